@@ -0,0 +1,10 @@
+"""
+Micro-benchmarks de los handlers del bot, sin red.
+
+Gemini, Google Sheets y Telegram se sustituyen por dobles en memoria (ver fakes.py) con
+latencias configurables, y cada handler se cronometra sobre libros de distinto tamaño.
+Los resultados se escriben en JSON para comparar dos commits:
+
+    python -m benchmarks.run --salida antes.json
+    python -m benchmarks.run --salida despues.json --comparar antes.json
+"""
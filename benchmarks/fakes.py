@@ -0,0 +1,297 @@
+"""
+Dobles en memoria de Gemini, gspread y Telegram para los benchmarks.
+
+Imitan solo la parte de cada API que usa bot.py. Las latencias se simulan con time.sleep en
+las llamadas que el bot ejecuta en sus pools de hilos (Gemini, Sheets) y con asyncio.sleep en
+las que son corutinas (Telegram), para que el coste caiga donde caería en producción.
+"""
+import asyncio
+import io
+import itertools
+import json
+import re
+import threading
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+import gspread
+from PIL import Image
+
+PATRON_MENSAJE = re.compile(r'Mensaje: "(.*)"')
+PATRON_MENSAJE_LOTE = re.compile(r'^(\w+): "(.*)"$', re.MULTILINE)
+PATRON_NUMERO = re.compile(r"\d+(?:[.,]\d+)?")
+
+# Gemini
+
+def _extraccion_guionizada(texto):
+    """Lo que respondería el modelo a un mensaje de registro: un gasto del primer concepto."""
+    numero = PATRON_NUMERO.search(texto)
+    if numero is None:
+        return {"tipo": "GASTO", "monto": 0, "concepto": "G1", "categoria": "VARIABLE",
+                "fecha": "actual", "error": "Monto no válido"}
+    return {"tipo": "GASTO", "monto": float(numero.group().replace(",", ".")), "concepto": "G1",
+            "categoria": "VARIABLE", "fecha": "actual"}
+
+def guion_por_defecto(contenido):
+    """Respuesta del modelo falso según el tipo de prompt (recibo, lote o mensaje suelto)."""
+    if isinstance(contenido, list):
+        return {"monto_total": 42.5, "fecha": datetime.now().strftime("%d/%m/%Y"), "categoria": "Supermercado"}
+    if "Mensajes (id: texto)" in contenido:
+        return [dict(_extraccion_guionizada(texto), id=id_mensaje)
+                for id_mensaje, texto in PATRON_MENSAJE_LOTE.findall(contenido)]
+    mensaje = PATRON_MENSAJE.search(contenido)
+    return _extraccion_guionizada(mensaje.group(1) if mensaje else "")
+
+class ModeloGeminiFalso:
+    """
+    Sustituto de genai.GenerativeModel: responde JSON según `guion(contenido)` tras `latencia`
+    segundos. Con stream=True reparte la respuesta y la latencia en `trozos` partes.
+    """
+
+    def __init__(self, latencia=0.05, guion=guion_por_defecto, trozos=4):
+        self.latencia = latencia
+        self.guion = guion
+        self.trozos = trozos
+        self.llamadas = 0
+        self._lock = threading.Lock()
+
+    def generate_content(self, contenido, generation_config=None, stream=False):
+        with self._lock:
+            self.llamadas += 1
+        texto = json.dumps(self.guion(contenido), ensure_ascii=False)
+        if not stream:
+            time.sleep(self.latencia)
+            return SimpleNamespace(text=texto)
+        return self._stream(texto)
+
+    def _stream(self, texto):
+        tamano = max(1, -(-len(texto) // self.trozos))
+        for inicio in range(0, len(texto), tamano):
+            time.sleep(self.latencia / self.trozos)
+            yield SimpleNamespace(text=texto[inicio:inicio + tamano])
+
+# Google Sheets
+
+PATRON_RANGO = re.compile(r"^[A-Z]+(\d+):[A-Z]+(\d+)$")
+
+class HojaFalsa:
+    """Worksheet de gspread en memoria; la fila 1 son los encabezados, como en la hoja real."""
+
+    def __init__(self, encabezados, filas=(), latencia=0.02, title="Registro"):
+        self.title = title
+        self.latencia = latencia
+        self.filas = ([list(encabezados)] if encabezados else []) + [list(fila) for fila in filas]
+        self.llamadas = 0
+        self._lock = threading.Lock()
+
+    def _esperar(self):
+        self.llamadas += 1
+        time.sleep(self.latencia)
+
+    @property
+    def row_count(self):
+        return len(self.filas)
+
+    def append_rows(self, filas, **kwargs):
+        self._esperar()
+        with self._lock:
+            primera = len(self.filas) + 1
+            self.filas.extend(list(fila) for fila in filas)
+            ultima = len(self.filas)
+        columna = chr(ord("A") + max(len(fila) for fila in filas) - 1)
+        return {"updates": {"updatedRange": f"{self.title}!A{primera}:{columna}{ultima}", "updatedRows": len(filas)}}
+
+    def append_row(self, fila, **kwargs):
+        return self.append_rows([fila], **kwargs)
+
+    def update(self, rango, valores, **kwargs):
+        """Escribe `valores` a partir de la celda de la columna A indicada ("A1")."""
+        self._esperar()
+        primera = int(re.match(r"^[A-Z]+(\d+)", rango).group(1))
+        with self._lock:
+            while len(self.filas) < primera - 1 + len(valores):
+                self.filas.append([])
+            for i, fila in enumerate(valores):
+                self.filas[primera - 1 + i] = list(fila)
+        return {"updatedRange": rango}
+
+    def get_values(self, rango=None, **kwargs):
+        self._esperar()
+        with self._lock:
+            if rango is None:
+                return [list(fila) for fila in self.filas]
+            desde, hasta = (int(n) for n in PATRON_RANGO.match(rango).groups())
+            return [[str(valor) for valor in fila] for fila in self.filas[desde - 1:hasta]]
+
+    def col_values(self, columna, **kwargs):
+        self._esperar()
+        with self._lock:
+            valores = [str(fila[columna - 1]) if len(fila) >= columna else "" for fila in self.filas]
+        # Como la API: hasta la última celda con valor
+        while valores and not valores[-1]:
+            valores.pop()
+        return valores
+
+    def get_all_records(self, **kwargs):
+        self._esperar()
+        with self._lock:
+            encabezados, *filas = self.filas
+        return [dict(zip(encabezados, fila)) for fila in filas]
+
+class LibroFalso:
+    """gspread.Spreadsheet en memoria: hojas por nombre, creadas bajo demanda como en la real."""
+
+    def __init__(self, title, hojas=(), latencia=0.02):
+        self.title = title
+        self.latencia = latencia
+        self.hojas = {hoja.title: hoja for hoja in hojas}
+
+    def worksheet(self, titulo):
+        time.sleep(self.latencia)
+        if titulo not in self.hojas:
+            raise gspread.exceptions.WorksheetNotFound(titulo)
+        return self.hojas[titulo]
+
+    def worksheets(self):
+        time.sleep(self.latencia)
+        return list(self.hojas.values())
+
+    def add_worksheet(self, title, rows=1, cols=7, **kwargs):
+        time.sleep(self.latencia)
+        hoja = HojaFalsa((), latencia=self.latencia, title=title)
+        self.hojas[title] = hoja
+        return hoja
+
+def generar_filas(cantidad, usuarios=("Ana", "Luis", "Sofía"), conceptos=("ALIMENTOS", "PASAJES", "LUZ"),
+                  hoy=None):
+    """`cantidad` filas del libro repartidas en los últimos 12 meses, en orden cronológico."""
+    hoy = hoy or datetime.now()
+    filas = []
+    for i in range(cantidad):
+        mes = (hoy.month - 1 - (cantidad - 1 - i) * 12 // max(cantidad, 1)) % 12 + 1
+        anio = hoy.year if mes <= hoy.month else hoy.year - 1
+        fecha = datetime(anio, mes, 1 + i % 28, 12, 0, 0)
+        tipo = "INGRESO" if i % 10 == 0 else "GASTO"
+        filas.append([
+            fecha.strftime("%d/%m/%Y %H:%M:%S"),
+            usuarios[i % len(usuarios)],
+            tipo,
+            "FIJO" if tipo == "INGRESO" else "VARIABLE",
+            "SUELDO" if tipo == "INGRESO" else conceptos[i % len(conceptos)],
+            1500 if tipo == "INGRESO" else 10 + i % 90,
+            fecha.strftime("%B %Y"),
+        ])
+    return filas
+
+# Telegram
+
+_ids_mensaje = itertools.count(1)
+
+class TelegramFalso:
+    """Registro de las llamadas salientes a Telegram, con latencia simulada."""
+
+    def __init__(self, latencia=0.0):
+        self.latencia = latencia
+        self.llamadas = 0
+
+    async def llamar(self):
+        self.llamadas += 1
+        if self.latencia:
+            await asyncio.sleep(self.latencia)
+
+class MensajeFalso:
+    """Lo que los handlers usan de telegram.Message: texto, fotos y respuestas/ediciones."""
+
+    def __init__(self, telegram, usuario, texto=None, fotos=()):
+        self._telegram = telegram
+        self.message_id = next(_ids_mensaje)
+        self.from_user = usuario
+        self.chat = SimpleNamespace(id=usuario.id, type="private")
+        self.text = texto
+        self.photo = tuple(fotos)
+        self.ediciones = []
+        self.respuestas = []
+
+    async def reply_text(self, texto, **kwargs):
+        await self._telegram.llamar()
+        respuesta = MensajeFalso(self._telegram, self.from_user, texto)
+        self.respuestas.append(respuesta)
+        return respuesta
+
+    async def edit_text(self, texto, **kwargs):
+        await self._telegram.llamar()
+        self.ediciones.append(texto)
+        self.text = texto
+        return self
+
+class CallbackQueryFalso:
+    """Lo que los handlers usan de telegram.CallbackQuery."""
+
+    def __init__(self, telegram, usuario, data):
+        self._telegram = telegram
+        self.id = str(next(_ids_mensaje))
+        self.from_user = usuario
+        self.data = data
+        self.message = MensajeFalso(telegram, usuario)
+
+    async def answer(self, *args, **kwargs):
+        await self._telegram.llamar()
+
+    async def edit_message_text(self, text, **kwargs):
+        return await self.message.edit_text(text, **kwargs)
+
+class ArchivoFalso:
+    def __init__(self, datos):
+        self._datos = datos
+
+    async def download_as_bytearray(self):
+        return bytearray(self._datos)
+
+class FotoFalsa:
+    """telegram.PhotoSize con los bytes de la imagen ya en memoria."""
+
+    def __init__(self, telegram, datos, width, height):
+        self._telegram = telegram
+        self._datos = datos
+        self.width = width
+        self.height = height
+        self.file_id = f"foto{next(_ids_mensaje)}"
+
+    async def get_file(self):
+        await self._telegram.llamar()
+        return ArchivoFalso(self._datos)
+
+def crear_usuario(user_id=1000, nombre="Ana"):
+    return SimpleNamespace(id=user_id, first_name=nombre, username=None, is_bot=False)
+
+def _update(usuario, mensaje=None, callback_query=None):
+    return SimpleNamespace(
+        update_id=next(_ids_mensaje),
+        message=mensaje,
+        callback_query=callback_query,
+        effective_user=usuario,
+        effective_chat=SimpleNamespace(id=usuario.id, type="private"),
+        effective_message=mensaje or (callback_query.message if callback_query else None),
+    )
+
+def crear_update_texto(telegram, usuario, texto):
+    return _update(usuario, mensaje=MensajeFalso(telegram, usuario, texto))
+
+def crear_update_callback(telegram, usuario, data):
+    return _update(usuario, callback_query=CallbackQueryFalso(telegram, usuario, data))
+
+def crear_update_foto(telegram, usuario, lado_mayor=1600):
+    """Update con una foto de ruido aleatorio (cada llamada da un recibo distinto), en tres tamaños."""
+    ancho, alto = lado_mayor, lado_mayor * 3 // 4
+    imagen = Image.effect_noise((ancho, alto), 64).convert("RGB")
+    fotos = []
+    for escala in (4, 2, 1):
+        reducida = imagen.resize((ancho // escala, alto // escala))
+        buffer = io.BytesIO()
+        reducida.save(buffer, format="JPEG", quality=85)
+        fotos.append(FotoFalsa(telegram, buffer.getvalue(), reducida.width, reducida.height))
+    return _update(usuario, mensaje=MensajeFalso(telegram, usuario, fotos=fotos))
+
+def crear_contexto():
+    return SimpleNamespace(user_data={}, chat_data={}, bot_data={}, args=[])
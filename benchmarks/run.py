@@ -0,0 +1,236 @@
+"""
+Cronometra los handlers del bot con Gemini, Sheets y Telegram falsos.
+
+    python -m benchmarks.run [--filas 100 1000 10000 100000] [--repeticiones 30]
+                             [--latencia-gemini 0.05] [--latencia-sheets 0.02] [--latencia-telegram 0]
+                             [--salida resultados.json] [--comparar base.json] [--umbral 10]
+
+Para cada tamaño del libro se carga la hoja falsa con ese número de filas, se sincroniza la
+copia local y se mide cada caso `--repeticiones` veces. Con --comparar se marca como regresión
+todo caso cuyo p50 empeore más de --umbral por ciento respecto al archivo base (código de
+salida 1).
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from benchmarks import fakes
+
+TEXTO_PARSER_LOCAL = "GASTO 50 ALIMENTOS"
+TEXTO_GEMINI = "PAGUÉ 37 POR UNAS COSITAS VARIAS"
+
+def _configurar_entorno(directorio):
+    """El bot lee su configuración al importarse: rutas temporales y cuotas sin límite práctico."""
+    os.environ.setdefault("CONTABOT_DB_PATH", os.path.join(directorio, "contabot.db"))
+    os.environ.setdefault("JOURNAL_PATH", os.path.join(directorio, "registros_pendientes.jsonl"))
+    os.environ.setdefault("ALMACEN_BACKEND", "memoria")
+    os.environ.setdefault("ENABLE_RECEIPT_PROCESSING", "true")
+    os.environ.setdefault("GEMINI_PETICIONES_POR_MINUTO", "1000000")
+    os.environ.setdefault("SHEETS_PETICIONES_POR_MINUTO", "1000000")
+
+def percentil(valores, p):
+    """Percentil por rango más cercano de una lista ya ordenada."""
+    if not valores:
+        return None
+    indice = max(0, min(len(valores), math.ceil(p / 100 * len(valores))) - 1)
+    return valores[indice]
+
+def resumir(caso, variante, filas, tiempos):
+    tiempos = sorted(t * 1000 for t in tiempos)
+    return {
+        "caso": caso,
+        "variante": variante,
+        "filas": filas,
+        "n": len(tiempos),
+        "media_ms": sum(tiempos) / len(tiempos),
+        "p50_ms": percentil(tiempos, 50),
+        "p95_ms": percentil(tiempos, 95),
+        "p99_ms": percentil(tiempos, 99),
+        "min_ms": tiempos[0],
+        "max_ms": tiempos[-1],
+    }
+
+async def cronometrar(repeticiones, preparar, ejecutar):
+    """Llama a preparar() (sin medir) y luego a ejecutar(...) (medido) `repeticiones` veces."""
+    tiempos = []
+    for _ in range(repeticiones):
+        argumentos = preparar()
+        inicio = time.perf_counter()
+        await ejecutar(*argumentos)
+        tiempos.append(time.perf_counter() - inicio)
+    return tiempos
+
+async def esperar_edicion_final(mensaje, limite=60.0):
+    """Espera a que el acuse de un recibo se edite con el resultado (✅, ❌ o ⚠️)."""
+    fin = time.perf_counter() + limite
+    while time.perf_counter() < fin:
+        if mensaje.ediciones and mensaje.ediciones[-1][:1] in ("✅", "❌", "⚠"):
+            return
+        await asyncio.sleep(0.001)
+    raise TimeoutError("El recibo no terminó de procesarse")
+
+async def medir_tamano(bot, filas, args, telegram, directorio):
+    resultados = []
+    usuario = fakes.crear_usuario()
+    contexto = fakes.crear_contexto()
+
+    # Libro nuevo: hoja falsa con `filas` filas y copia local vacía que se sincroniza desde ella
+    await bot.cola_registros.vaciar()
+    # Las filas históricas están en la hoja "Registro" única; las nuevas van a la hoja del mes
+    hoja = fakes.HojaFalsa(bot.COLUMNAS_REGISTRO, fakes.generar_filas(filas), latencia=args.latencia_sheets,
+                           title=bot.NOMBRE_HOJA_REGISTRO)
+    bot._hojas_cache.clear()
+    bot._libros_cache[bot.LIBRO_POR_DEFECTO] = fakes.LibroFalso(bot.LIBRO_POR_DEFECTO, [hoja],
+                                                                latencia=args.latencia_sheets)
+    bot.libro_local.cerrar()
+    bot.libro_local = bot.LibroLocal(os.path.join(directorio, f"libro_{filas}.db"))
+    inicio = time.perf_counter()
+    await bot.sincronizar_libro_local()
+    resultados.append(resumir("sincronizar_libro_local", "inicial", filas, [time.perf_counter() - inicio]))
+
+    def texto(mensaje, invalidar_cache=False):
+        def preparar():
+            if invalidar_cache:
+                bot.cache_extracciones.invalidar()
+            return fakes.crear_update_texto(telegram, usuario, mensaje), contexto
+        return preparar
+
+    casos = [
+        ("registrar_por_texto", "parser_local", texto(TEXTO_PARSER_LOCAL), bot.registrar_por_texto),
+        ("registrar_por_texto", "gemini", texto(TEXTO_GEMINI, invalidar_cache=True), bot.registrar_por_texto),
+        ("registrar_por_texto", "cache", texto(TEXTO_GEMINI), bot.registrar_por_texto),
+    ]
+
+    def callback(data, datos_usuario):
+        def preparar():
+            bot.usuario_data[usuario.id] = dict(datos_usuario)
+            return fakes.crear_update_callback(telegram, usuario, data), contexto
+        return preparar
+
+    casos += [
+        ("elegir_categoria", "gasto", callback("VARIABLE", {"usuario": usuario.first_name, "tipo": "GASTO"}),
+         bot.elegir_categoria),
+        ("confirmar", "confirmar", callback("confirmar", {
+            "usuario": usuario.first_name, "tipo": "GASTO", "categoria": "VARIABLE",
+            "concepto": "ALIMENTOS", "monto": 25.0,
+        }), bot.confirmar),
+        ("elegir_accion", "ver_ultimo", callback("ver_ultimo", {}), bot.elegir_accion),
+    ]
+
+    for caso, variante, preparar, handler in casos:
+        tiempos = await cronometrar(args.repeticiones, preparar, handler)
+        resultados.append(resumir(caso, variante, filas, tiempos))
+
+    # Recibos: el acuse es lo que tarda el handler; "completo" incluye cola, preproceso y Gemini
+    acuses, completos = [], []
+    for _ in range(args.repeticiones_recibos):
+        update = fakes.crear_update_foto(telegram, usuario)
+        inicio = time.perf_counter()
+        await bot.procesar_recibo_con_gemini(update, contexto)
+        acuses.append(time.perf_counter() - inicio)
+        await esperar_edicion_final(update.message.respuestas[0])
+        completos.append(time.perf_counter() - inicio)
+    resultados.append(resumir("procesar_recibo_con_gemini", "acuse", filas, acuses))
+    resultados.append(resumir("procesar_recibo_con_gemini", "completo", filas, completos))
+    return resultados
+
+async def ejecutar_benchmarks(bot, args, directorio):
+    telegram = fakes.TelegramFalso(latencia=args.latencia_telegram)
+    modelo = fakes.ModeloGeminiFalso(latencia=args.latencia_gemini)
+    bot.gemini_text_model = modelo
+    bot.gemini_vision_model = modelo
+
+    bot.cola_registros.iniciar()
+    bot.cola_recibos.iniciar()
+    try:
+        resultados = []
+        for filas in args.filas:
+            logging.getLogger("benchmarks").warning(f"Midiendo con un libro de {filas} filas...")
+            resultados += await medir_tamano(bot, filas, args, telegram, directorio)
+    finally:
+        await bot.cola_recibos.detener()
+        await bot.cola_registros.detener()
+    return resultados, {"llamadas_gemini": modelo.llamadas, "llamadas_telegram": telegram.llamadas}
+
+def _commit_actual():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def comparar(resultados, base, umbral):
+    """Devuelve los casos cuyo p50 empeoró más de `umbral` por ciento respecto a `base`."""
+    anteriores = {(r["caso"], r["variante"], r["filas"]): r for r in base["resultados"]}
+    regresiones = []
+    for r in resultados:
+        anterior = anteriores.get((r["caso"], r["variante"], r["filas"]))
+        if anterior is None or not anterior["p50_ms"]:
+            continue
+        cambio = (r["p50_ms"] - anterior["p50_ms"]) / anterior["p50_ms"] * 100
+        if cambio > umbral:
+            regresiones.append(dict(r, p50_base_ms=anterior["p50_ms"], cambio_pct=cambio))
+    return regresiones
+
+def imprimir_tabla(resultados, archivo=sys.stderr):
+    print(f"{'caso':<28} {'variante':<12} {'filas':>7} {'n':>4} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}",
+          file=archivo)
+    for r in resultados:
+        print(f"{r['caso']:<28} {r['variante']:<12} {r['filas']:>7} {r['n']:>4} "
+              f"{r['p50_ms']:>9.2f} {r['p95_ms']:>9.2f} {r['p99_ms']:>9.2f}", file=archivo)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Micro-benchmarks de los handlers de ContaBot")
+    parser.add_argument("--filas", type=int, nargs="+", default=[100, 1000, 10000, 100000])
+    parser.add_argument("--repeticiones", type=int, default=30)
+    parser.add_argument("--repeticiones-recibos", type=int, default=5)
+    parser.add_argument("--latencia-gemini", type=float, default=0.05)
+    parser.add_argument("--latencia-sheets", type=float, default=0.02)
+    parser.add_argument("--latencia-telegram", type=float, default=0.0)
+    parser.add_argument("--salida", help="Archivo JSON de resultados (por defecto, a stdout)")
+    parser.add_argument("--comparar", help="Archivo JSON de una ejecución anterior")
+    parser.add_argument("--umbral", type=float, default=10.0, help="Regresión mínima del p50, en %%")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix="contabot-bench-") as directorio:
+        _configurar_entorno(directorio)
+        import bot
+        logging.getLogger().setLevel(logging.WARNING)
+        resultados, contadores = asyncio.run(ejecutar_benchmarks(bot, args, directorio))
+
+    salida = {
+        "commit": _commit_actual(),
+        "fecha": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "configuracion": {k: v for k, v in vars(args).items() if k not in ("salida", "comparar")},
+        "contadores": contadores,
+        "resultados": resultados,
+    }
+    imprimir_tabla(resultados)
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as f:
+            json.dump(salida, f, indent=2, ensure_ascii=False)
+    else:
+        print(json.dumps(salida, indent=2, ensure_ascii=False))
+
+    if args.comparar:
+        with open(args.comparar, encoding="utf-8") as f:
+            regresiones = comparar(resultados, json.load(f), args.umbral)
+        for r in regresiones:
+            print(f"REGRESIÓN {r['caso']}/{r['variante']} ({r['filas']} filas): "
+                  f"p50 {r['p50_base_ms']:.2f} -> {r['p50_ms']:.2f} ms (+{r['cambio_pct']:.0f}%)")
+        if regresiones:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,35 +1,113 @@
+import time
+# Referencia para el desglose del arranque (ver registrar_etapa_arranque)
+INICIO_PROCESO = time.perf_counter()
 import logging
-from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram import Bot, Update, InlineKeyboardMarkup, InlineKeyboardButton
 # Importar Application, Request y URLInputFile para usar con webhooks en versiones recientes de python-telegram-bot
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackContext, ConversationHandler, CallbackQueryHandler
 from telegram.ext import filters # Importa el módulo 'filters' aparte
+from telegram.ext import BasePersistence, PersistenceInput, TypeHandler, ApplicationHandlerStop
+from telegram.request import HTTPXRequest
+import tornado.ioloop
+import tornado.web
 # No necesitamos Updater con Application.run_webhook
 # from telegram.ext import Updater
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
-from datetime import datetime
+# gspread, oauth2client, el SDK de Gemini, Pillow y openpyxl tardan en importarse; se cargan la
+# primera vez que se usan (ver cargar_genai, _crear_cliente_sheets, preprocesar_recibo y leer_filas_extracto)
+from cachetools import TTLCache
+from datetime import date, datetime, timedelta
 import os
 import json # Necesario para cargar las credenciales de Google Sheets desde JSON string
-import google.generativeai as genai
-from PIL import Image # Necesitas Pillow para esto
 import io
-
-# Estructura para almacenar datos de usuarios
-users_db = {}  # Temporal, luego será PostgreSQL
-families_db = {}  # Temporal
+import csv
+import codecs
+import tempfile
+import re
+import string
+import unicodedata
+import threading
+import asyncio
+import functools
+import uuid
+import random
+import sys
+import signal
+import multiprocessing
+import sqlite3
+import contextlib
+import importlib
+import zlib
+import weakref
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import requests
 
 # Nuevos estados para el onboarding
 ONBOARDING_START, ONBOARDING_ROLE, ONBOARDING_INCOME, ONBOARDING_GOALS = range(6, 10)
 
-# **Importante:** Estas variables se inicializarán más tarde en main()
-# Las declaramos aquí para que sean globales y accesibles desde cualquier función.
+# Los modelos se crean en el primer uso o al precalentar, no al arrancar (ver modelo_gemini).
+# Los benchmarks y las pruebas de carga asignan aquí sus modelos falsos.
 gemini_text_model = None
-gemini_vision_model = None # Si vas a usar gemini-pro-vision
+gemini_vision_model = None
+MODELO_GEMINI = 'gemini-1.5-flash'
+RECIBOS_ACTIVADOS = os.getenv("ENABLE_RECEIPT_PROCESSING", "False").lower() == "true"
 
 # Configuración de logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Arranque
+# En el plan gratuito de Render el servicio se duerme sin tráfico y el mensaje que lo despierta
+# espera todo el arranque. Cada etapa guarda el momento en que terminó, desde INICIO_PROCESO.
+ETAPAS_ARRANQUE = {}
+
+def registrar_etapa_arranque(etapa):
+    ETAPAS_ARRANQUE[etapa] = time.perf_counter() - INICIO_PROCESO
+
+def resumen_arranque():
+    """'etapa a los Xs (+duración)' para cada etapa registrada, en orden."""
+    partes = []
+    anterior = 0.0
+    for etapa, segundos in ETAPAS_ARRANQUE.items():
+        partes.append(f"{etapa} a los {segundos:.2f}s (+{segundos - anterior:.2f}s)")
+        anterior = segundos
+    return ", ".join(partes)
+
+# Gemini
+_genai = None
+_genai_lock = threading.Lock()
+
+def cargar_genai():
+    """Importa y configura el SDK de Gemini la primera vez; tarda, así que se llama desde un hilo."""
+    global _genai
+    with _genai_lock:
+        if _genai is None:
+            import google.generativeai as genai
+            genai.configure(api_key=os.environ["GEMINI_API_KEY"])
+            _genai = genai
+        return _genai
+
+def _crear_modelo_gemini(vision):
+    global gemini_text_model, gemini_vision_model
+    genai = cargar_genai()
+    with _genai_lock:
+        if vision:
+            if gemini_vision_model is None:
+                gemini_vision_model = genai.GenerativeModel(MODELO_GEMINI)
+            return gemini_vision_model
+        if gemini_text_model is None:
+            gemini_text_model = genai.GenerativeModel(MODELO_GEMINI)
+        return gemini_text_model
+
+async def modelo_gemini(vision=False):
+    """Modelo de texto o de visión; si todavía no existe se crea en un hilo para no frenar el event loop."""
+    if vision and not RECIBOS_ACTIVADOS:
+        raise RuntimeError("El análisis de recibos no está activado (ENABLE_RECEIPT_PROCESSING).")
+    modelo = gemini_vision_model if vision else gemini_text_model
+    if modelo is None:
+        modelo = await asyncio.to_thread(_crear_modelo_gemini, vision)
+    return modelo
+
 # Estados de la conversación
 ELEGIR_ACCION, ELEGIR_TIPO, ELEGIR_CATEGORIA, ELEGIR_CONCEPTO, INGRESAR_MONTO, CONFIRMAR = range(6)
 
@@ -88,11 +166,715 @@ CONCEPTOS_GASTOS = [
 CATEGORIAS = ["FIJO", "VARIABLE"]
 TIPOS = ["INGRESO", "GASTO"]
 
+# Persistencia de perfiles y conversaciones
+# users_db, families_db y usuario_data son diccionarios en memoria (las lecturas no tocan disco)
+# que escriben cada cambio en un almacén clave-valor. El almacén por defecto es SQLite; el
+# backend se elige con ALMACEN_BACKEND para poder cambiarlo sin tocar los handlers.
+RUTA_BASE_DATOS = os.getenv("CONTABOT_DB_PATH", "contabot.db")
+
+# Con WEBHOOK_WORKERS > 1 el proceso principal solo enruta updates a N procesos trabajadores
+# (ver EnrutadorTrabajadores). Cada trabajador recibe su índice en CONTABOT_TRABAJADOR.
+TRABAJADORES = max(1, int(os.getenv("WEBHOOK_WORKERS", "1")))
+TRABAJADOR = os.getenv("CONTABOT_TRABAJADOR")
+
+def ruta_de_trabajador(ruta, indice=None):
+    """Ruta propia de un trabajador ("registros.trabajador2.jsonl"); sin trabajador, la ruta tal cual."""
+    indice = TRABAJADOR if indice is None else indice
+    if indice is None:
+        return ruta
+    base, extension = os.path.splitext(ruta)
+    return f"{base}.trabajador{indice}{extension}"
+
+# Idempotencia: update_id ya procesados, callbacks de confirmación ya atendidos y claves de las
+# filas ya guardadas se marcan en el almacén con vencimiento, para que ni los reintentos de
+# Telegram ni un doble toque en "✅ Confirmar" lleguen dos veces a la hoja.
+IDEMPOTENCIA_TTL = float(os.getenv("IDEMPOTENCIA_TTL", str(24 * 3600)))
+IDEMPOTENCIA_MAXIMO = int(os.getenv("IDEMPOTENCIA_MAXIMO", "100000"))
+
+class AlmacenKV:
+    """Interfaz de los backends de persistencia: espacios de nombres con claves y valores JSON."""
+
+    def cargar(self, espacio):
+        """Devuelve {clave: valor} con todo el contenido del espacio."""
+        raise NotImplementedError
+
+    def leer(self, espacio, clave):
+        """Valor de una clave; KeyError si no existe. Los backends remotos deberían sobrescribirla."""
+        return self.cargar(espacio)[clave]
+
+    def guardar(self, espacio, clave, valor):
+        raise NotImplementedError
+
+    def borrar(self, espacio, clave):
+        raise NotImplementedError
+
+    def marcar_una_vez(self, espacio, clave, ttl):
+        """
+        Marca la clave durante `ttl` segundos; True si no estaba marcada. Tiene que ser atómico
+        entre procesos (en un almacén de red, el equivalente a SET NX EX).
+        """
+        raise NotImplementedError
+
+    def desmarcar(self, espacio, clave):
+        raise NotImplementedError
+
+    def marcado(self, espacio, clave):
+        """True si la clave tiene una marca vigente."""
+        raise NotImplementedError
+
+    def sumar(self, espacio, clave, cantidad):
+        """
+        Suma `cantidad` a un contador numérico (0 si no existía) y devuelve el total nuevo. Tiene
+        que ser atómico entre procesos (en un almacén de red, el equivalente a INCRBYFLOAT).
+        """
+        raise NotImplementedError
+
+    def contador(self, espacio, clave):
+        """Valor de un contador; 0 si no existe."""
+        raise NotImplementedError
+
+class AlmacenMemoria(AlmacenKV):
+    """Backend sin persistencia, útil para pruebas locales."""
+
+    def __init__(self):
+        self._datos = {}
+        self._marcas = {}  # espacio -> TTLCache acotada
+        self._contadores = {}  # (espacio, clave) -> total
+
+    def cargar(self, espacio):
+        return dict(self._datos.get(espacio, {}))
+
+    def leer(self, espacio, clave):
+        return self._datos.get(espacio, {})[clave]
+
+    def guardar(self, espacio, clave, valor):
+        self._datos.setdefault(espacio, {})[clave] = json.loads(json.dumps(valor))
+
+    def borrar(self, espacio, clave):
+        self._datos.get(espacio, {}).pop(clave, None)
+
+    def marcar_una_vez(self, espacio, clave, ttl):
+        marcas = self._marcas.get(espacio)
+        if marcas is None:
+            marcas = self._marcas[espacio] = TTLCache(maxsize=IDEMPOTENCIA_MAXIMO, ttl=ttl)
+        if clave in marcas:
+            return False
+        marcas[clave] = True
+        return True
+
+    def desmarcar(self, espacio, clave):
+        self._marcas.get(espacio, {}).pop(clave, None)
+
+    def marcado(self, espacio, clave):
+        return clave in self._marcas.get(espacio, {})
+
+    def sumar(self, espacio, clave, cantidad):
+        total = self._contadores.get((espacio, clave), 0.0) + cantidad
+        self._contadores[(espacio, clave)] = total
+        return total
+
+    def contador(self, espacio, clave):
+        return self._contadores.get((espacio, clave), 0.0)
+
+class AlmacenSQLite(AlmacenKV):
+    """Backend por defecto: una tabla clave-valor en la base SQLite local."""
+
+    def __init__(self, ruta):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(ruta, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS kv (espacio TEXT, clave TEXT, valor TEXT, PRIMARY KEY (espacio, clave))"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS marcas (espacio TEXT, clave TEXT, vence REAL, PRIMARY KEY (espacio, clave))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_marcas_vence ON marcas(vence)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS contadores (espacio TEXT, clave TEXT, valor REAL NOT NULL, "
+            "PRIMARY KEY (espacio, clave))"
+        )
+        self._marcas_desde_purga = 0
+
+    def cargar(self, espacio):
+        with self._lock:
+            filas = self._conn.execute("SELECT clave, valor FROM kv WHERE espacio = ?", (espacio,)).fetchall()
+        # Las claves se guardan como JSON para conservar su tipo (los ids de Telegram son int)
+        return {json.loads(clave): json.loads(valor) for clave, valor in filas}
+
+    def leer(self, espacio, clave):
+        with self._lock:
+            fila = self._conn.execute(
+                "SELECT valor FROM kv WHERE espacio = ? AND clave = ?", (espacio, json.dumps(clave))
+            ).fetchone()
+        if fila is None:
+            raise KeyError(clave)
+        return json.loads(fila[0])
+
+    def guardar(self, espacio, clave, valor):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO kv (espacio, clave, valor) VALUES (?, ?, ?)",
+                (espacio, json.dumps(clave), json.dumps(valor, ensure_ascii=False))
+            )
+
+    def borrar(self, espacio, clave):
+        with self._lock:
+            self._conn.execute("DELETE FROM kv WHERE espacio = ? AND clave = ?", (espacio, json.dumps(clave)))
+
+    def marcar_una_vez(self, espacio, clave, ttl):
+        ahora = time.time()
+        clave = json.dumps(clave)
+        with self._lock:
+            # Cada sentencia es atómica (autocommit), también frente a otros procesos
+            self._conn.execute("DELETE FROM marcas WHERE espacio = ? AND clave = ? AND vence < ?",
+                               (espacio, clave, ahora))
+            cursor = self._conn.execute("INSERT OR IGNORE INTO marcas (espacio, clave, vence) VALUES (?, ?, ?)",
+                                        (espacio, clave, ahora + ttl))
+            self._marcas_desde_purga += 1
+            if self._marcas_desde_purga >= 1000:
+                self._purgar_marcas(ahora)
+        return cursor.rowcount == 1
+
+    def _purgar_marcas(self, ahora):
+        """Borra las marcas vencidas y, si aun así sobran, las que vencen antes."""
+        self._marcas_desde_purga = 0
+        self._conn.execute("DELETE FROM marcas WHERE vence < ?", (ahora,))
+        self._conn.execute(
+            "DELETE FROM marcas WHERE rowid IN (SELECT rowid FROM marcas ORDER BY vence DESC LIMIT -1 OFFSET ?)",
+            (IDEMPOTENCIA_MAXIMO,)
+        )
+
+    def desmarcar(self, espacio, clave):
+        with self._lock:
+            self._conn.execute("DELETE FROM marcas WHERE espacio = ? AND clave = ?", (espacio, json.dumps(clave)))
+
+    def marcado(self, espacio, clave):
+        with self._lock:
+            fila = self._conn.execute(
+                "SELECT 1 FROM marcas WHERE espacio = ? AND clave = ? AND vence >= ?",
+                (espacio, json.dumps(clave), time.time())
+            ).fetchone()
+        return fila is not None
+
+    def sumar(self, espacio, clave, cantidad):
+        clave = json.dumps(clave)
+        with self._lock:
+            # BEGIN IMMEDIATE: otro proceso no puede sumar entre el incremento y la lectura del total
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "INSERT INTO contadores (espacio, clave, valor) VALUES (?, ?, ?) "
+                    "ON CONFLICT(espacio, clave) DO UPDATE SET valor = valor + excluded.valor",
+                    (espacio, clave, cantidad)
+                )
+                total = self._conn.execute(
+                    "SELECT valor FROM contadores WHERE espacio = ? AND clave = ?", (espacio, clave)
+                ).fetchone()[0]
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return total
+
+    def contador(self, espacio, clave):
+        with self._lock:
+            fila = self._conn.execute(
+                "SELECT valor FROM contadores WHERE espacio = ? AND clave = ?", (espacio, json.dumps(clave))
+            ).fetchone()
+        return fila[0] if fila else 0.0
+
+def crear_almacen():
+    backend = os.getenv("ALMACEN_BACKEND", "sqlite").lower()
+    if backend == "memoria":
+        if TRABAJADORES > 1:
+            raise ValueError("ALMACEN_BACKEND=memoria no se puede compartir entre varios trabajadores.")
+        return AlmacenMemoria()
+    if backend != "sqlite":
+        logger.warning(f"ALMACEN_BACKEND desconocido '{backend}', se usa SQLite.")
+    return AlmacenSQLite(RUTA_BASE_DATOS)
+
+class DiccionarioPersistente(MutableMapping):
+    """
+    dict en memoria con escritura inmediata (write-through) en un AlmacenKV.
+    Con compartido=True no guarda copia en memoria: cada lectura va al almacén, para ver lo que
+    escriben los otros procesos trabajadores.
+    """
+
+    def __init__(self, almacen, espacio, compartido=False):
+        self._almacen = almacen
+        self._espacio = espacio
+        self._compartido = compartido
+        self._datos = {} if compartido else almacen.cargar(espacio)
+
+    def _vista(self):
+        return self._almacen.cargar(self._espacio) if self._compartido else self._datos
+
+    def __getitem__(self, clave):
+        if self._compartido:
+            return self._almacen.leer(self._espacio, clave)
+        return self._datos[clave]
+
+    def __setitem__(self, clave, valor):
+        self._almacen.guardar(self._espacio, clave, valor)
+        if not self._compartido:
+            self._datos[clave] = valor
+
+    def __delitem__(self, clave):
+        if self._compartido:
+            self._almacen.leer(self._espacio, clave)  # KeyError si no existe, como un dict
+        else:
+            del self._datos[clave]
+        self._almacen.borrar(self._espacio, clave)
+
+    def __iter__(self):
+        return iter(self._vista())
+
+    def __len__(self):
+        return len(self._vista())
+
+    def actualizar(self, clave, **campos):
+        """Modifica campos de un valor dict y lo persiste (las mutaciones anidadas no se ven solas)."""
+        self[clave] = {**self.get(clave, {}), **campos}
+
+almacen = crear_almacen()
+
+# Estructura para almacenar datos de usuarios
+users_db = DiccionarioPersistente(almacen, "usuarios", compartido=TRABAJADORES > 1)
+families_db = DiccionarioPersistente(almacen, "familias", compartido=TRABAJADORES > 1)
+
 # Variables para almacenar temporalmente la información del registro
-usuario_data = {}
+usuario_data = DiccionarioPersistente(almacen, "conversaciones", compartido=TRABAJADORES > 1)
 
-# Función para conectar con Google Sheets
-def conectar_google_sheets():
+# Recibos parecidos a uno ya registrado, esperando que el usuario confirme (ver confirmar_recibo_repetido)
+recibos_por_confirmar = DiccionarioPersistente(almacen, "recibos_por_confirmar", compartido=TRABAJADORES > 1)
+
+# Importaciones de extractos esperando confirmación (ver importar_extracto)
+importaciones = DiccionarioPersistente(almacen, "importaciones", compartido=TRABAJADORES > 1)
+
+class PersistenciaBot(BasePersistence):
+    """
+    Persistencia de python-telegram-bot sobre el mismo almacén, para que el estado de los
+    ConversationHandler sobreviva a reinicios. Solo se guardan las conversaciones: los datos de
+    usuarios y familias ya viven en los diccionarios persistentes de arriba.
+    """
+
+    def __init__(self, almacen):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=False, callback_data=False),
+            # Respaldo: cada update ya guarda su cambio de estado al terminar (ver marcar_update_atendido)
+            update_interval=60,
+        )
+        self._almacen = almacen
+
+    async def get_conversations(self, name):
+        guardadas = self._almacen.cargar(f"ptb_conversacion:{name}")
+        return {tuple(json.loads(clave)): estado for clave, estado in guardadas.items()}
+
+    async def update_conversation(self, name, key, new_state):
+        clave = json.dumps(list(key))
+        if new_state is None:
+            self._almacen.borrar(f"ptb_conversacion:{name}", clave)
+        else:
+            self._almacen.guardar(f"ptb_conversacion:{name}", clave, new_state)
+
+    async def get_user_data(self):
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_user_data(self, user_id, data):
+        pass
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_user_data(self, user_id):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        pass
+
+# Parser local para el registro rápido
+# La mayoría de los mensajes siguen el formato "TIPO MONTO CONCEPTO" o frases muy comunes
+# ("gasté 30 en pasajes", "sueldo 1500"). Se resuelven aquí sin llamar a Gemini; solo los
+# mensajes ambiguos se envían al modelo.
+SINONIMOS_CONCEPTOS = {
+    "SUELDO": ["SALARIO", "QUINCENA"],
+    "GRATIFICACIÓN": ["GRATI"],
+    "MANICURE": ["UÑAS", "PEDICURE"],
+    "CUOTA DEPARTAMENTO": ["ALQUILER", "HIPOTECA", "RENTA"],
+    "TARJETA DE CREDITO": ["TARJETA"],
+    "PLAN DE CELULAR": ["CELULAR", "RECARGA"],
+    "INTERNET": ["WIFI"],
+    "LUZ": ["ELECTRICIDAD"],
+    "PASAJES": ["TAXI", "BUS", "MICRO", "COMBI", "COLECTIVO", "MOVILIDAD", "UBER", "METRO"],
+    "GASOLINA/COMBUSTIBLE": ["GRIFO"],
+    "ALIMENTOS/COMIDA(DESAYUNO,ALMUERZO,CENA)": ["MERCADO", "SUPERMERCADO", "LONCHE", "MENU"],
+    "CALZADO/ZAPATILLA/ZAPATO": ["ZAPATILLAS", "ZAPATOS"],
+    "CITA MEDICA": ["DOCTOR", "CONSULTA MEDICA"],
+    "MEDICINA/PASTILLAS": ["FARMACIA", "MEDICAMENTOS", "REMEDIOS"],
+    "DENTISTA": ["ODONTOLOGO"],
+    "SALIDAS": ["CINE"],
+    "GUSTITOS": ["ANTOJO", "ANTOJOS", "HELADO", "POSTRE"],
+}
+
+# Conceptos que por su naturaleza se repiten cada mes
+CONCEPTOS_FIJOS = {
+    "SUELDO", "CTS", "GRATIFICACIÓN", "AFP", "CUOTA DEPARTAMENTO", "TARJETA DE CREDITO",
+    "PLAN DE CELULAR", "INTERNET", "LUZ", "MANTENIMIENTO DE DEPARTAMENTO", "DIEZMO", "AHORROS",
+}
+
+PALABRAS_GASTO = ["GASTO", "GASTOS", "GASTE", "GASTAMOS", "PAGUE", "PAGAMOS", "COMPRE", "COMPRAMOS", "EGRESO"]
+PALABRAS_INGRESO = ["INGRESO", "INGRESOS", "COBRE", "COBRAMOS", "RECIBI", "RECIBIMOS", "GANE", "VENDI", "ME PAGARON"]
+
+# Palabras que no aportan información al registro
+PALABRAS_RELLENO = {
+    "EN", "DE", "DEL", "POR", "PARA", "EL", "LA", "LOS", "LAS", "MI", "MIS", "UN", "UNA", "AL",
+    "SOLES", "SOL", "HOY", "AYER", "ANTEAYER", "ANTIER", "PASADO", "FIJO", "VARIABLE", "Y", "ME", "SE",
+}
+MAX_PALABRAS_DESCONOCIDAS = 1
+
+DIAS_SEMANA = {"LUNES": 0, "MARTES": 1, "MIERCOLES": 2, "JUEVES": 3, "VIERNES": 4, "SABADO": 5, "DOMINGO": 6}
+
+PATRON_FECHA = re.compile(r"(?<![\d.,])(\d{1,2})[/-](\d{1,2})(?:[/-](\d{2,4}))?(?![\d.,])")
+PATRON_MONEDA = re.compile(r"S/\.?")
+PATRON_MONTO = re.compile(r"(?<![\w.,])(\d+(?:[.,]\d{1,2})?)(?![\w.,])")
+PATRON_DIA_SEMANA = re.compile(r"(?<![A-Z])(?:EL\s+)?(" + "|".join(DIAS_SEMANA) + r")(?:\s+PASADO)?(?![A-Z])")
+PATRON_TIPO = re.compile(
+    r"(?<![A-Z])(?:(?P<gasto>" + "|".join(PALABRAS_GASTO) + r")|(?P<ingreso>" + "|".join(PALABRAS_INGRESO) + r"))(?![A-Z])"
+)
+
+def normalizar_texto(texto):
+    """Mayúsculas, sin tildes y con espacios simples, para comparar sin importar cómo se escribió."""
+    texto = unicodedata.normalize("NFKD", texto)
+    texto = "".join(c for c in texto if not unicodedata.combining(c))
+    return " ".join(texto.upper().split())
+
+def _variantes_alias(nombre):
+    """Nombre completo más cada parte separada por '/', '(' o ',' y su singular/plural."""
+    nombre = normalizar_texto(nombre)
+    variantes = {nombre}
+    for parte in re.split(r"[/(),]", nombre):
+        parte = parte.strip()
+        if parte:
+            variantes.add(parte)
+    for variante in list(variantes):
+        if " " in variante or "/" in variante or "(" in variante:
+            continue
+        if variante.endswith("S"):
+            variantes.add(variante[:-1])
+        else:
+            variantes.add(variante + "S")
+    return variantes
+
+def _huella_conceptos():
+    """Identifica la versión actual de las listas de conceptos; cambia si se editan."""
+    return hash((tuple(CONCEPTOS_INGRESOS), tuple(CONCEPTOS_GASTOS),
+                 tuple((k, tuple(v)) for k, v in sorted(SINONIMOS_CONCEPTOS.items()))))
+
+_matcher_conceptos = None  # (huella, patrón compilado, {alias: {tipo: concepto}})
+
+def _obtener_matcher_conceptos():
+    """Compila una sola expresión regular con todos los alias; se recompila si cambian las listas."""
+    global _matcher_conceptos
+    huella = _huella_conceptos()
+    if _matcher_conceptos is not None and _matcher_conceptos[0] == huella:
+        return _matcher_conceptos
+
+    alias_a_concepto = {}
+    for tipo, conceptos in (("INGRESO", CONCEPTOS_INGRESOS), ("GASTO", CONCEPTOS_GASTOS)):
+        for concepto in conceptos:
+            alias = _variantes_alias(concepto)
+            for sinonimo in SINONIMOS_CONCEPTOS.get(concepto, []):
+                alias |= _variantes_alias(sinonimo)
+            for a in alias:
+                alias_a_concepto.setdefault(a, {})[tipo] = concepto
+    # "OTROS" como gasto se registra como "OTROS GASTOS"
+    if "OTROS GASTOS" in CONCEPTOS_GASTOS and "OTROS" in alias_a_concepto:
+        alias_a_concepto["OTROS"].setdefault("GASTO", "OTROS GASTOS")
+
+    # Los alias largos primero para que "TARJETA DE CREDITO" gane a "TARJETA"
+    ordenados = sorted(alias_a_concepto, key=len, reverse=True)
+    patron = re.compile(r"(?<![A-Z0-9])(" + "|".join(re.escape(a) for a in ordenados) + r")(?![A-Z0-9])")
+    _matcher_conceptos = (huella, patron, alias_a_concepto)
+    return _matcher_conceptos
+
+def resolver_fecha_relativa(texto_normalizado, hoy=None):
+    """
+    Devuelve la fecha mencionada en el mensaje en formato DD/MM/YYYY, o "actual" si no hay ninguna.
+    Entiende "hoy", "ayer", "anteayer", días de la semana ("el lunes") y fechas DD/MM[/YYYY].
+    """
+    hoy = hoy or datetime.now()
+
+    coincidencia = PATRON_FECHA.search(texto_normalizado)
+    if coincidencia:
+        dia, mes, anio = coincidencia.groups()
+        anio = int(anio) if anio else hoy.year
+        if anio < 100:
+            anio += 2000
+        try:
+            return datetime(anio, int(mes), int(dia)).strftime("%d/%m/%Y")
+        except ValueError:
+            return "actual"
+
+    palabras = set(texto_normalizado.split())
+    if palabras & {"ANTEAYER", "ANTIER"}:
+        return (hoy - timedelta(days=2)).strftime("%d/%m/%Y")
+    if "AYER" in palabras:
+        return (hoy - timedelta(days=1)).strftime("%d/%m/%Y")
+
+    coincidencia = PATRON_DIA_SEMANA.search(texto_normalizado)
+    if coincidencia:
+        # El último día con ese nombre; si es hoy, se entiende el de la semana pasada
+        dias_atras = (hoy.weekday() - DIAS_SEMANA[coincidencia.group(1)]) % 7 or 7
+        return (hoy - timedelta(days=dias_atras)).strftime("%d/%m/%Y")
+
+    return "actual"
+
+def parsear_mensaje_local(mensaje, hoy=None):
+    """
+    Intenta extraer tipo, monto, concepto, categoría y fecha sin usar Gemini.
+    Devuelve un dict con el mismo formato que la respuesta del modelo, o None si el mensaje es ambiguo.
+    """
+    texto = normalizar_texto(mensaje)
+    _, patron_conceptos, alias_a_concepto = _obtener_matcher_conceptos()
+
+    fecha = resolver_fecha_relativa(texto, hoy)
+    resto = PATRON_FECHA.sub(" ", texto)
+    resto = PATRON_DIA_SEMANA.sub(" ", resto)
+
+    # Concepto: todos los alias encontrados deben apuntar al mismo concepto
+    candidatos = [alias_a_concepto[m.group(1)] for m in patron_conceptos.finditer(resto)]
+    if not candidatos:
+        return None
+    resto = patron_conceptos.sub(" ", resto)
+
+    # Tipo: por palabra clave o, si no la hay, por la lista a la que pertenece el concepto
+    tipos = {"GASTO" if m.group("gasto") else "INGRESO" for m in PATRON_TIPO.finditer(resto)}
+    if len(tipos) > 1:
+        return None
+    resto = PATRON_TIPO.sub(" ", resto)
+
+    if tipos:
+        tipo = tipos.pop()
+        conceptos = {c.get(tipo) for c in candidatos}
+    else:
+        tipos_posibles = set.intersection(*(set(c) for c in candidatos))
+        if len(tipos_posibles) != 1:
+            return None
+        tipo = tipos_posibles.pop()
+        conceptos = {c[tipo] for c in candidatos}
+    if len(conceptos) != 1 or None in conceptos:
+        return None
+    concepto = conceptos.pop()
+
+    # Monto: exactamente un número en lo que queda del mensaje
+    resto = PATRON_MONEDA.sub(" ", resto)
+    montos = PATRON_MONTO.findall(resto)
+    if len(montos) != 1:
+        return None
+    monto = float(montos[0].replace(",", "."))
+    resto = PATRON_MONTO.sub(" ", resto)
+
+    desconocidas = [p for p in re.findall(r"[A-Z]+", resto) if p not in PALABRAS_RELLENO]
+    if len(desconocidas) > MAX_PALABRAS_DESCONOCIDAS:
+        return None
+
+    palabras = set(texto.split())
+    if "FIJO" in palabras:
+        categoria = "FIJO"
+    elif "VARIABLE" in palabras:
+        categoria = "VARIABLE"
+    else:
+        categoria = "FIJO" if concepto in CONCEPTOS_FIJOS else "VARIABLE"
+
+    return {"tipo": tipo, "monto": monto, "concepto": concepto, "categoria": categoria, "fecha": fecha}
+
+# Cache de extracciones de Gemini
+# Los usuarios repiten casi los mismos mensajes ("PASAJES 5", "ALMUERZO 12", "SUELDO 1500").
+# Se guarda lo que Gemini extrajo (tipo, concepto, categoría) bajo una versión normalizada del
+# mensaje en la que el monto y la fecha se sustituyen por marcadores; en un acierto el monto y
+# la fecha se vuelven a sacar del mensaje nuevo.
+class CacheExtracciones:
+    """Cache LRU con TTL de extracciones, invalidada cuando cambian las listas de conceptos."""
+
+    def __init__(self, max_entradas, ttl_segundos):
+        self._cache = TTLCache(maxsize=max_entradas, ttl=ttl_segundos)
+        self._huella = _huella_conceptos()
+        self.aciertos = 0
+        self.fallos = 0
+
+    def _clave(self, mensaje):
+        """Devuelve (clave, monto) o (None, None) si el mensaje no tiene exactamente un monto."""
+        texto = normalizar_texto(mensaje)
+        texto = PATRON_FECHA.sub(" ", texto)
+        texto = PATRON_DIA_SEMANA.sub(" ", texto)
+        texto = PATRON_MONEDA.sub(" ", texto)
+        montos = PATRON_MONTO.findall(texto)
+        if len(montos) != 1:
+            return None, None
+        texto = PATRON_MONTO.sub(" # ", texto)
+        palabras = [p for p in re.findall(r"[A-Z]+|#", texto) if p not in ("HOY", "AYER", "ANTEAYER", "ANTIER")]
+        return " ".join(palabras), float(montos[0].replace(",", "."))
+
+    def _comprobar_huella(self):
+        huella = _huella_conceptos()
+        if huella != self._huella:
+            self.invalidar()
+            self._huella = huella
+
+    def obtener(self, mensaje, hoy=None):
+        """Devuelve los datos extraídos para un mensaje equivalente ya visto, o None."""
+        self._comprobar_huella()
+        clave, monto = self._clave(mensaje)
+        datos = self._cache.get(clave) if clave else None
+        if datos is None:
+            self.fallos += 1
+            return None
+        self.aciertos += 1
+        return dict(datos, monto=monto, fecha=resolver_fecha_relativa(normalizar_texto(mensaje), hoy))
+
+    def guardar(self, mensaje, extraido, hoy=None):
+        """Guarda una extracción válida de Gemini si se puede reutilizar para mensajes parecidos."""
+        self._comprobar_huella()
+        if "error" in extraido or extraido.get("tipo") not in TIPOS:
+            return
+        clave, monto = self._clave(mensaje)
+        if clave is None:
+            return
+        try:
+            if float(extraido.get("monto", 0)) != monto:
+                return  # Gemini no tomó el mismo número como monto; no es seguro reutilizarlo
+        except (TypeError, ValueError):
+            return
+        # Si el modelo entendió una fecha que el parser local no sabe resolver, no se cachea
+        fecha_local = resolver_fecha_relativa(normalizar_texto(mensaje), hoy)
+        if extraido.get("fecha", "actual") not in ("actual", fecha_local):
+            return
+        self._cache[clave] = {
+            "tipo": extraido["tipo"],
+            "concepto": extraido.get("concepto", "OTROS"),
+            "categoria": extraido.get("categoria", "VARIABLE"),
+        }
+
+    def invalidar(self):
+        self._cache.clear()
+        logger.info("Cache de extracciones invalidada.")
+
+    def estadisticas(self):
+        total = self.aciertos + self.fallos
+        return {
+            "entradas": len(self._cache),
+            "aciertos": self.aciertos,
+            "fallos": self.fallos,
+            "tasa_aciertos": self.aciertos / total if total else 0.0,
+        }
+
+cache_extracciones = CacheExtracciones(
+    max_entradas=int(os.getenv("CACHE_EXTRACCIONES_MAX", "1000")),
+    ttl_segundos=int(os.getenv("CACHE_EXTRACCIONES_TTL", str(7 * 24 * 3600))),
+)
+
+# Conexión con Google Sheets
+# El cliente y los handles de las hojas se crean una sola vez por proceso y se reutilizan
+# en cada registro. gspread usa una AuthorizedSession de google-auth, que renueva el token
+# de acceso automáticamente cuando expira, así que no hace falta volver a autorizar.
+#
+# Cada familia puede tener su propio libro (spreadsheet) en families_db, y dentro de cada
+# libro los movimientos se reparten en una hoja por mes ("Registro October 2025") que se crea
+# la primera vez que se escribe en ella. Un destino es el par (libro, hoja); los handles se
+# cachean por destino. Las filas antiguas de la hoja "Registro" única se siguen leyendo.
+NOMBRE_SPREADSHEET = "ECONOMIA DE LA CASA"
+NOMBRE_HOJA_REGISTRO = "Registro"
+LIBRO_POR_DEFECTO = os.getenv("GOOGLE_SPREADSHEET_KEY") or NOMBRE_SPREADSHEET
+DESTINO_LEGADO = (LIBRO_POR_DEFECTO, NOMBRE_HOJA_REGISTRO)
+PATRON_CLAVE_SPREADSHEET = re.compile(r"[A-Za-z0-9_-]{30,}")
+
+_sheets_client = None
+_libros_cache = {}  # libro (clave o nombre) -> gspread.Spreadsheet
+_hojas_cache = {}  # (libro, nombre de la hoja) -> gspread.Worksheet
+_sheets_lock = threading.Lock()
+
+def hoja_del_mes(mes):
+    """Nombre de la hoja de un mes, a partir de la columna Mes de la fila ("October 2025")."""
+    return f"{NOMBRE_HOJA_REGISTRO} {mes}" if mes else NOMBRE_HOJA_REGISTRO
+
+def es_hoja_registro(titulo):
+    return titulo == NOMBRE_HOJA_REGISTRO or titulo.startswith(NOMBRE_HOJA_REGISTRO + " ")
+
+def libro_de_usuario(user_id):
+    """
+    Libro de la familia del usuario. families_db[familia_id]["spreadsheet"] guarda la clave o el
+    nombre del spreadsheet de la familia; sin familia (o sin libro propio) se usa el libro por defecto.
+    """
+    perfil = users_db.get(user_id) or {}
+    familia = families_db.get(perfil.get("familia_id")) if perfil.get("familia_id") is not None else None
+    return (familia or {}).get("spreadsheet") or LIBRO_POR_DEFECTO
+
+PATRON_URL_SPREADSHEET = re.compile(r"/spreadsheets/d/([A-Za-z0-9_-]+)")
+
+def libro_desde_texto(texto):
+    """Clave del spreadsheet a partir de su URL; cualquier otro texto se toma como clave o nombre."""
+    coincidencia = PATRON_URL_SPREADSHEET.search(texto)
+    return coincidencia.group(1) if coincidencia else texto.strip()
+
+def crear_familia(user_id, nombre, libro):
+    """Crea una familia con su libro, deja al usuario en ella y devuelve el código para invitar."""
+    codigo = uuid.uuid4().hex[:8].upper()
+    families_db[codigo] = {
+        "nombre": nombre,
+        "spreadsheet": libro,
+        "creador": user_id,
+        "fecha_creacion": datetime.now().isoformat(),
+    }
+    users_db.actualizar(user_id, familia_id=codigo)
+    return codigo
+
+def unir_a_familia(user_id, codigo):
+    """Deja al usuario en la familia del código; devuelve la familia, o None si el código no existe."""
+    codigo = codigo.strip().upper()
+    familia = families_db.get(codigo)
+    if familia is not None:
+        users_db.actualizar(user_id, familia_id=codigo)
+    return familia
+
+def destino_de(user_id, fila):
+    """(libro, hoja) donde se escribe una fila del libro: la hoja del mes de la fila."""
+    return libro_de_usuario(user_id), hoja_del_mes(fila_a_registro(fila)["Mes"])
+
+def libros_conocidos():
+    """El libro por defecto y los de todas las familias que tienen uno propio."""
+    libros = {LIBRO_POR_DEFECTO}
+    libros.update(familia["spreadsheet"] for familia in families_db.values() if familia.get("spreadsheet"))
+    return sorted(libros)
+
+def _crear_cliente_sheets():
     scope = ["https://spreadsheets.google.com/feeds",
              "https://www.googleapis.com/auth/spreadsheets",
              "https://www.googleapis.com/auth/drive.file",
@@ -104,119 +886,1541 @@ def conectar_google_sheets():
         logger.error("¡La variable de entorno 'GOOGLE_CREDENTIALS_JSON' no está configurada o está vacía!")
         logger.error("Asegúrate de haber pegado el contenido completo del JSON de la clave de servicio en Render.")
         return None
-    
-    try:
-        # Cargar las credenciales desde la cadena JSON de la variable de entorno
-        creds_dict = json.loads(credentials_json_str)
-        creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-        logger.info("Credenciales cargadas correctamente desde la variable de entorno.")
-        
-        client = gspread.authorize(creds)
-        logger.info("Cliente autorizado correctamente")
-        
-        # Nombre de tu hoja de Google Sheets
-        nombre_spreadsheet = "ECONOMIA DE LA CASA"
-        logger.info(f"Intentando abrir la hoja: {nombre_spreadsheet}")
-        
-        # Listar todas las hojas a las que tenemos acceso
-        disponibles = [sheet.title for sheet in client.openall()]
-        logger.info(f"Hojas disponibles: {disponibles}")
-        
-        spreadsheet = client.open(nombre_spreadsheet)
-        logger.info(f"Hoja de cálculo abierta correctamente. Hojas: {[ws.title for ws in spreadsheet.worksheets()]}")
-        
-        sheet = spreadsheet.worksheet("Registro")
-        logger.info("Hoja 'Registro' abierta correctamente")
-        
+
+    # Cargar las credenciales desde la cadena JSON de la variable de entorno
+    import gspread
+    from oauth2client.service_account import ServiceAccountCredentials
+
+    creds_dict = json.loads(credentials_json_str)
+    creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
+    logger.info("Credenciales cargadas correctamente desde la variable de entorno.")
+
+    client = gspread.authorize(creds)
+    logger.info("Cliente autorizado correctamente")
+    return client
+
+def _abrir_spreadsheet(client, libro):
+    # Con la clave del spreadsheet se evita la búsqueda por nombre en Drive
+    if PATRON_CLAVE_SPREADSHEET.fullmatch(libro):
+        return client.open_by_key(libro)
+    logger.info(f"Intentando abrir la hoja: {libro}")
+    return client.open(libro)
+
+def _obtener_spreadsheet(libro):
+    """Spreadsheet cacheado del libro; hay que llamarla con _sheets_lock tomado."""
+    global _sheets_client
+
+    spreadsheet = _libros_cache.get(libro)
+    if spreadsheet is None:
+        if _sheets_client is None:
+            _sheets_client = _crear_cliente_sheets()
+            if _sheets_client is None:
+                return None
+        spreadsheet = _abrir_spreadsheet(_sheets_client, libro)
+        _libros_cache[libro] = spreadsheet
+        logger.info(f"Hoja de cálculo abierta correctamente: {spreadsheet.title}")
+    return spreadsheet
+
+def _crear_hoja(spreadsheet, nombre_hoja):
+    hoja = spreadsheet.add_worksheet(title=nombre_hoja, rows=1, cols=len(COLUMNAS_REGISTRO))
+    hoja.update("A1", [COLUMNAS_REGISTRO])
+    logger.info(f"Hoja '{nombre_hoja}' creada en '{spreadsheet.title}'")
+    return hoja
+
+def _asegurar_columnas(hoja):
+    """
+    Las hojas creadas antes de la columna Clave no tienen su encabezado: se mira la celda y, si está
+    vacía, se escribe. El número de columnas no sirve (una hoja de Sheets nace con 26).
+    """
+    faltan = len(COLUMNAS_REGISTRO) - getattr(hoja, "col_count", len(COLUMNAS_REGISTRO))
+    if faltan > 0:
+        # Leer fuera de la cuadrícula da error: primero se amplía
+        hoja.add_cols(faltan)
+    if hoja.get_values(f"{ULTIMA_COLUMNA}1:{ULTIMA_COLUMNA}1"):
+        return
+    hoja.update(f"{ULTIMA_COLUMNA}1", [[COLUMNAS_REGISTRO[-1]]])
+    logger.info(f"Columna {COLUMNAS_REGISTRO[-1]} añadida a la hoja '{hoja.title}'")
+
+# Función para conectar con Google Sheets
+def conectar_google_sheets(nombre_hoja=NOMBRE_HOJA_REGISTRO, libro=None, crear=False):
+    """
+    Devuelve el handle cacheado de la hoja; solo se conecta la primera vez o tras invalidar.
+    Con crear=True, si la hoja no existe se crea con los encabezados del libro.
+    """
+    clave = (libro or LIBRO_POR_DEFECTO, nombre_hoja)
+    sheet = _hojas_cache.get(clave)
+    if sheet is not None:
         return sheet
-    except Exception as e:
-        logger.error(f"Error al conectar con Google Sheets: {str(e)}")
-        logger.error(f"Tipo de error: {type(e).__name__}")
-        import traceback
-        logger.error(f"Detalles: {traceback.format_exc()}")
-        return None
 
-# Comandos
-async def start_command(update: Update, context: CallbackContext) -> int:
-    user = update.effective_user
-    telegram_id = user.id
-    
-    # Verificar si el usuario ya existe
-    if telegram_id in users_db:
-        # Usuario existente - menú normal
-        keyboard = [
-            [InlineKeyboardButton("Registrar movimiento", callback_data='registrar')],
-            [InlineKeyboardButton("Ver último registro", callback_data='ver_ultimo')],
-            [InlineKeyboardButton("Ver mi perfil", callback_data='ver_perfil')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await update.message.reply_text(
-            f'¡Hola de nuevo {user.first_name}! ¿Qué deseas hacer hoy?',
-            reply_markup=reply_markup
-        )
-        return ELEGIR_ACCION
-    else:
-        # Usuario nuevo - iniciar onboarding
-        await update.message.reply_text(
-            f'¡Hola {user.first_name}! 👋\n\n'
-            f'Soy tu asistente de economía familiar inteligente. '
-            f'Para comenzar, necesito conocerte mejor.\n\n'
-            f'¿Podrías contarme brevemente sobre tu situación familiar y financiera? '
-            f'Por ejemplo: si vives solo/a, en pareja, con hijos, tus ingresos aproximados, etc.'
-        )
-        return ONBOARDING_START
+    with _sheets_lock:
+        sheet = _hojas_cache.get(clave)
+        if sheet is not None:
+            return sheet
 
-async def elegir_accion(update: Update, context: CallbackContext) -> int:
-    query = update.callback_query
-    await query.answer()
-    
-    if query.data == 'registrar':
-        # Inicializar datos del usuario
-        usuario_data[query.from_user.id] = {
-            'usuario': query.from_user.first_name
-        }
-        
-        keyboard = [[InlineKeyboardButton(tipo, callback_data=tipo)] for tipo in TIPOS]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(
-            text="¿Qué tipo de movimiento quieres registrar?",
-            reply_markup=reply_markup
-        )
-        return ELEGIR_TIPO
-    
-    elif query.data == 'ver_ultimo':
-        # Implementar la visualización del último registro
         try:
-            sheet = conectar_google_sheets()
-            if sheet:
-                # Obtener la última fila
-                records = sheet.get_all_records()
-                if records:
-                    last_record = records[-1]
-                    await query.edit_message_text(
-                        f"📝 *Último registro*\n\n"
-                        f"📅 Fecha: {last_record.get('Fecha', 'N/A')}\n"
-                        f"👤 Usuario: {last_record.get('Usuario', 'N/A')}\n"
-                        f"📊 Tipo: {last_record.get('Tipo', 'N/A')}\n"
-                        f"🏷️ Categoría: {last_record.get('Categoría', 'N/A')}\n"
-                        f"🔖 Concepto: {last_record.get('Concepto', 'N/A')}\n"
-                        f"💰 Monto: S/. {last_record.get('Monto', 'N/A')}\n",
-                        parse_mode='Markdown'
-                    )
-                else:
-                    await query.edit_message_text("No hay registros disponibles.")
-            else:
-                await query.edit_message_text("No se pudo conectar con la hoja de cálculo.")
+            spreadsheet = _obtener_spreadsheet(clave[0])
+            if spreadsheet is None:
+                return None
+
+            import gspread
+
+            try:
+                sheet = spreadsheet.worksheet(nombre_hoja)
+                _asegurar_columnas(sheet)
+            except gspread.exceptions.WorksheetNotFound:
+                if not crear:
+                    logger.warning(f"La hoja '{nombre_hoja}' no existe en '{spreadsheet.title}'")
+                    return None
+                sheet = _crear_hoja(spreadsheet, nombre_hoja)
+            _hojas_cache[clave] = sheet
+            logger.info(f"Hoja '{nombre_hoja}' abierta correctamente")
+
+            return sheet
         except Exception as e:
-            await query.edit_message_text(f"Error al obtener el último registro: {e}")
-        
-        return ConversationHandler.END
-    
-    elif query.data == 'ver_perfil':
-        user_id = query.from_user.id
-    if user_id in users_db:
+            logger.error(f"Error al conectar con Google Sheets: {str(e)}")
+            logger.error(f"Tipo de error: {type(e).__name__}")
+            import traceback
+            logger.error(f"Detalles: {traceback.format_exc()}")
+            return None
+
+def invalidar_conexion_sheets():
+    """Descarta el cliente y los handles cacheados para forzar una reconexión."""
+    global _sheets_client
+    with _sheets_lock:
+        _sheets_client = None
+        _libros_cache.clear()
+        _hojas_cache.clear()
+    logger.warning("Conexión con Google Sheets invalidada, se reconectará en el próximo uso.")
+
+def _es_handle_obsoleto(error):
+    """True si el error indica que el cliente o la hoja cacheados ya no sirven."""
+    # Si gspread no se llegó a importar, el error no puede venir de él
+    gspread = sys.modules.get("gspread")
+    if gspread is not None:
+        if isinstance(error, gspread.exceptions.APIError):
+            return error.response.status_code in (401, 403, 404)
+        if isinstance(error, (gspread.exceptions.WorksheetNotFound, gspread.exceptions.SpreadsheetNotFound)):
+            return True
+    return isinstance(error, requests.exceptions.ConnectionError)
+
+def operar_hoja(operacion, nombre_hoja=NOMBRE_HOJA_REGISTRO, libro=None, crear=False):
+    """
+    Ejecuta operacion(sheet) sobre la hoja cacheada.
+    Si el handle quedó obsoleto (hoja renombrada, sesión caída, etc.) reconecta y reintenta una vez.
+    """
+    sheet = conectar_google_sheets(nombre_hoja, libro, crear)
+    if sheet is None:
+        raise ConnectionError(f"No se pudo abrir la hoja '{nombre_hoja}'.")
+    try:
+        return operacion(sheet)
+    except Exception as e:
+        if not _es_handle_obsoleto(e):
+            raise
+        logger.warning(f"Handle de la hoja '{nombre_hoja}' obsoleto ({type(e).__name__}), reconectando...")
+        invalidar_conexion_sheets()
+        sheet = conectar_google_sheets(nombre_hoja, libro, crear)
+        if sheet is None:
+            raise ConnectionError(f"No se pudo abrir la hoja '{nombre_hoja}'.")
+        return operacion(sheet)
+
+def listar_hojas_registro(libro):
+    """Nombres de las hojas del libro que contienen movimientos ("Registro" y las mensuales)."""
+    with _sheets_lock:
+        spreadsheet = _obtener_spreadsheet(libro)
+        if spreadsheet is None:
+            raise ConnectionError(f"No se pudo abrir el libro '{libro}'.")
+    return [hoja.title for hoja in spreadsheet.worksheets() if es_hoja_registro(hoja.title)]
+
+# Métricas
+# Histogramas de latencia, contadores y medidores en el formato de texto de Prometheus, sin
+# dependencias extra. Se registran latencias de handlers, de Sheets y Gemini (por intento) y de
+# las llamadas a la API de Telegram; colas, caches e interruptores se leen en cada scrape.
+# Se publican en /metrics del mismo servidor que recibe el webhook, junto con /healthz.
+BUCKETS_LATENCIA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _formatear_etiquetas(etiquetas):
+    if not etiquetas:
+        return ""
+    partes = []
+    for clave, valor in etiquetas:
+        valor = str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        partes.append(f'{clave}="{valor}"')
+    return "{" + ",".join(partes) + "}"
+
+class Metricas:
+    """Registro de métricas en memoria, expuesto en formato Prometheus."""
+
+    def __init__(self, buckets=BUCKETS_LATENCIA):
+        self.buckets = buckets
+        self._tipos = {}  # nombre -> (tipo, ayuda)
+        self._histogramas = {}  # (nombre, etiquetas) -> [conteos por bucket, suma, total]
+        self._contadores = {}  # (nombre, etiquetas) -> valor
+        self._en_curso = {}  # (nombre, etiquetas) -> valor
+        self._medidores = {}  # nombre -> función que devuelve [(etiquetas, valor)]
+        self._lock = threading.Lock()
+
+    def describir(self, nombre, tipo, ayuda):
+        self._tipos[nombre] = (tipo, ayuda)
+
+    def observar(self, nombre, valor, **etiquetas):
+        clave = (nombre, tuple(sorted(etiquetas.items())))
+        with self._lock:
+            histograma = self._histogramas.get(clave)
+            if histograma is None:
+                histograma = self._histogramas[clave] = [[0] * len(self.buckets), 0.0, 0]
+            for i, limite in enumerate(self.buckets):
+                if valor <= limite:
+                    histograma[0][i] += 1
+            histograma[1] += valor
+            histograma[2] += 1
+
+    def incrementar(self, nombre, cantidad=1, **etiquetas):
+        clave = (nombre, tuple(sorted(etiquetas.items())))
+        with self._lock:
+            self._contadores[clave] = self._contadores.get(clave, 0) + cantidad
+
+    @contextlib.contextmanager
+    def medir(self, nombre, **etiquetas):
+        """Mide la duración del bloque y cuenta cuántos hay en curso (`{nombre}_en_curso`)."""
+        clave = (f"{nombre}_en_curso", tuple(sorted(etiquetas.items())))
+        with self._lock:
+            self._en_curso[clave] = self._en_curso.get(clave, 0) + 1
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observar(f"{nombre}_segundos", time.perf_counter() - inicio, **etiquetas)
+            with self._lock:
+                self._en_curso[clave] -= 1
+
+    def medidor(self, nombre, ayuda, funcion):
+        """Medidor calculado en cada scrape: `funcion()` devuelve un número o [(etiquetas, valor)]."""
+        self.describir(nombre, "gauge", ayuda)
+        self._medidores[nombre] = funcion
+
+    def _cabecera(self, lineas, nombre, tipo_por_defecto):
+        tipo, ayuda = self._tipos.get(nombre, (tipo_por_defecto, ""))
+        if ayuda:
+            lineas.append(f"# HELP {nombre} {ayuda}")
+        lineas.append(f"# TYPE {nombre} {tipo}")
+
+    def exponer(self):
+        """Texto en formato de exposición de Prometheus (version 0.0.4)."""
+        lineas = []
+        with self._lock:
+            histogramas = {clave: [list(h[0]), h[1], h[2]] for clave, h in self._histogramas.items()}
+            contadores = dict(self._contadores)
+            contadores.update(self._en_curso)
+
+        vistos = set()
+        for (nombre, etiquetas), (conteos, suma, total) in sorted(histogramas.items()):
+            if nombre not in vistos:
+                vistos.add(nombre)
+                self._cabecera(lineas, nombre, "histogram")
+            for limite, conteo in zip(self.buckets, conteos):
+                lineas.append(f"{nombre}_bucket{_formatear_etiquetas(etiquetas + (('le', limite),))} {conteo}")
+            lineas.append(f"{nombre}_bucket{_formatear_etiquetas(etiquetas + (('le', '+Inf'),))} {total}")
+            lineas.append(f"{nombre}_sum{_formatear_etiquetas(etiquetas)} {suma}")
+            lineas.append(f"{nombre}_count{_formatear_etiquetas(etiquetas)} {total}")
+
+        for (nombre, etiquetas), valor in sorted(contadores.items()):
+            if nombre not in vistos:
+                vistos.add(nombre)
+                self._cabecera(lineas, nombre, "gauge" if nombre.endswith("_en_curso") else "counter")
+            lineas.append(f"{nombre}{_formatear_etiquetas(etiquetas)} {valor}")
+
+        for nombre, funcion in self._medidores.items():
+            try:
+                valores = funcion()
+            except Exception as e:
+                logger.warning(f"No se pudo calcular la métrica {nombre}: {e}")
+                continue
+            self._cabecera(lineas, nombre, "gauge")
+            if isinstance(valores, (int, float)):
+                valores = [({}, valores)]
+            for etiquetas, valor in valores:
+                lineas.append(f"{nombre}{_formatear_etiquetas(tuple(sorted(etiquetas.items())))} {float(valor)}")
+        return "\n".join(lineas) + "\n"
+
+metricas = Metricas()
+metricas.describir("contabot_handler_segundos", "histogram", "Duración de cada handler de Telegram")
+metricas.describir("contabot_handler_errores_total", "counter", "Excepciones lanzadas por los handlers")
+metricas.describir("contabot_backend_segundos", "histogram", "Duración de cada intento de llamada a Sheets o Gemini")
+metricas.describir("contabot_backend_espera_segundos", "histogram", "Tiempo esperando cuota y un hueco en el pool")
+metricas.describir("contabot_backend_errores_total", "counter", "Errores de Sheets o Gemini por tipo")
+metricas.describir("contabot_telegram_segundos", "histogram", "Duración de las llamadas a la API de Telegram")
+metricas.describir("contabot_telegram_errores_total", "counter", "Llamadas a la API de Telegram fallidas")
+metricas.describir("contabot_duplicados_descartados_total", "counter",
+                   "Updates, confirmaciones y filas repetidos que no se procesaron")
+
+def medir_handler(callback):
+    """Envuelve un callback de handler para registrar su latencia, errores y cuántos hay en curso."""
+    nombre = callback.__name__
+
+    @functools.wraps(callback)
+    async def envoltura(update, context):
+        try:
+            with metricas.medir("contabot_handler", handler=nombre):
+                return await callback(update, context)
+        except Exception as e:
+            metricas.incrementar("contabot_handler_errores_total", handler=nombre, error=type(e).__name__)
+            raise
+
+    return envoltura
+
+def instrumentar_handlers(handlers):
+    """Aplica medir_handler a cada handler registrado, incluidos los de un ConversationHandler."""
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            instrumentar_handlers(handler.entry_points)
+            for handlers_estado in handler.states.values():
+                instrumentar_handlers(handlers_estado)
+            instrumentar_handlers(handler.fallbacks)
+        elif not hasattr(handler.callback, "__wrapped__"):
+            handler.callback = medir_handler(handler.callback)
+
+class PeticionTelegramMedida(HTTPXRequest):
+    """HTTPXRequest que registra la latencia y los errores de cada método de la API de Telegram."""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        metodo = url.rsplit("/", 1)[-1]
+        inicio = time.perf_counter()
+        try:
+            codigo, contenido = await super().do_request(url, method, *args, **kwargs)
+        except Exception as e:
+            metricas.incrementar("contabot_telegram_errores_total", metodo=metodo, error=type(e).__name__)
+            raise
+        finally:
+            metricas.observar("contabot_telegram_segundos", time.perf_counter() - inicio, metodo=metodo)
+        if codigo >= 400:
+            metricas.incrementar("contabot_telegram_errores_total", metodo=metodo, error=str(codigo))
+        return codigo, contenido
+
+# Límites de cuota, reintentos e interruptores
+# Cada backend tiene un token bucket configurado con su cuota publicada (peticiones por minuto),
+# los errores transitorios (429, 5xx, caídas de red) se reintentan con backoff exponencial con
+# jitter, y un interruptor (circuit breaker) deja de llamar al backend durante un tiempo cuando
+# acumula fallos seguidos, para fallar rápido y derivar al camino degradado.
+class LimitadorTokens:
+    """Token bucket: `por_minuto` peticiones sostenidas con ráfagas de hasta `rafaga`."""
+
+    def __init__(self, por_minuto, rafaga=None):
+        self.por_minuto = por_minuto
+        self.capacidad = rafaga or max(1, por_minuto // 6)
+        self._tokens = float(self.capacidad)
+        self._ultimo = time.monotonic()
+        self.esperas = 0
+
+    def _recargar(self):
+        ahora = time.monotonic()
+        self._tokens = min(self.capacidad, self._tokens + (ahora - self._ultimo) * self.por_minuto / 60)
+        self._ultimo = ahora
+
+    async def adquirir(self):
+        while True:
+            self._recargar()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            self.esperas += 1
+            await asyncio.sleep((1 - self._tokens) * 60 / self.por_minuto)
+
+    def estado(self):
+        self._recargar()
+        return {"por_minuto": self.por_minuto, "tokens": round(self._tokens, 2), "esperas": self.esperas}
+
+class CircuitoAbierto(Exception):
+    """El backend está marcado como no disponible; se falla sin llamarlo."""
+
+class Interruptor:
+    """Circuit breaker: cerrado -> abierto tras N fallos seguidos -> semiabierto tras un tiempo."""
+
+    def __init__(self, nombre, umbral_fallos, segundos_abierto):
+        self.nombre = nombre
+        self.umbral_fallos = umbral_fallos
+        self.segundos_abierto = segundos_abierto
+        self.estado_actual = "cerrado"
+        self.fallos_seguidos = 0
+        self.aperturas = 0
+        self._abierto_desde = 0.0
+        self._prueba_desde = None  # Momento en que salió la llamada de prueba (semiabierto)
+
+    def permitir(self):
+        ahora = time.monotonic()
+        if self.estado_actual == "abierto":
+            if ahora - self._abierto_desde < self.segundos_abierto:
+                return False
+            self.estado_actual = "semiabierto"
+            logger.info(f"Interruptor de {self.nombre}: semiabierto, probando el backend.")
+        if self.estado_actual == "semiabierto":
+            # Una sola llamada de prueba hasta que se resuelva; si se pierde (tarea cancelada), se
+            # deja salir otra pasado el tiempo de espera
+            if self._prueba_desde is not None and ahora - self._prueba_desde < self.segundos_abierto:
+                return False
+            self._prueba_desde = ahora
+        return True
+
+    def registrar_exito(self):
+        if self.estado_actual != "cerrado":
+            logger.info(f"Interruptor de {self.nombre}: cerrado, el backend respondió de nuevo.")
+        self.estado_actual = "cerrado"
+        self.fallos_seguidos = 0
+        self._prueba_desde = None
+
+    def registrar_fallo(self):
+        self.fallos_seguidos += 1
+        self._prueba_desde = None
+        if self.estado_actual == "semiabierto" or self.fallos_seguidos >= self.umbral_fallos:
+            if self.estado_actual != "abierto":
+                self.aperturas += 1
+                logger.warning(f"Interruptor de {self.nombre}: abierto tras {self.fallos_seguidos} fallos seguidos.")
+            self.estado_actual = "abierto"
+            self._abierto_desde = time.monotonic()
+
+    def estado(self):
+        return {"estado": self.estado_actual, "fallos_seguidos": self.fallos_seguidos, "aperturas": self.aperturas}
+
+CODIGOS_TRANSITORIOS = {429, 500, 502, 503, 504}
+
+def es_error_transitorio(error):
+    """True para errores que suelen resolverse solos: cuota agotada, 5xx y problemas de red."""
+    # Solo se miran las excepciones de las librerías ya cargadas, sin importarlas por esto
+    gspread = sys.modules.get("gspread")
+    if gspread is not None and isinstance(error, gspread.exceptions.APIError):
+        return error.response.status_code in CODIGOS_TRANSITORIOS
+    google_exceptions = sys.modules.get("google.api_core.exceptions")
+    if google_exceptions is not None and isinstance(error, (google_exceptions.TooManyRequests,
+                                                            google_exceptions.ResourceExhausted,
+                                                            google_exceptions.ServiceUnavailable,
+                                                            google_exceptions.InternalServerError,
+                                                            google_exceptions.DeadlineExceeded)):
+        return True
+    return isinstance(error, (requests.exceptions.ConnectionError,
+                              requests.exceptions.Timeout,
+                              ConnectionError,
+                              TimeoutError))
+
+# Ejecutores para llamadas bloqueantes
+# gspread y el SDK de Gemini son síncronos; si se llaman directamente desde un handler
+# bloquean el event loop y todos los demás usuarios esperan. Cada backend tiene su propio
+# pool de hilos y un tope de llamadas en vuelo configurable por variable de entorno.
+class EjecutorBackend:
+    """Pool de hilos acotado, con límite de cuota, reintentos e interruptor, para un backend externo."""
+
+    def __init__(self, nombre, max_concurrencia, por_minuto, reintentos=3, espera_base=0.5, espera_maxima=20.0,
+                 umbral_fallos=5, segundos_abierto=30.0):
+        self.nombre = nombre
+        self.max_concurrencia = max_concurrencia
+        self.reintentos = reintentos
+        self.espera_base = espera_base
+        self.espera_maxima = espera_maxima
+        self.limitador = LimitadorTokens(por_minuto)
+        self.interruptor = Interruptor(nombre, umbral_fallos, segundos_abierto)
+        self.en_vuelo = 0
+        self.en_espera = 0
+        self.llamadas = 0
+        self.reintentos_hechos = 0
+        self.errores = 0
+        self._pool = ThreadPoolExecutor(max_workers=max_concurrencia,
+                                        thread_name_prefix=f"ejecutor-{nombre}")
+        self._semaforo = None  # Se crea dentro del event loop en el primer uso
+
+    @property
+    def disponible(self):
+        return self.interruptor.estado_actual != "abierto"
+
+    async def _ejecutar_una_vez(self, funcion, *args, **kwargs):
+        if self._semaforo is None:
+            self._semaforo = asyncio.Semaphore(self.max_concurrencia)
+
+        self.en_espera += 1
+        inicio_espera = time.perf_counter()
+        try:
+            await self._semaforo.acquire()
+        finally:
+            self.en_espera -= 1
+            metricas.observar("contabot_backend_espera_segundos", time.perf_counter() - inicio_espera,
+                              backend=self.nombre)
+
+        self.en_vuelo += 1
+        try:
+            loop = asyncio.get_running_loop()
+            with metricas.medir("contabot_backend", backend=self.nombre):
+                return await loop.run_in_executor(self._pool, functools.partial(funcion, *args, **kwargs))
+        finally:
+            self.en_vuelo -= 1
+            self._semaforo.release()
+
+    async def ejecutar(self, funcion, *args, **kwargs):
+        """
+        Ejecuta funcion(*args, **kwargs) en el pool del backend sin bloquear el event loop.
+        Lanza CircuitoAbierto si el backend está marcado como caído.
+        """
+        for intento in range(self.reintentos + 1):
+            if not self.interruptor.permitir():
+                metricas.incrementar("contabot_backend_errores_total", backend=self.nombre, tipo="circuito_abierto")
+                raise CircuitoAbierto(f"{self.nombre} no está disponible temporalmente")
+            await self.limitador.adquirir()
+            self.llamadas += 1
+            try:
+                resultado = await self._ejecutar_una_vez(funcion, *args, **kwargs)
+            except Exception as e:
+                self.errores += 1
+                transitorio = es_error_transitorio(e)
+                metricas.incrementar("contabot_backend_errores_total", backend=self.nombre,
+                                     tipo="transitorio" if transitorio else "permanente")
+                if not transitorio:
+                    # El backend respondió (con un error propio de la petición): cuenta como vivo
+                    self.interruptor.registrar_exito()
+                    raise
+                self.interruptor.registrar_fallo()
+                if intento == self.reintentos:
+                    raise
+                espera = min(self.espera_maxima, self.espera_base * 2 ** intento)
+                espera = random.uniform(0, espera)  # full jitter
+                self.reintentos_hechos += 1
+                logger.warning(f"{self.nombre}: error transitorio ({e}), reintento {intento + 1} en {espera:.1f}s")
+                await asyncio.sleep(espera)
+            else:
+                self.interruptor.registrar_exito()
+                return resultado
+
+    def estado(self):
+        return {
+            "en_vuelo": self.en_vuelo,
+            "en_espera": self.en_espera,
+            "llamadas": self.llamadas,
+            "reintentos": self.reintentos_hechos,
+            "errores": self.errores,
+            "limitador": self.limitador.estado(),
+            "interruptor": self.interruptor.estado(),
+        }
+
+    def cerrar(self):
+        self._pool.shutdown(wait=False)
+
+# Cuotas publicadas por defecto: Sheets 60 peticiones/minuto por usuario, Gemini Flash 15 RPM (plan gratuito)
+ejecutor_sheets = EjecutorBackend(
+    "sheets",
+    int(os.getenv("SHEETS_MAX_CONCURRENCIA", "4")),
+    # La cuota es por proyecto: con varios trabajadores, cada uno usa su parte
+    por_minuto=max(1, int(os.getenv("SHEETS_PETICIONES_POR_MINUTO", "60")) // TRABAJADORES),
+)
+ejecutor_gemini = EjecutorBackend(
+    "gemini",
+    int(os.getenv("GEMINI_MAX_CONCURRENCIA", "8")),
+    por_minuto=max(1, int(os.getenv("GEMINI_PETICIONES_POR_MINUTO", "15")) // TRABAJADORES),
+)
+
+def estado_backends():
+    """Estado de limitadores, interruptores y colas, para monitoreo."""
+    return {
+        "sheets": ejecutor_sheets.estado(),
+        "gemini": ejecutor_gemini.estado(),
+        "cola_registros": {"pendientes": cola_registros.pendientes, "llamadas_api": cola_registros.llamadas_api},
+        "cola_recibos": {"en_cola": cola_recibos.en_cola, "rechazados": cola_recibos.rechazados},
+        "lotes_gemini": lote_extracciones.estadisticas(),
+    }
+
+def _medidor_por_backend(funcion):
+    return lambda: [({"backend": e.nombre}, funcion(e)) for e in (ejecutor_sheets, ejecutor_gemini)]
+
+metricas.medidor("contabot_backend_en_vuelo", "Llamadas en curso por backend",
+                 _medidor_por_backend(lambda e: e.en_vuelo))
+metricas.medidor("contabot_backend_en_espera", "Llamadas esperando un hueco en el pool",
+                 _medidor_por_backend(lambda e: e.en_espera))
+metricas.medidor("contabot_backend_reintentos", "Reintentos hechos desde el arranque",
+                 _medidor_por_backend(lambda e: e.reintentos_hechos))
+metricas.medidor("contabot_backend_esperas_cuota", "Veces que se esperó por el límite de cuota",
+                 _medidor_por_backend(lambda e: e.limitador.esperas))
+metricas.medidor("contabot_backend_circuito_abierto", "1 si el interruptor del backend está abierto",
+                 _medidor_por_backend(lambda e: 0 if e.disponible else 1))
+metricas.medidor("contabot_cola_registros_pendientes", "Filas en el journal que aún no llegaron a Sheets",
+                 lambda: cola_registros.pendientes)
+metricas.medidor("contabot_cola_recibos_en_cola", "Recibos esperando análisis", lambda: cola_recibos.en_cola)
+metricas.medidor("contabot_cola_recibos_rechazados", "Recibos rechazados por cola llena",
+                 lambda: cola_recibos.rechazados)
+metricas.medidor("contabot_cache_extracciones", "Aciertos, fallos y entradas de la cache de extracciones",
+                 lambda: [({"dato": clave}, valor) for clave, valor in cache_extracciones.estadisticas().items()])
+metricas.medidor("contabot_lotes_gemini", "Estadísticas del agrupador de extracciones",
+                 lambda: [({"dato": clave}, valor) for clave, valor in lote_extracciones.estadisticas().items()
+                          if isinstance(valor, (int, float))])
+
+# Salud del servicio
+# /healthz responde 200 mientras el bot pueda atender (aunque sea en modo degradado con un
+# interruptor abierto) y 503 cuando el envío a Sheets está detenido o acumula demasiadas filas.
+SALUD_MAX_PENDIENTES = int(os.getenv("SALUD_MAX_PENDIENTES", "1000"))
+
+def estado_salud():
+    """Devuelve (código HTTP, detalle) con la salud de backends y colas."""
+    problemas = []
+    if not cola_registros.activa:
+        problemas.append("el envío de registros a Sheets no está corriendo")
+    if cola_registros.pendientes > SALUD_MAX_PENDIENTES:
+        problemas.append(f"{cola_registros.pendientes} filas sin enviar a Sheets")
+    degradados = [e.nombre for e in (ejecutor_sheets, ejecutor_gemini) if not e.disponible]
+
+    if problemas:
+        estado = "error"
+    elif degradados:
+        estado = "degradado"
+    else:
+        estado = "ok"
+    detalle = {
+        "estado": estado,
+        "problemas": problemas,
+        "backends_no_disponibles": degradados,
+        "backends": {e.nombre: e.interruptor.estado() for e in (ejecutor_sheets, ejecutor_gemini)},
+        "cola_registros_pendientes": cola_registros.pendientes,
+    }
+    return (503 if problemas else 200), detalle
+
+class MetricasHandler(tornado.web.RequestHandler):
+    def initialize(self, registro=None):
+        self.registro = registro or metricas
+
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(self.registro.exponer())
+
+class SaludHandler(tornado.web.RequestHandler):
+    def get(self):
+        codigo, detalle = estado_salud()
+        self.set_status(codigo)
+        self.write(detalle)
+
+class WebhookHandler(tornado.web.RequestHandler):
+    """Recibe los updates de Telegram y los pasa a la cola de la Application (modo de un proceso)."""
+
+    def initialize(self, aplicacion):
+        self.aplicacion = aplicacion
+
+    def post(self):
+        try:
+            update = Update.de_json(json.loads(self.request.body), self.aplicacion.bot)
+        except (ValueError, AttributeError, TypeError) as e:
+            logger.warning(f"Update inválido recibido en el webhook: {e}")
+            self.set_status(400)
+            return
+        self.aplicacion.update_queue.put_nowait(update)
+
+# Cola write-behind de registros
+# Cada fila se guarda primero en un journal local (una línea JSON por entrada, con fsync) y se
+# confirma al usuario de inmediato. Un flusher en segundo plano agrupa las filas pendientes por
+# destino (libro y hoja del mes) y las envía a Sheets con una sola llamada append_rows por lote.
+# Cuando un lote llega a Sheets se escribe una marca "ack" en el journal; al reiniciar solo se
+# reenvían las filas sin ack.
+class ColaRegistros:
+    """Journal local + envío por lotes de las filas del libro a Google Sheets."""
+
+    def __init__(self, ruta_journal, tamano_lote, intervalo, filas_por_llamada=None):
+        self.ruta_journal = ruta_journal
+        self.tamano_lote = tamano_lote  # Filas pendientes que disparan un envío sin esperar al intervalo
+        # Tope de filas por append_rows; una importación de extracto se envía en pocas llamadas grandes
+        self.filas_por_llamada = max(filas_por_llamada or tamano_lote, tamano_lote)
+        self.intervalo = intervalo
+        self.filas_enviadas = 0
+        self.llamadas_api = 0
+        self.ultimas_filas = {}  # destino -> número de la última fila escrita en esa hoja
+        self._pendientes = []  # [(id, fila, destino)] en orden de llegada
+        # Ids que pueden haber llegado ya a la hoja sin ack (recuperados del journal o de un
+        # envío fallido): antes de reenviarlos se buscan sus claves en la hoja
+        self._por_verificar = set()
+        self._journal_lock = None
+        self._vaciando = None
+        self._hay_lote = None
+        self._tarea = None
+
+    def _asegurar_primitivas(self):
+        # Las primitivas de asyncio se crean dentro del event loop que las va a usar
+        if self._journal_lock is None:
+            self._journal_lock = asyncio.Lock()
+            self._vaciando = asyncio.Lock()
+            self._hay_lote = asyncio.Event()
+
+    @property
+    def pendientes(self):
+        return len(self._pendientes)
+
+    @property
+    def activa(self):
+        return self._tarea is not None and not self._tarea.done()
+
+    def entradas_pendientes(self):
+        """(id, fila, destino) guardadas en el journal que todavía no están en Sheets, en orden de llegada."""
+        return list(self._pendientes)
+
+    @contextlib.asynccontextmanager
+    async def pausar_envios(self):
+        """Mientras dure el bloque no se envía ningún lote, así hoja + pendientes es consistente."""
+        self._asegurar_primitivas()
+        async with self._vaciando:
+            yield
+
+    def _escribir_journal(self, entradas):
+        with open(self.ruta_journal, "a", encoding="utf-8") as f:
+            for entrada in entradas:
+                f.write(json.dumps(entrada, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _reescribir_journal(self, pendientes):
+        # Se escribe en un archivo temporal y se reemplaza de forma atómica
+        ruta_tmp = self.ruta_journal + ".tmp"
+        with open(ruta_tmp, "w", encoding="utf-8") as f:
+            for id_fila, fila, destino in pendientes:
+                f.write(json.dumps({"id": id_fila, "fila": fila, "destino": destino}, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(ruta_tmp, self.ruta_journal)
+
+    def cargar_pendientes(self):
+        """Recupera del journal las filas que no llegaron a Sheets (tras un reinicio o caída)."""
+        if not os.path.exists(self.ruta_journal):
+            return 0
+
+        pendientes = {}
+        with open(self.ruta_journal, encoding="utf-8") as f:
+            for linea in f:
+                try:
+                    entrada = json.loads(linea)
+                except json.JSONDecodeError:
+                    # Una línea a medio escribir por una caída; su fila nunca se confirmó al usuario
+                    continue
+                if "ack" in entrada:
+                    for id_fila in entrada["ack"]:
+                        pendientes.pop(id_fila, None)
+                else:
+                    # Las entradas anteriores a las hojas mensuales iban a la hoja Registro única
+                    pendientes[entrada["id"]] = (entrada["fila"], tuple(entrada.get("destino") or DESTINO_LEGADO))
+
+        self._pendientes = [(id_fila, fila, destino) for id_fila, (fila, destino) in pendientes.items()]
+        self._por_verificar.update(pendientes)
+        self._reescribir_journal(self._pendientes)
+        if self._pendientes:
+            logger.info(f"Journal: {len(self._pendientes)} filas pendientes se reenviarán a Sheets.")
+        return len(self._pendientes)
+
+    async def encolar(self, filas, destino=DESTINO_LEGADO):
+        """Guarda las filas en el journal; vuelve en cuanto están en disco, sin esperar a Sheets."""
+        self._asegurar_primitivas()
+        destino = tuple(destino)
+        entradas = [{"id": uuid.uuid4().hex, "fila": fila, "destino": destino} for fila in filas]
+        async with self._journal_lock:
+            await asyncio.to_thread(self._escribir_journal, entradas)
+            self._pendientes.extend((entrada["id"], entrada["fila"], destino) for entrada in entradas)
+        if len(self._pendientes) >= self.tamano_lote:
+            self._hay_lote.set()
+        return [entrada["id"] for entrada in entradas]
+
+    def _siguiente_lote(self, excluidos):
+        """Hasta filas_por_llamada filas pendientes del primer destino no excluido, en orden de llegada."""
+        destino = next((d for _, _, d in self._pendientes if d not in excluidos), None)
+        if destino is None:
+            return None, []
+        lote = [entrada for entrada in self._pendientes if entrada[2] == destino][:self.filas_por_llamada]
+        return destino, lote
+
+    async def vaciar(self):
+        """Envía a Sheets todas las filas pendientes, en lotes de hasta filas_por_llamada filas por destino."""
+        self._asegurar_primitivas()
+        async with self._vaciando:
+            fallidos = set()  # Un libro con problemas no detiene el envío a los demás
+            while True:
+                destino, lote = self._siguiente_lote(fallidos)
+                if not lote:
+                    return not fallidos
+                libro, nombre_hoja = destino
+                ids = [id_fila for id_fila, _, _ in lote]
+                try:
+                    ya_estaban, enviadas, respuesta = await ejecutor_sheets.ejecutar(
+                        operar_hoja, self._enviar_lote(lote), nombre_hoja, libro, True
+                    )
+                except CircuitoAbierto:
+                    # Sheets está caído: las filas esperan en el journal hasta que se recupere
+                    logger.warning(f"Sheets no disponible, {len(self._pendientes)} filas esperan en el journal.")
+                    return False
+                except Exception as e:
+                    # Las filas siguen en el journal; se reintentará en el próximo intervalo. El
+                    # append pudo llegar aunque la respuesta no, así que se verificarán antes
+                    logger.error(f"No se pudo enviar un lote de {len(lote)} filas a '{nombre_hoja}': {e}")
+                    self._por_verificar.update(ids)
+                    fallidos.add(destino)
+                    continue
+
+                self._por_verificar.difference_update(ids)
+                self.llamadas_api += 1
+                self.filas_enviadas += len(enviadas)
+                libro_local.registrar_hoja(libro, nombre_hoja)
+                for id_fila, numero_fila in ya_estaban.items():
+                    libro_local.marcar_enviadas([id_fila], numero_fila)
+                ultima_fila = _ultima_fila_de_rango(respuesta)
+                if ultima_fila is not None:
+                    self.ultimas_filas[destino] = ultima_fila
+                    libro_local.marcar_enviadas(enviadas, ultima_fila - len(enviadas) + 1)
+                async with self._journal_lock:
+                    await asyncio.to_thread(self._escribir_journal, [{"ack": ids}])
+                    enviados = set(ids)
+                    self._pendientes = [entrada for entrada in self._pendientes if entrada[0] not in enviados]
+                    if not self._pendientes:
+                        await asyncio.to_thread(self._reescribir_journal, [])
+                if ya_estaban:
+                    logger.warning(f"{len(ya_estaban)} filas ya estaban en '{nombre_hoja}'; no se reenviaron.")
+                logger.info(f"Lote de {len(enviadas)} filas enviado a '{nombre_hoja}'.")
+
+    def _enviar_lote(self, lote):
+        """
+        Operación de hoja que envía el lote con append_rows y devuelve
+        ({id: fila de la hoja} de las que ya estaban, [ids enviados], respuesta de append_rows).
+        Las claves se buscan en la hoja solo si hace falta: filas por verificar o un reintento del
+        ejecutor tras un error (un timeout no dice si el append llegó).
+        """
+        intentos = []
+
+        def enviar(hoja):
+            intentos.append(1)
+            ya_estaban = {}
+            if len(intentos) > 1 or any(id_fila in self._por_verificar for id_fila, _, _ in lote):
+                claves = {clave_de_fila(fila): id_fila for id_fila, fila, _ in lote if clave_de_fila(fila)}
+                ya_estaban = {claves[clave]: numero for clave, numero in filas_con_clave(hoja, claves).items()}
+            faltan = [(id_fila, fila) for id_fila, fila, _ in lote if id_fila not in ya_estaban]
+            respuesta = hoja.append_rows([fila for _, fila in faltan]) if faltan else None
+            return ya_estaban, [id_fila for id_fila, _ in faltan], respuesta
+
+        return enviar
+
+    async def _bucle_flusher(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._hay_lote.wait(), timeout=self.intervalo)
+            except asyncio.TimeoutError:
+                pass
+            self._hay_lote.clear()
+            try:
+                await self.vaciar()
+            except Exception as e:
+                logger.error(f"Error inesperado en el flusher de registros: {e}")
+
+    def iniciar(self):
+        self._asegurar_primitivas()
+        if self._tarea is None:
+            self._tarea = asyncio.get_running_loop().create_task(self._bucle_flusher())
+
+    async def detener(self):
+        if self._tarea is not None:
+            self._tarea.cancel()
+            try:
+                await self._tarea
+            except asyncio.CancelledError:
+                pass
+            self._tarea = None
+        await self.vaciar()
+
+RUTA_JOURNAL = os.getenv("JOURNAL_PATH", "registros_pendientes.jsonl")
+
+# Cada trabajador tiene su journal: el envío por lotes supone un único escritor por archivo
+cola_registros = ColaRegistros(
+    ruta_de_trabajador(RUTA_JOURNAL),
+    tamano_lote=int(os.getenv("LOTE_MAXIMO", "50")),
+    intervalo=float(os.getenv("INTERVALO_FLUSH", "2.0")),
+    filas_por_llamada=int(os.getenv("FILAS_POR_APPEND", "500")),
+)
+
+def _ultima_fila_de_rango(respuesta):
+    """Saca el número de la última fila de la respuesta de append_rows ("Registro!A5:G7" -> 7)."""
+    try:
+        rango = respuesta["updates"]["updatedRange"]
+        return int(re.search(r"(\d+)$", rango).group(1))
+    except (KeyError, TypeError, AttributeError):
+        return None
+
+# Copia local del libro (SQLite)
+# Todas las filas que se guardan pasan también por una base SQLite local, y un reconciliador
+# trae periódicamente solo las filas que aparecieron en las hojas después de la última
+# sincronización (incluidas las que la familia añade a mano). Las lecturas del bot son
+# consultas locales por libro; Google Sheets sigue siendo lo que ve el usuario. El
+# reconciliador solo vuelve a mirar las hojas del mes actual y del anterior; las demás se leen
+# una vez al descubrirlas y en /resumen reconstruir.
+COLUMNAS_REGISTRO = ["Fecha", "Usuario", "Tipo", "Categoría", "Concepto", "Monto", "Mes", "Clave"]
+# Clave guarda la clave de idempotencia de cada fila (ver clave_idempotencia)
+COLUMNA_CLAVE = COLUMNAS_REGISTRO.index("Clave") + 1
+ULTIMA_COLUMNA = chr(ord("A") + len(COLUMNAS_REGISTRO) - 1)
+MAX_ULTIMOS_POR_USUARIO = int(os.getenv("MAX_ULTIMOS_POR_USUARIO", "20"))
+FILAS_POR_PAGINA_SYNC = int(os.getenv("FILAS_POR_PAGINA_SYNC", "2000"))
+INTERVALO_SYNC = float(os.getenv("INTERVALO_SYNC", "300"))
+
+def fila_a_registro(fila):
+    """Convierte una fila de la hoja (lista) en un dict con los encabezados de la hoja."""
+    fila = list(fila) + [""] * (len(COLUMNAS_REGISTRO) - len(fila))
+    return dict(zip(COLUMNAS_REGISTRO, fila))
+
+def clave_de_fila(fila):
+    """Clave de idempotencia de una fila, o None en las filas anteriores a la columna Clave."""
+    return (fila[COLUMNA_CLAVE - 1] or None) if len(fila) >= COLUMNA_CLAVE else None
+
+def filas_con_clave(hoja, claves):
+    """{clave: número de fila} de las `claves` que ya están en la hoja; lee solo la columna Clave."""
+    return {valor: i + 1 for i, valor in enumerate(hoja.col_values(COLUMNA_CLAVE)) if valor in claves}
+
+def fecha_ordenable(fecha):
+    """ "25/05/2025 14:03:00" -> "2025-05-25 14:03:00", para ordenar por fecha en SQL ("" si no se entiende)."""
+    for formato in ("%d/%m/%Y %H:%M:%S", "%d/%m/%Y"):
+        try:
+            return datetime.strptime(str(fecha).strip(), formato).strftime("%Y-%m-%d %H:%M:%S")
+        except ValueError:
+            continue
+    return ""
+
+def monto_a_float(valor):
+    """Interpreta montos escritos en la hoja ("30", "30,5", "S/ 1,200.50") como float."""
+    if isinstance(valor, (int, float)):
+        return float(valor)
+    texto = str(valor).replace("S/.", "").replace("S/", "").strip().replace(" ", "")
+    if "," in texto and "." in texto:
+        texto = texto.replace(",", "")
+    else:
+        texto = texto.replace(",", ".")
+    try:
+        return float(texto)
+    except ValueError:
+        return 0.0
+
+class LibroLocal:
+    """Espejo SQLite de las hojas de movimientos de cada libro, con sincronización incremental."""
+
+    # Versión 2: filas por libro y hoja (antes, una sola hoja Registro)
+    VERSION_ESQUEMA = 2
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(ruta, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._migrar()
+        self._crear_esquema()
+
+    def _migrar(self):
+        with self._lock:
+            version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+            if version >= self.VERSION_ESQUEMA:
+                return
+            # La copia es desechable: se vuelve a llenar desde las hojas y el journal
+            self._conn.executescript("""
+                DROP TABLE IF EXISTS registros;
+                DROP TABLE IF EXISTS sync;
+                DROP TABLE IF EXISTS agregados;
+            """)
+            self._conn.execute(f"PRAGMA user_version = {self.VERSION_ESQUEMA}")
+        if version:
+            logger.info("Copia local del libro migrada a hojas por libro y mes; se sincronizará de nuevo.")
+
+    def _crear_esquema(self):
+        with self._lock:
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS registros (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    libro TEXT NOT NULL,
+                    hoja TEXT NOT NULL,
+                    fila_hoja INTEGER,             -- NULL mientras la fila está en la cola
+                    id_journal TEXT UNIQUE,        -- NULL para filas añadidas a mano en la hoja
+                    fecha TEXT,
+                    fecha_orden TEXT,              -- fecha como YYYY-MM-DD HH:MM:SS
+                    usuario TEXT,
+                    usuario_id INTEGER,            -- Usuario de Telegram; NULL en filas escritas a mano
+                    tipo TEXT,
+                    categoria TEXT,
+                    concepto TEXT,
+                    monto REAL,
+                    mes TEXT,
+                    UNIQUE (libro, hoja, fila_hoja)
+                );
+                CREATE INDEX IF NOT EXISTS idx_registros_libro_fecha ON registros(libro, fecha_orden);
+                CREATE INDEX IF NOT EXISTS idx_registros_libro_usuario ON registros(libro, usuario, fecha_orden);
+                CREATE INDEX IF NOT EXISTS idx_registros_mes ON registros(mes);
+                CREATE INDEX IF NOT EXISTS idx_registros_libro_mes ON registros(libro, mes, fecha_orden);
+                CREATE INDEX IF NOT EXISTS idx_registros_tipo ON registros(tipo);
+                CREATE INDEX IF NOT EXISTS idx_registros_concepto ON registros(concepto);
+                -- Hojas conocidas de cada libro y última fila ya copiada (1 = solo encabezados)
+                CREATE TABLE IF NOT EXISTS sync (
+                    libro TEXT,
+                    hoja TEXT,
+                    ultima_fila INTEGER NOT NULL DEFAULT 1,
+                    PRIMARY KEY (libro, hoja)
+                );
+                -- Libros cuyas hojas ya se listaron una vez
+                CREATE TABLE IF NOT EXISTS libros_descubiertos (
+                    libro TEXT PRIMARY KEY
+                );
+                -- Huellas perceptuales de los recibos ya registrados
+                CREATE TABLE IF NOT EXISTS recibos (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    libro TEXT,                    -- Solo se compara con recibos del mismo libro (familia)
+                    huella TEXT,
+                    usuario TEXT,
+                    fecha TEXT,
+                    monto REAL
+                );
+                -- Usuario de Telegram que escribió cada fila del bot, por su Clave. No se borra al
+                -- reconstruir: las filas que se vuelven a leer de la hoja recuperan su autor
+                CREATE TABLE IF NOT EXISTS autores (
+                    clave TEXT PRIMARY KEY,
+                    usuario_id INTEGER NOT NULL
+                );
+                -- Totales por libro/mes/tipo/categoría/concepto, actualizados con cada fila insertada
+                CREATE TABLE IF NOT EXISTS agregados (
+                    libro TEXT,
+                    mes TEXT,
+                    tipo TEXT,
+                    categoria TEXT,
+                    concepto TEXT,
+                    total REAL NOT NULL DEFAULT 0,
+                    cantidad INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (libro, mes, tipo, categoria, concepto)
+                );
+            """)
+            # Bases creadas antes de que los recibos tuvieran libro: las huellas viejas quedan sin
+            # libro y ya no coinciden con ninguna familia
+            columnas = {row["name"] for row in self._conn.execute("PRAGMA table_info(recibos)")}
+            if "libro" not in columnas:
+                self._conn.execute("ALTER TABLE recibos ADD COLUMN libro TEXT")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_recibos_libro ON recibos(libro, id)")
+            # Bases anteriores a usuario_id: sus filas quedan sin autor y no salen en /ultimos
+            columnas = {row["name"] for row in self._conn.execute("PRAGMA table_info(registros)")}
+            if "usuario_id" not in columnas:
+                self._conn.execute("ALTER TABLE registros ADD COLUMN usuario_id INTEGER")
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_registros_libro_usuario_id ON registros(libro, usuario_id, fecha_orden)"
+            )
+
+    @staticmethod
+    def _valores(fila):
+        r = fila_a_registro(fila)
+        return (r["Fecha"], fecha_ordenable(r["Fecha"]), r["Usuario"], r["Tipo"], r["Categoría"], r["Concepto"],
+                monto_a_float(r["Monto"]), r["Mes"])
+
+    def _sumar_agregado(self, libro, valores):
+        _, _, _, tipo, categoria, concepto, monto, mes = valores
+        self._conn.execute(
+            "INSERT INTO agregados (libro, mes, tipo, categoria, concepto, total, cantidad) "
+            "VALUES (?, ?, ?, ?, ?, ?, 1) "
+            "ON CONFLICT(libro, mes, tipo, categoria, concepto) DO UPDATE SET "
+            "total = total + excluded.total, cantidad = cantidad + 1",
+            (libro, mes, tipo, categoria, concepto, monto)
+        )
+
+    def _restar_agregado(self, row):
+        clave = (row["libro"], row["mes"], row["tipo"], row["categoria"], row["concepto"])
+        condicion = "libro = ? AND mes = ? AND tipo = ? AND categoria = ? AND concepto = ?"
+        self._conn.execute(f"UPDATE agregados SET total = total - ?, cantidad = cantidad - 1 WHERE {condicion}",
+                           (row["monto"],) + clave)
+        self._conn.execute(f"DELETE FROM agregados WHERE {condicion} AND cantidad <= 0", clave)
+
+    def registrar_autores(self, claves, usuario_id):
+        """Anota el usuario de Telegram de las filas con esas claves, antes de encolarlas."""
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO autores (clave, usuario_id) VALUES (?, ?)",
+                                   [(clave, usuario_id) for clave in claves])
+
+    def insertar(self, id_journal, fila, destino):
+        """Guarda una fila recién registrada (todavía sin número de fila en su hoja)."""
+        self.insertar_varias([(id_journal, fila)], destino)
+
+    def insertar_varias(self, entradas, destino):
+        """Como insertar, para [(id_journal, fila)] de un mismo destino en una sola transacción."""
+        libro, hoja = destino
+        with self._lock:
+            self._conn.execute("BEGIN")
+            for id_journal, fila in entradas:
+                valores = self._valores(fila)
+                cursor = self._conn.execute(
+                    "INSERT OR IGNORE INTO registros (libro, hoja, id_journal, usuario_id, fecha, fecha_orden, "
+                    "usuario, tipo, categoria, concepto, monto, mes) VALUES (?, ?, ?, "
+                    "(SELECT usuario_id FROM autores WHERE clave = ?), ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (libro, hoja, id_journal, clave_de_fila(fila)) + valores
+                )
+                if cursor.rowcount:
+                    self._sumar_agregado(libro, valores)
+            self._conn.execute("COMMIT")
+
+    def marcar_enviadas(self, ids_journal, primera_fila):
+        """Asocia las filas de un lote con las filas de la hoja donde quedaron."""
+        with self._lock:
+            self._conn.execute("BEGIN")
+            for i, id_journal in enumerate(ids_journal):
+                fila_hoja = primera_fila + i
+                # Si alguien borró filas en la hoja, un número viejo puede quedar ocupado; gana el
+                # nuevo y la fila vieja sale también de los agregados
+                viejas = self._conn.execute(
+                    "SELECT v.* FROM registros v JOIN registros n ON v.libro = n.libro AND v.hoja = n.hoja "
+                    "WHERE n.id_journal = ? AND v.fila_hoja = ? AND v.id != n.id",
+                    (id_journal, fila_hoja)
+                ).fetchall()
+                for vieja in viejas:
+                    self._restar_agregado(vieja)
+                    self._conn.execute("DELETE FROM registros WHERE id = ?", (vieja["id"],))
+                self._conn.execute("UPDATE registros SET fila_hoja = ? WHERE id_journal = ?", (fila_hoja, id_journal))
+            # La marca de sincronización no se mueve aquí: antes de este lote pudo haber filas
+            # añadidas a mano que el reconciliador todavía tiene que traer
+            self._conn.execute("COMMIT")
+
+    def registrar_hoja(self, libro, hoja):
+        """Añade una hoja a las que sigue el reconciliador (no hace nada si ya estaba)."""
+        with self._lock:
+            self._conn.execute("INSERT OR IGNORE INTO sync (libro, hoja) VALUES (?, ?)", (libro, hoja))
+
+    def hojas_registradas(self, libro=None):
+        """[(libro, hoja)] que sigue el reconciliador, opcionalmente solo las de un libro."""
+        with self._lock:
+            if libro is None:
+                rows = self._conn.execute("SELECT libro, hoja FROM sync ORDER BY libro, hoja").fetchall()
+            else:
+                rows = self._conn.execute("SELECT libro, hoja FROM sync WHERE libro = ? ORDER BY hoja",
+                                          (libro,)).fetchall()
+        return [(row["libro"], row["hoja"]) for row in rows]
+
+    def libro_descubierto(self, libro):
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM libros_descubiertos WHERE libro = ?", (libro,)).fetchone() is not None
+
+    def marcar_descubierto(self, libro, hojas):
+        """Registra las hojas encontradas al listar un libro por primera vez."""
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany("INSERT OR IGNORE INTO sync (libro, hoja) VALUES (?, ?)",
+                                   [(libro, hoja) for hoja in hojas])
+            self._conn.execute("INSERT OR IGNORE INTO libros_descubiertos (libro) VALUES (?)", (libro,))
+            self._conn.execute("COMMIT")
+
+    def olvidar_hoja(self, libro, hoja):
+        """Deja de seguir una hoja que ya no existe (sus filas se conservan)."""
+        with self._lock:
+            self._conn.execute("DELETE FROM sync WHERE libro = ? AND hoja = ?", (libro, hoja))
+
+    def _guardar_marca(self, libro, hoja, fila):
+        self._conn.execute(
+            "INSERT INTO sync (libro, hoja, ultima_fila) VALUES (?, ?, ?) "
+            "ON CONFLICT(libro, hoja) DO UPDATE SET ultima_fila = MAX(ultima_fila, excluded.ultima_fila)",
+            (libro, hoja, fila)
+        )
+
+    def marca_sync(self, libro, hoja):
+        """Última fila de la hoja que ya está en la copia local (1 = solo encabezados)."""
+        with self._lock:
+            fila = self._conn.execute("SELECT ultima_fila FROM sync WHERE libro = ? AND hoja = ?",
+                                      (libro, hoja)).fetchone()
+        return int(fila["ultima_fila"]) if fila else 1
+
+    def incorporar_filas_hoja(self, filas, primera_fila, libro, hoja):
+        """Añade filas leídas de una hoja; devuelve cuántas no estaban en la copia local."""
+        nuevas = 0
+        with self._lock:
+            self._conn.execute("BEGIN")
+            for i, fila in enumerate(filas):
+                if not any(fila):
+                    continue
+                valores = self._valores(fila)
+                cursor = self._conn.execute(
+                    "INSERT OR IGNORE INTO registros (libro, hoja, fila_hoja, usuario_id, fecha, fecha_orden, "
+                    "usuario, tipo, categoria, concepto, monto, mes) VALUES (?, ?, ?, "
+                    "(SELECT usuario_id FROM autores WHERE clave = ?), ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (libro, hoja, primera_fila + i, clave_de_fila(fila)) + valores
+                )
+                if cursor.rowcount:
+                    self._sumar_agregado(libro, valores)
+                    nuevas += 1
+            if filas:
+                self._guardar_marca(libro, hoja, primera_fila + len(filas) - 1)
+            self._conn.execute("COMMIT")
+        return nuevas
+
+    def _a_registro(self, row):
+        return {
+            "Fecha": row["fecha"], "Usuario": row["usuario"], "Tipo": row["tipo"],
+            "Categoría": row["categoria"], "Concepto": row["concepto"], "Monto": row["monto"], "Mes": row["mes"],
+        }
+
+    # Las filas vienen de varias hojas, así que el orden es por fecha y, a igual fecha, por llegada
+    _ORDEN_DESC = "ORDER BY fecha_orden DESC, id DESC"
+
+    def ultimo(self, libro):
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT * FROM registros WHERE libro = ? {self._ORDEN_DESC} LIMIT 1", (libro,)
+            ).fetchone()
+        return self._a_registro(row) if row else None
+
+    def ultimos_de(self, libro, usuario_id, cantidad):
+        """
+        Los últimos `cantidad` registros del usuario de Telegram en su libro, del más reciente al
+        más antiguo. Se filtra por id y no por nombre: dos "Juan" de la familia no se mezclan.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT * FROM registros WHERE libro = ? AND usuario_id = ? {self._ORDEN_DESC} LIMIT ?",
+                (libro, usuario_id, cantidad)
+            ).fetchall()
+        return [self._a_registro(row) for row in rows]
+
+    def resumen_mes(self, libro, mes):
+        """Filas de agregados del mes en un libro: una por tipo/categoría/concepto, sin recorrer el libro."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT tipo, categoria, concepto, total, cantidad FROM agregados WHERE libro = ? AND mes = ?",
+                (libro, mes)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def recorrer(self, libro, mes=None, tipo=None, tamano_pagina=500):
+        """
+        Filas del libro (opcionalmente de un mes y un tipo) en orden cronológico, como tuplas en el
+        orden de COLUMNAS_EXPORTACION. Se leen por páginas (paginación por clave), así que la memoria no
+        depende del tamaño del libro y el lock se suelta entre página y página.
+        """
+        condiciones, parametros = ["libro = ?"], [libro]
+        if mes is not None:
+            condiciones.append("mes = ?")
+            parametros.append(mes)
+        if tipo is not None:
+            condiciones.append("tipo = ?")
+            parametros.append(tipo)
+        consulta = (
+            "SELECT id, fecha_orden, fecha, usuario, tipo, categoria, concepto, monto, mes FROM registros "
+            f"WHERE {' AND '.join(condiciones)} AND (fecha_orden, id) > (?, ?) ORDER BY fecha_orden, id LIMIT ?"
+        )
+        ultima = ("", 0)
+        while True:
+            with self._lock:
+                rows = self._conn.execute(consulta, (*parametros, *ultima, tamano_pagina)).fetchall()
+            for row in rows:
+                yield tuple(row)[2:]
+            if len(rows) < tamano_pagina:
+                return
+            ultima = (rows[-1]["fecha_orden"], rows[-1]["id"])
+
+    def buscar_recibo_parecido(self, libro, huella, distancia_maxima, ultimos=500):
+        """Devuelve el recibo reciente del libro cuya huella está a <= distancia_maxima bits, o None."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT huella, usuario, fecha, monto FROM recibos WHERE libro = ? ORDER BY id DESC LIMIT ?",
+                (libro, ultimos)
+            ).fetchall()
+        for row in rows:
+            if distancia_hamming(huella, row["huella"]) <= distancia_maxima:
+                return dict(row)
+        return None
+
+    def guardar_recibo(self, libro, huella, usuario, fecha, monto):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO recibos (libro, huella, usuario, fecha, monto) VALUES (?, ?, ?, ?, ?)",
+                (libro, huella, usuario, fecha, monto)
+            )
+
+    def preparar_reconstruccion(self):
+        """Olvida las filas que vinieron de la hoja para volver a leerla completa (conserva la cola)."""
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.execute("DELETE FROM registros WHERE fila_hoja IS NOT NULL")
+            self._conn.execute("DELETE FROM sync")
+            self._conn.execute("DELETE FROM libros_descubiertos")
+            self._conn.execute("COMMIT")
+
+    def recalcular_agregados(self):
+        """Recalcula todos los totales a partir de las filas de la copia local."""
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.execute("DELETE FROM agregados")
+            self._conn.execute(
+                "INSERT INTO agregados (libro, mes, tipo, categoria, concepto, total, cantidad) "
+                "SELECT libro, mes, tipo, categoria, concepto, SUM(monto), COUNT(*) FROM registros "
+                "GROUP BY libro, mes, tipo, categoria, concepto"
+            )
+            self._conn.execute("COMMIT")
+
+    def cerrar(self):
+        with self._lock:
+            self._conn.close()
+
+# La copia local también es por trabajador: la sincronización supone que nadie más envía filas
+# mientras lee las hojas. Cada libro tiene un solo trabajador dueño (ver trabajador_de_libro),
+# que es el único que escribe en él y el único que lo sincroniza.
+libro_local = LibroLocal(ruta_de_trabajador(RUTA_BASE_DATOS))
+
+def leer_filas_desde(primera_fila, cantidad, libro=None, nombre_hoja=NOMBRE_HOJA_REGISTRO):
+    """Lee de una hoja hasta `cantidad` filas a partir de `primera_fila` (bloqueante)."""
+    rango = f"A{primera_fila}:{ULTIMA_COLUMNA}{primera_fila + cantidad - 1}"
+    return operar_hoja(lambda hoja: hoja.get_values(rango), nombre_hoja, libro)
+
+def hojas_recientes(hoy=None):
+    """Hojas del mes actual y del anterior: las únicas que el reconciliador vuelve a leer."""
+    hoy = hoy or datetime.now()
+    mes_anterior = hoy.replace(day=1) - timedelta(days=1)
+    return {hoja_del_mes(hoy.strftime("%B %Y")), hoja_del_mes(mes_anterior.strftime("%B %Y"))}
+
+async def _sincronizar_hoja(libro, nombre_hoja):
+    total = 0
+    while True:
+        desde = libro_local.marca_sync(libro, nombre_hoja) + 1
+        filas = await ejecutor_sheets.ejecutar(leer_filas_desde, desde, FILAS_POR_PAGINA_SYNC, libro, nombre_hoja)
+        total += libro_local.incorporar_filas_hoja(filas, desde, libro, nombre_hoja)
+        if len(filas) < FILAS_POR_PAGINA_SYNC:
+            return total
+
+async def sincronizar_libro_local(todas=False):
+    """
+    Trae a la copia local solo las filas posteriores a la última sincronización de cada hoja.
+    La primera vez que aparece un libro se listan sus hojas y se leen todas; después solo las
+    recientes, salvo con todas=True.
+    """
+    total = 0
+    # Sin envíos en curso, así las filas propias ya tienen su número de fila asignado
+    async with cola_registros.pausar_envios():
+        nuevas = set()
+        for libro in libros_conocidos():
+            if not es_libro_propio(libro) or libro_local.libro_descubierto(libro):
+                continue
+            try:
+                hojas = await ejecutor_sheets.ejecutar(listar_hojas_registro, libro)
+            except CircuitoAbierto:
+                raise
+            except Exception as e:
+                logger.error(f"No se pudieron listar las hojas del libro '{libro}': {e}")
+                continue
+            libro_local.marcar_descubierto(libro, hojas)
+            nuevas.update((libro, hoja) for hoja in hojas)
+
+        recientes = hojas_recientes()
+        for libro, nombre_hoja in libro_local.hojas_registradas():
+            if not es_libro_propio(libro):
+                continue
+            if not (todas or nombre_hoja in recientes or (libro, nombre_hoja) in nuevas):
+                continue
+            try:
+                total += await _sincronizar_hoja(libro, nombre_hoja)
+            except CircuitoAbierto:
+                raise
+            except ConnectionError as e:
+                # La hoja se borró o se renombró: se deja de seguir
+                logger.warning(f"No se pudo leer la hoja '{nombre_hoja}' de '{libro}' ({e}); se deja de seguir.")
+                libro_local.olvidar_hoja(libro, nombre_hoja)
+            except Exception as e:
+                logger.error(f"Error al sincronizar la hoja '{nombre_hoja}' de '{libro}': {e}")
+    if total:
+        logger.info(f"Sincronización del libro local: {total} filas nuevas desde las hojas.")
+    return total
+
+async def _bucle_sincronizacion():
+    while True:
+        try:
+            await sincronizar_libro_local()
+        except Exception as e:
+            logger.error(f"Error al sincronizar el libro local con la hoja: {e}")
+        await asyncio.sleep(INTERVALO_SYNC)
+
+# /resumen reconstruir relee todas las hojas de todos los libros: solo para administradores y
+# como mucho una vez por intervalo, porque gasta cuota de Sheets y frena al bot mientras dura
+ADMINISTRADORES = {int(i) for i in os.getenv("ADMIN_USER_IDS", "").replace(",", " ").split()}
+ESPERA_RECONSTRUCCION = float(os.getenv("ESPERA_RECONSTRUCCION", "900"))
+
+async def reconstruir_libro_local():
+    """Vuelve a leer todas las hojas y recalcula los agregados (por ejemplo tras editar filas a mano)."""
+    async with cola_registros.pausar_envios():
+        libro_local.preparar_reconstruccion()
+    total = await sincronizar_libro_local(todas=True)
+    libro_local.recalcular_agregados()
+    logger.info(f"Libro local reconstruido desde las hojas: {total} filas.")
+    return total
+
+# Presupuestos
+# Los presupuestos mensuales por concepto de gasto salen de las sugerencias del onboarding o de
+# /presupuesto y se guardan en el perfil del usuario. Cada gasto que se guarda suma su monto a un
+# contador usuario/mes/concepto del almacén (una sentencia, atómica entre trabajadores), así que
+# evaluar un presupuesto es leer un número, sin recorrer el libro ni las hojas. Un aviso sale al
+# cruzar el 80% y otro al cruzar el 100%. Las filas que la familia escribe a mano en la hoja no
+# pasan por aquí y no cuentan.
+UMBRALES_PRESUPUESTO = (0.8, 1.0)
+
+def clave_gasto_mes(user_id, mes, concepto):
+    return f"{user_id}:{mes}:{concepto}"
+
+def presupuestos_de(user_id):
+    """{concepto: monto mensual} del usuario ({} si no tiene perfil o presupuestos)."""
+    return (users_db.get(user_id) or {}).get("presupuestos", {})
+
+def aviso_presupuesto(concepto, mes, limite, antes, despues):
+    """Texto del aviso si el gasto del mes pasó de `antes` a `despues` cruzando un umbral; si no, None."""
+    if not limite:
+        return None
+    cruzados = [umbral for umbral in UMBRALES_PRESUPUESTO if antes < umbral * limite <= despues]
+    if not cruzados:
+        return None
+    porcentaje = despues / limite * 100
+    if max(cruzados) >= 1.0:
+        return (f"🚨 Superaste tu presupuesto de {concepto} para {mes}: "
+                f"S/. {despues:.2f} de S/. {limite:.2f} ({porcentaje:.0f}%).")
+    return (f"⚠️ Llevas el {porcentaje:.0f}% de tu presupuesto de {concepto} para {mes}: "
+            f"S/. {despues:.2f} de S/. {limite:.2f}.")
+
+def sumar_gastos_presupuesto(user_id, filas):
+    """
+    Suma los gastos de `filas` a los contadores del usuario (una suma por mes y concepto) y
+    devuelve los avisos de los presupuestos que cruzaron un umbral.
+    """
+    por_concepto = {}
+    for fila in filas:
+        registro = fila_a_registro(fila)
+        if registro["Tipo"] == "GASTO":
+            clave = (registro["Mes"], registro["Concepto"])
+            por_concepto[clave] = por_concepto.get(clave, 0.0) + monto_a_float(registro["Monto"])
+    presupuestos = presupuestos_de(user_id) if por_concepto else {}
+    avisos = []
+    for (mes, concepto), monto in por_concepto.items():
+        total = almacen.sumar("gastos_mes", clave_gasto_mes(user_id, mes, concepto), monto)
+        aviso = aviso_presupuesto(concepto, mes, presupuestos.get(concepto), total - monto, total)
+        if aviso:
+            avisos.append(aviso)
+    return avisos
+
+def texto_avisos(avisos):
+    """Los avisos de presupuesto para añadir al final de una confirmación ("" si no hay)."""
+    return "".join(f"\n\n{aviso}" for aviso in avisos or ())
+
+def clave_idempotencia(origen, mensaje):
+    """'origen:chat:mensaje': identifica de dónde sale una fila aunque el update llegue dos veces."""
+    return f"{origen}:{mensaje.chat.id}:{mensaje.message_id}"
+
+async def guardar_registro(fila, user_id, clave):
+    """
+    Punto único de escritura de filas del libro (journal + copia local + envío por lotes).
+    La fila va al libro de la familia del usuario, en la hoja del mes de la fila, con `clave` en
+    la columna Clave, y cuenta para sus presupuestos. Devuelve los avisos de presupuesto que
+    disparó (ver sumar_gastos_presupuesto), o None si ya se había guardado una fila con esa clave.
+    """
+    if not almacen.marcar_una_vez("registros", clave, IDEMPOTENCIA_TTL):
+        logger.info(f"Registro {clave} repetido; no se guarda de nuevo.")
+        metricas.incrementar("contabot_duplicados_descartados_total", origen="registro")
+        return None
+    fila = list(fila) + [clave]
+    destino = destino_de(user_id, fila)
+    libro_local.registrar_autores([clave], user_id)
+    try:
+        ids = await cola_registros.encolar([fila], destino)
+    except Exception:
+        # La fila no quedó guardada: un reintento tiene que poder hacerlo
+        almacen.desmarcar("registros", clave)
+        raise
+    libro_local.insertar(ids[0], fila, destino)
+    return sumar_gastos_presupuesto(user_id, [fila])
+
+async def guardar_registros(filas, user_id, clave):
+    """
+    Como guardar_registro para muchas filas de una vez (una importación): una sola marca de
+    idempotencia para todo el grupo, la fila n lleva la clave "clave:n" y se encolan por destino.
+    Devuelve (filas guardadas, avisos de presupuesto); (0, []) si el grupo ya se había guardado.
+    """
+    if not almacen.marcar_una_vez("registros", clave, IDEMPOTENCIA_TTL):
+        logger.info(f"Importación {clave} repetida; no se guarda de nuevo.")
+        metricas.incrementar("contabot_duplicados_descartados_total", origen="registro")
+        return 0, []
+    por_destino = {}
+    for n, fila in enumerate(filas):
+        fila = list(fila) + [f"{clave}:{n}"]
+        por_destino.setdefault(destino_de(user_id, fila), []).append(fila)
+    libro_local.registrar_autores([f"{clave}:{n}" for n in range(len(filas))], user_id)
+    guardadas = 0
+    try:
+        for destino, filas_destino in por_destino.items():
+            ids = await cola_registros.encolar(filas_destino, destino)
+            guardadas += len(ids)
+            libro_local.insertar_varias(list(zip(ids, filas_destino)), destino)
+    except Exception:
+        # Con parte ya en el journal no se desmarca: repetir la importación duplicaría esas filas
+        if not guardadas:
+            almacen.desmarcar("registros", clave)
+        raise
+    return guardadas, sumar_gastos_presupuesto(user_id, filas)
+
+def formatear_registro(registro):
+    return (
+        f"📅 Fecha: {registro.get('Fecha', 'N/A')}\n"
+        f"👤 Usuario: {registro.get('Usuario', 'N/A')}\n"
+        f"📊 Tipo: {registro.get('Tipo', 'N/A')}\n"
+        f"🏷️ Categoría: {registro.get('Categoría', 'N/A')}\n"
+        f"🔖 Concepto: {registro.get('Concepto', 'N/A')}\n"
+        f"💰 Monto: S/. {registro.get('Monto', 'N/A')}\n"
+    )
+
+# Comandos
+async def start_command(update: Update, context: CallbackContext) -> int:
+    user = update.effective_user
+    telegram_id = user.id
+    
+    # Verificar si el usuario ya existe
+    if telegram_id in users_db:
+        # Usuario existente - menú normal
+        keyboard = [
+            [InlineKeyboardButton("Registrar movimiento", callback_data='registrar')],
+            [InlineKeyboardButton("Ver último registro", callback_data='ver_ultimo')],
+            [InlineKeyboardButton("Ver mi perfil", callback_data='ver_perfil')]
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        
+        await update.message.reply_text(
+            f'¡Hola de nuevo {user.first_name}! ¿Qué deseas hacer hoy?',
+            reply_markup=reply_markup
+        )
+        return ELEGIR_ACCION
+    else:
+        # Usuario nuevo - iniciar onboarding
+        await update.message.reply_text(
+            f'¡Hola {user.first_name}! 👋\n\n'
+            f'Soy tu asistente de economía familiar inteligente. '
+            f'Para comenzar, necesito conocerte mejor.\n\n'
+            f'¿Podrías contarme brevemente sobre tu situación familiar y financiera? '
+            f'Por ejemplo: si vives solo/a, en pareja, con hijos, tus ingresos aproximados, etc.'
+        )
+        return ONBOARDING_START
+
+async def elegir_accion(update: Update, context: CallbackContext) -> int:
+    query = update.callback_query
+    await query.answer()
+    
+    if query.data == 'registrar':
+        # Inicializar datos del usuario
+        usuario_data[query.from_user.id] = {
+            'usuario': query.from_user.first_name
+        }
+        
+        keyboard = [[InlineKeyboardButton(tipo, callback_data=tipo)] for tipo in TIPOS]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        
+        await query.edit_message_text(
+            text="¿Qué tipo de movimiento quieres registrar?",
+            reply_markup=reply_markup
+        )
+        return ELEGIR_TIPO
+    
+    elif query.data == 'ver_ultimo':
+        # El último registro se lee de la copia local, sin descargar la hoja completa
+        try:
+            last_record = libro_local.ultimo(libro_de_usuario(query.from_user.id))
+            if last_record:
+                await query.edit_message_text(
+                    "📝 *Último registro*\n\n" + formatear_registro(last_record),
+                    parse_mode='Markdown'
+                )
+            else:
+                await query.edit_message_text("No hay registros disponibles.")
+        except Exception as e:
+            await query.edit_message_text(f"Error al obtener el último registro: {e}")
+        
+        return ConversationHandler.END
+    
+    elif query.data == 'ver_perfil':
+        user_id = query.from_user.id
+    if user_id in users_db:
         perfil = users_db[user_id]
         await query.edit_message_text(
             f"👤 Mi Perfil:\n\n"
@@ -235,33 +2439,15 @@ async def procesar_onboarding_inicial(update: Update, context: CallbackContext)
     
     try:
         # Prompt para Gemini para analizar el perfil del usuario
-        prompt = f"""
-        Analiza la siguiente información de un nuevo usuario de una app de economía familiar y extrae:
-        
-        Información del usuario: "{user_input}"
-        
-        Devuelve un JSON con:
-        - "rol_familiar": "adulto_solo", "pareja_sin_hijos", "padre_familia", "madre_familia", "adolescente", "estudiante"
-        - "ingresos_estimados": número estimado de ingresos mensuales (0 si no se menciona)
-        - "prioridades": array de máximo 3 prioridades financieras detectadas ["ahorro", "control_gastos", "presupuesto", "deudas", etc.]
-        - "categorias_relevantes": array de categorías de gasto que parecen relevantes para esta persona
-        - "sugerencias_presupuesto": objeto con presupuestos sugeridos por categoría
-        - "necesita_configuracion_familiar": true/false si parece que hay más miembros de familia
-        
-        Ejemplo de respuesta:
-        {{
-            "rol_familiar": "padre_familia",
-            "ingresos_estimados": 2500,
-            "prioridades": ["control_gastos", "ahorro", "educacion_hijos"],
-            "categorias_relevantes": ["ALIMENTOS", "EDUCACION", "VIVIENDA"],
-            "sugerencias_presupuesto": {{"ALIMENTOS": 600, "ENTRETENIMIENTO": 200}},
-            "necesita_configuracion_familiar": true
-        }}
-        """
-        
-        response = gemini_text_model.generate_content(prompt, generation_config={"temperature": 0.3})
-        response_text = response.text.strip().replace("```json", "").replace("```", "")
-        perfil = json.loads(response_text)
+        _, catalogo, codigos, _, _ = _obtener_catalogo()
+        prompt = PROMPTS["onboarding"].substitute(descripcion=user_input, catalogo=catalogo)
+        perfil = await consultar_gemini_json(await modelo_gemini(), prompt, esquema_onboarding(codigos),
+                                             temperatura=0.3)
+        # Los presupuestos llegan como lista de pares con códigos; en el perfil van como {concepto: monto}
+        perfil['sugerencias_presupuesto'] = {
+            codigos[s['categoria']]: s['monto'] for s in perfil.get('sugerencias_presupuesto', [])
+            if s.get('categoria') in codigos and s.get('monto', 0) > 0
+        }
         
         # Guardar temporalmente el perfil
         usuario_data[user.id] = {
@@ -290,8 +2476,10 @@ async def procesar_onboarding_inicial(update: Update, context: CallbackContext)
             f"📊 Análisis de tu perfil:\n\n"
             f"👤 Te veo como: {rol_texto}\n"
             f"💰 Ingresos estimados: S/. {perfil.get('ingresos_estimados', 'No especificado')}\n"
-            f"🎯 Prioridades detectadas: {', '.join(perfil.get('prioridades', []))}\n\n"
-            f"¿Es correcto este análisis?",
+            f"🎯 Prioridades detectadas: {', '.join(perfil.get('prioridades', []))}\n"
+            + "".join(f"\n📌 Presupuesto {concepto}: S/. {monto:.2f}"
+                      for concepto, monto in perfil['sugerencias_presupuesto'].items())
+            + "\n\n¿Es correcto este análisis?",
             reply_markup=reply_markup,
         )
         
@@ -299,7 +2487,6 @@ async def procesar_onboarding_inicial(update: Update, context: CallbackContext)
         
     except Exception as e:
         logger.error(f"Error en onboarding: {e}")
-        logger.error(f"Respuesta de Gemini: {response.text if 'response' in locals() else 'No response'}")
         await update.message.reply_text(
         f"Error técnico: {str(e)[:100]}... "
         "Por favor intenta de nuevo o usa /start para el menú normal."
@@ -315,360 +2502,1625 @@ async def confirmar_perfil_callback(update: Update, context: CallbackContext) ->
         user_id = query.from_user.id
         perfil = usuario_data[user_id]['perfil_inicial']
         
-        users_db[user_id] = {
-            'telegram_id': user_id,
-            'nombre': query.from_user.first_name,
-            'rol_familiar': perfil.get('rol_familiar'),
-            'ingresos_estimados': perfil.get('ingresos_estimados', 0),
-            'prioridades': perfil.get('prioridades', []),
-            'fecha_registro': datetime.now().isoformat(),
-            'familia_id': None  # Por ahora sin familia
-        }
+        users_db[user_id] = {
+            'telegram_id': user_id,
+            'nombre': query.from_user.first_name,
+            'rol_familiar': perfil.get('rol_familiar'),
+            'ingresos_estimados': perfil.get('ingresos_estimados', 0),
+            'prioridades': perfil.get('prioridades', []),
+            # Presupuestos mensuales por concepto de gasto (ver sumar_gastos_presupuesto)
+            'presupuestos': perfil.get('sugerencias_presupuesto', {}),
+            'fecha_registro': datetime.now().isoformat(),
+            # Se une a una familia con /familia; repetir el onboarding no lo saca de la suya
+            'familia_id': (users_db.get(user_id) or {}).get('familia_id')
+        }
+        
+        await query.edit_message_text(
+            "✅ ¡Perfil creado exitosamente!\n\n"
+            "Ya puedes empezar a registrar tus movimientos financieros. "
+            "Usa /start para acceder al menú principal."
+        )
+        
+        # Limpiar datos temporales
+        if user_id in usuario_data:
+            del usuario_data[user_id]
+            
+        return ConversationHandler.END
+    
+    else:  # corregir_perfil
+        await query.edit_message_text(
+            "Por favor, describe nuevamente tu situación familiar y financiera "
+            "con más detalles para que pueda entenderte mejor:"
+        )
+        return ONBOARDING_START
+
+async def elegir_tipo(update: Update, context: CallbackContext) -> int:
+    query = update.callback_query
+    await query.answer()
+    
+    tipo = query.data
+    usuario_data.actualizar(query.from_user.id, tipo=tipo)
+    
+    keyboard = [[InlineKeyboardButton(categoria, callback_data=categoria)] for categoria in CATEGORIAS]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    await query.edit_message_text(
+        text=f"Has seleccionado: {tipo}\n\n¿Es un {tipo.lower()} fijo o variable?",
+        reply_markup=reply_markup
+    )
+    
+    return ELEGIR_CATEGORIA
+
+async def elegir_categoria(update: Update, context: CallbackContext) -> int:
+    query = update.callback_query
+    await query.answer()
+    
+    categoria = query.data
+    usuario_data.actualizar(query.from_user.id, categoria=categoria)
+    
+    # Seleccionar la lista adecuada según el tipo
+    conceptos = CONCEPTOS_INGRESOS if usuario_data[query.from_user.id]['tipo'] == "INGRESO" else CONCEPTOS_GASTOS
+    
+    # Crear botones en filas de 2
+    keyboard = []
+    row = []
+    for i, concepto in enumerate(conceptos):
+        row.append(InlineKeyboardButton(concepto, callback_data=concepto))
+        if i % 2 == 1 or i == len(conceptos) - 1:
+            keyboard.append(row)
+            row = []
+    
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    await query.edit_message_text(
+        text=f"Has seleccionado: {categoria}\n\nSelecciona el concepto:",
+        reply_markup=reply_markup
+    )
+    
+    return ELEGIR_CONCEPTO
+
+async def elegir_concepto(update: Update, context: CallbackContext) -> int:
+    query = update.callback_query
+    await query.answer()
+    
+    concepto = query.data
+    usuario_data.actualizar(query.from_user.id, concepto=concepto)
+    
+    await query.edit_message_text(
+        text=f"Has seleccionado: {concepto}\n\nPor favor, ingresa el monto (solo números):"
+    )
+    
+    return INGRESAR_MONTO
+
+def teclado_confirmar():
+    keyboard = [
+        [InlineKeyboardButton("✅ Confirmar", callback_data='confirmar')],
+        [InlineKeyboardButton("❌ Cancelar", callback_data='cancelar')]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+async def ingresar_monto(update: Update, context: CallbackContext) -> int:
+    try:
+        monto = float(update.message.text.replace(',', '.'))
+        user_id = update.effective_user.id
+        
+        if monto <= 0:
+            await update.message.reply_text("El monto debe ser mayor que cero. Por favor, ingresa un monto válido:")
+            return INGRESAR_MONTO
+        
+        usuario_data.actualizar(user_id, monto=monto)
+        
+        # Mostrar resumen para confirmación
+        reply_markup = teclado_confirmar()
+        
+        await update.message.reply_text(
+            f"📝 *Resumen del registro*\n\n"
+            f"👤 Usuario: {usuario_data[user_id]['usuario']}\n"
+            f"📊 Tipo: {usuario_data[user_id]['tipo']}\n"
+            f"🏷️ Categoría: {usuario_data[user_id]['categoria']}\n"
+            f"🔖 Concepto: {usuario_data[user_id]['concepto']}\n"
+            f"💰 Monto: S/. {monto}\n\n"
+            f"¿Confirmas este registro?",
+            reply_markup=reply_markup,
+        )
+        
+        return CONFIRMAR
+    
+    except ValueError:
+        await update.message.reply_text("Por favor, ingresa solo números (usa punto o coma para decimales):")
+        return INGRESAR_MONTO
+
+async def confirmar(update: Update, context: CallbackContext) -> int:
+    query = update.callback_query
+    await query.answer()
+    
+    user_id = query.from_user.id
+
+    # Un doble toque llega como dos callbacks del mismo mensaje: solo cuenta el primero
+    clave = clave_idempotencia("confirmar", query.message) if query.message else f"confirmar:{query.id}"
+    if not almacen.marcar_una_vez("confirmaciones", clave, IDEMPOTENCIA_TTL):
+        metricas.incrementar("contabot_duplicados_descartados_total", origen="confirmacion")
+        return ConversationHandler.END
+
+    if query.data == 'confirmar' and user_id not in usuario_data:
+        await query.edit_message_text("⌛ Este registro ya no está disponible. Empieza de nuevo con /start.")
+        return ConversationHandler.END
+
+    if query.data == 'confirmar':
+        try:
+            # Datos a registrar
+            fecha = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+            mes = datetime.now().strftime("%B %Y")  # Mes y año
+
+            # Añadir a Google Sheets (se envía en segundo plano)
+            avisos = await guardar_registro([
+                fecha,
+                usuario_data[user_id]['usuario'],
+                usuario_data[user_id]['tipo'],
+                usuario_data[user_id]['categoria'],
+                usuario_data[user_id]['concepto'],
+                usuario_data[user_id]['monto'],
+                mes
+            ], user_id, clave)
+
+            await query.edit_message_text("✅ Registro completado con éxito." + texto_avisos(avisos))
+
+        except Exception as e:
+            # Sin marca y con los datos intactos: el usuario puede volver a confirmar
+            logger.error(f"Error al guardar el registro de {user_id}: {e}")
+            almacen.desmarcar("confirmaciones", clave)
+            await query.edit_message_text(f"❌ Error al guardar el registro: {e}\n\n¿Lo intentamos de nuevo?",
+                                          reply_markup=teclado_confirmar())
+            return CONFIRMAR
+    
+    else:  # cancelar
+        await query.edit_message_text("❌ Registro cancelado.")
+    
+    # Limpiar datos
+    if user_id in usuario_data:
+        del usuario_data[user_id]
+    
+    return ConversationHandler.END
+
+# Prompts de Gemini
+# Las plantillas se compilan una vez (string.Template) y el catálogo de conceptos se inserta con
+# códigos cortos (I1, G7...) que se vuelven a traducir al nombre completo al recibir la
+# respuesta. Las llamadas usan el modo JSON de Gemini con un esquema declarado, así que la
+# respuesta ya es JSON válido y no hay que limpiarla. La fecha de hoy va en el prompt para que
+# "ayer" o "el lunes" se calculen bien.
+DIAS_SEMANA_NOMBRES = ["lunes", "martes", "miércoles", "jueves", "viernes", "sábado", "domingo"]
+
+PROMPTS = {
+    "extraccion": string.Template(
+        "Hoy es $hoy ($dia_semana). Extrae del mensaje de economía familiar: "
+        "tipo (INGRESO o GASTO); monto (número); concepto (código del catálogo, el más cercano); "
+        "categoria (FIJO o VARIABLE; si no es claro, VARIABLE); "
+        "fecha (DD/MM/YYYY si el mensaje menciona una fecha como ayer, el lunes o 25/05; si no, \"actual\"). "
+        "Si no hay monto, pon error: \"Monto no válido\".\n"
+        "Catálogo: $catalogo\n"
+        "Mensaje: \"$mensaje\""
+    ),
+    "extraccion_lote": string.Template(
+        "Hoy es $hoy ($dia_semana). Para cada mensaje de economía familiar extrae: "
+        "id (el del mensaje); tipo (INGRESO o GASTO); monto (número); concepto (código del catálogo, el más cercano); "
+        "categoria (FIJO o VARIABLE; si no es claro, VARIABLE); "
+        "fecha (DD/MM/YYYY si menciona una fecha como ayer, el lunes o 25/05; si no, \"actual\"). "
+        "Si un mensaje no tiene monto, pon error: \"Monto no válido\". Un objeto por mensaje.\n"
+        "Catálogo: $catalogo\n"
+        "Mensajes (id: texto):\n$mensajes"
+    ),
+    "onboarding": string.Template(
+        "Analiza la descripción de un nuevo usuario de una app de economía familiar. Extrae su rol familiar, "
+        "ingresos mensuales estimados (0 si no los menciona), hasta 3 prioridades financieras "
+        "(ahorro, control_gastos, presupuesto, deudas, etc.), categorías de gasto relevantes, un presupuesto "
+        "mensual sugerido para sus principales conceptos de gasto (código G del catálogo y monto) y si parece "
+        "que hay más miembros de familia.\n"
+        "Catálogo: $catalogo\n"
+        "Descripción: \"$descripcion\""
+    ),
+    "recibo": string.Template(
+        "Hoy es $hoy. Extrae de este recibo el monto total, la fecha (DD/MM/YYYY, o \"sin_fecha\" si no hay una "
+        "válida) y sugiere una categoría de gasto."
+    ),
+    "clasificacion_extracto": string.Template(
+        "Clasifica cada movimiento de un extracto bancario familiar: para cada id devuelve el concepto "
+        "(código del catálogo, el más cercano, y del tipo indicado: I para INGRESO, G para GASTO). "
+        "Un objeto por movimiento.\n"
+        "Catálogo: $catalogo\n"
+        "Movimientos (id: tipo descripción):\n$movimientos"
+    ),
+}
+
+def _esquema_objeto(propiedades, requeridas):
+    return {"type": "object", "properties": propiedades, "required": requeridas}
+
+def _esquema_enum(valores):
+    return {"type": "string", "format": "enum", "enum": list(valores)}
+
+def esquema_onboarding(codigos):
+    """Esquema del perfil; los presupuestos sugeridos usan los códigos de gasto del catálogo."""
+    codigos_gasto = [codigo for codigo in codigos if codigo.startswith("G")]
+    return _esquema_objeto({
+        "rol_familiar": _esquema_enum(["adulto_solo", "pareja_sin_hijos", "padre_familia", "madre_familia",
+                                       "adolescente", "estudiante"]),
+        "ingresos_estimados": {"type": "number"},
+        "prioridades": {"type": "array", "items": {"type": "string"}},
+        "categorias_relevantes": {"type": "array", "items": {"type": "string"}},
+        # El esquema de Gemini no admite objetos con claves libres, así que va como lista de pares
+        "sugerencias_presupuesto": {"type": "array", "items": _esquema_objeto(
+            {"categoria": _esquema_enum(codigos_gasto), "monto": {"type": "number"}}, ["categoria", "monto"])},
+        "necesita_configuracion_familiar": {"type": "boolean"},
+    }, ["rol_familiar", "ingresos_estimados", "prioridades", "categorias_relevantes",
+        "sugerencias_presupuesto", "necesita_configuracion_familiar"])
+
+ESQUEMA_RECIBO = _esquema_objeto({
+    "monto_total": {"type": "number"},
+    "fecha": {"type": "string"},
+    "categoria": {"type": "string"},
+}, ["monto_total", "fecha", "categoria"])
+
+_catalogo_compilado = None  # (huella, catálogo en texto, {código: concepto}, esquema, esquema de lote)
+
+def _obtener_catalogo():
+    """Catálogo de conceptos con códigos cortos y sus esquemas; se recompila si cambian las listas."""
+    global _catalogo_compilado
+    huella = _huella_conceptos()
+    if _catalogo_compilado is not None and _catalogo_compilado[0] == huella:
+        return _catalogo_compilado
+
+    codigos = {}
+    for prefijo, conceptos in (("I", CONCEPTOS_INGRESOS), ("G", CONCEPTOS_GASTOS)):
+        for i, concepto in enumerate(conceptos, start=1):
+            codigos[f"{prefijo}{i}"] = concepto
+    texto = "; ".join(f"{codigo} {concepto}" for codigo, concepto in codigos.items())
+
+    propiedades = {
+        "tipo": _esquema_enum(TIPOS),
+        "monto": {"type": "number"},
+        "concepto": _esquema_enum(codigos),
+        "categoria": _esquema_enum(CATEGORIAS),
+        "fecha": {"type": "string"},
+        "error": {"type": "string"},
+    }
+    esquema = _esquema_objeto(propiedades, ["tipo", "monto", "concepto", "categoria", "fecha"])
+    esquema_lote = {"type": "array", "items": _esquema_objeto(
+        {"id": {"type": "string"}, **propiedades}, ["id", "tipo", "monto", "concepto", "categoria", "fecha"])}
+
+    _catalogo_compilado = (huella, texto, codigos, esquema, esquema_lote)
+    return _catalogo_compilado
+
+def _valores_fecha(hoy=None):
+    hoy = hoy or datetime.now()
+    return {"hoy": hoy.strftime("%d/%m/%Y"), "dia_semana": DIAS_SEMANA_NOMBRES[hoy.weekday()]}
+
+def cargar_json_respuesta(texto):
+    """Carga el JSON de una respuesta; por si acaso tolera un bloque ```json alrededor."""
+    try:
+        return json.loads(texto)
+    except json.JSONDecodeError:
+        return json.loads(texto.strip().replace("```json", "").replace("```", ""))
+
+async def consultar_gemini_json(modelo, prompt, esquema, temperatura=0.2, partes_extra=()):
+    """Llama a Gemini en modo JSON con el esquema indicado y devuelve la respuesta ya parseada."""
+    contenido = [prompt, *partes_extra] if partes_extra else prompt
+    response = await ejecutor_gemini.ejecutar(
+        modelo.generate_content, contenido,
+        generation_config={
+            "temperature": temperatura,
+            "response_mime_type": "application/json",
+            "response_schema": esquema,
+        },
+    )
+    try:
+        return cargar_json_respuesta(response.text)
+    except json.JSONDecodeError:
+        logger.error(f"Respuesta de Gemini que no es JSON: {response.text[:500]}")
+        raise
+
+# Respuestas en streaming
+# Con stream=True Gemini entrega el JSON en trozos. Un parser incremental detecta los campos
+# escalares ya completos ("tipo", "monto", ...) para poder mostrar una respuesta provisional
+# antes de que termine la generación.
+PATRON_CAMPO_JSON = re.compile(
+    r'"(\w+)"\s*:\s*("(?:[^"\\]|\\.)*"|-?\d+(?:\.\d+)?(?=\s*[,}\]])|true|false|null)'
+)
+_REINICIO_STREAM = object()  # Marca que un reintento empieza el stream de nuevo
+_FIN_STREAM = object()
+
+class ParserJSONIncremental:
+    """Acumula los trozos del stream y devuelve los campos escalares que ya están completos."""
+
+    def __init__(self):
+        self.texto = ""
+
+    def reiniciar(self):
+        self.texto = ""
+
+    def agregar(self, trozo):
+        self.texto += trozo
+        campos = {}
+        for clave, valor in PATRON_CAMPO_JSON.findall(self.texto):
+            campos[clave] = json.loads(valor)
+        return campos
+
+def _consumir_stream(modelo, contenido, config, loop, cola, parar):
+    """
+    Corre en el pool de Gemini: itera el stream y pasa cada trozo al event loop. Un hilo no se
+    puede cancelar, así que deja de leer cuando el consumidor activa `parar`.
+    """
+    loop.call_soon_threadsafe(cola.put_nowait, _REINICIO_STREAM)
+    for trozo in modelo.generate_content(contenido, generation_config=config, stream=True):
+        if parar.is_set():
+            return
+        loop.call_soon_threadsafe(cola.put_nowait, trozo.text)
+
+async def consultar_gemini_json_stream(modelo, prompt, esquema, al_parcial, temperatura=0.2, partes_extra=()):
+    """
+    Como consultar_gemini_json, pero en streaming: llama a `al_parcial(campos)` cada vez que llegan
+    campos nuevos completos. Devuelve (datos, segundos hasta el primer campo, segundos totales).
+    """
+    inicio = time.perf_counter()
+    primer_campo = None
+    loop = asyncio.get_running_loop()
+    cola = asyncio.Queue()
+    contenido = [prompt, *partes_extra] if partes_extra else prompt
+    config = {"temperature": temperatura, "response_mime_type": "application/json", "response_schema": esquema}
+
+    parar = threading.Event()
+
+    async def _productor():
+        try:
+            await ejecutor_gemini.ejecutar(_consumir_stream, modelo, contenido, config, loop, cola, parar)
+        finally:
+            cola.put_nowait(_FIN_STREAM)
+
+    tarea = loop.create_task(_productor())
+    parser = ParserJSONIncremental()
+    vistos = 0
+    try:
+        while True:
+            trozo = await cola.get()
+            if trozo is _FIN_STREAM:
+                break
+            if trozo is _REINICIO_STREAM:
+                parser.reiniciar()
+                vistos = 0
+                continue
+            campos = parser.agregar(trozo)
+            if len(campos) > vistos:
+                vistos = len(campos)
+                if primer_campo is None:
+                    primer_campo = time.perf_counter() - inicio
+                await al_parcial(campos)
+    except BaseException:
+        # al_parcial falló o se canceló la tarea: el hilo deja el stream en el siguiente trozo y
+        # se espera a que libere su lugar en el pool de Gemini
+        parar.set()
+        await asyncio.gather(tarea, return_exceptions=True)
+        raise
+    await tarea  # Propaga el error del stream, si lo hubo
+
+    try:
+        datos = cargar_json_respuesta(parser.texto)
+    except json.JSONDecodeError:
+        logger.error(f"Respuesta de Gemini que no es JSON: {parser.texto[:500]}")
+        raise
+    return datos, primer_campo, time.perf_counter() - inicio
+
+def _decodificar_extraccion(datos, codigos):
+    """Traduce el código de concepto devuelto por el modelo al nombre completo del concepto."""
+    codigo = str(datos.get("concepto", "")).strip().upper()
+    if codigo in codigos:
+        datos["concepto"] = codigos[codigo]
+    elif datos.get("concepto") not in codigos.values():
+        datos["concepto"] = "OTROS" if datos.get("tipo") == "INGRESO" else "OTROS GASTOS"
+    return datos
+
+async def extraer_con_gemini(user_message, al_parcial=None):
+    """
+    Pide a Gemini que extraiga tipo, monto, concepto, categoría y fecha de un mensaje libre.
+    Si se da `al_parcial`, la respuesta llega en streaming y se le pasan los campos ya decodificados.
+    """
+    _, catalogo, codigos, esquema, _ = _obtener_catalogo()
+    prompt = PROMPTS["extraccion"].substitute(catalogo=catalogo, mensaje=user_message, **_valores_fecha())
+    if al_parcial is None:
+        datos = await consultar_gemini_json(await modelo_gemini(), prompt, esquema)
+        return _decodificar_extraccion(datos, codigos)
+
+    async def _parcial_decodificado(campos):
+        if "concepto" in campos:
+            campos = _decodificar_extraccion(dict(campos), codigos)
+        await al_parcial(campos)
+
+    datos, primer_campo, total = await consultar_gemini_json_stream(
+        await modelo_gemini(), prompt, esquema, _parcial_decodificado
+    )
+    primer = f"{primer_campo:.2f}s" if primer_campo is not None else "-"
+    logger.info(f"Extracción con Gemini en streaming: primeros datos en {primer}, total {total:.2f}s")
+    return _decodificar_extraccion(datos, codigos)
+
+async def extraer_lote_con_gemini(mensajes):
+    """
+    Extrae los datos de varios mensajes con una sola llamada a Gemini.
+    `mensajes` es {id: texto}; devuelve {id: datos} solo para los ids que vinieron bien en la respuesta.
+    """
+    _, catalogo, codigos, _, esquema_lote = _obtener_catalogo()
+    lista = "\n".join(f'{id_mensaje}: "{texto}"' for id_mensaje, texto in mensajes.items())
+    prompt = PROMPTS["extraccion_lote"].substitute(catalogo=catalogo, mensajes=lista, **_valores_fecha())
+    datos = await consultar_gemini_json(await modelo_gemini(), prompt, esquema_lote)
+    if not isinstance(datos, list):
+        raise ValueError("La respuesta del lote no es un array JSON")
+    return {
+        str(d["id"]): _decodificar_extraccion(d, codigos)
+        for d in datos if isinstance(d, dict) and str(d.get("id")) in mensajes
+    }
+
+# Micro-lotes de extracción
+# Cuando varios familiares escriben a la vez, los mensajes que llegan dentro de una ventana
+# corta se envían a Gemini en un solo prompt (el preámbulo y la lista de conceptos van una
+# vez) y la respuesta se reparte a cada handler. Si la respuesta del lote no sirve, cada
+# mensaje faltante se extrae por separado.
+class LoteExtracciones:
+    """Agrupa extracciones concurrentes de Gemini en una sola llamada."""
+
+    def __init__(self, ventana_segundos, tamano_maximo):
+        self.ventana_segundos = ventana_segundos
+        self.tamano_maximo = tamano_maximo
+        self.lotes_enviados = 0
+        self.mensajes_en_lotes = 0
+        self.reintentos_individuales = 0
+        self._pendientes = []  # [(id, mensaje, future, al_parcial)]
+        self._temporizador = None
+        self._contador = 0
+
+    async def extraer(self, mensaje, al_parcial=None):
+        """`al_parcial` solo se usa si el mensaje termina solo en su ventana (respuesta en streaming)."""
+        loop = asyncio.get_running_loop()
+        self._contador += 1
+        futuro = loop.create_future()
+        self._pendientes.append((f"m{self._contador}", mensaje, futuro, al_parcial))
+        if len(self._pendientes) >= self.tamano_maximo:
+            self._despachar_pendientes()
+        elif self._temporizador is None:
+            self._temporizador = loop.call_later(self.ventana_segundos, self._despachar_pendientes)
+        return await futuro
+
+    def _despachar_pendientes(self):
+        if self._temporizador is not None:
+            self._temporizador.cancel()
+            self._temporizador = None
+        lote, self._pendientes = self._pendientes, []
+        if lote:
+            asyncio.get_running_loop().create_task(self._procesar_lote(lote))
+
+    async def _procesar_lote(self, lote):
+        if len(lote) == 1:
+            _, mensaje, futuro, al_parcial = lote[0]
+            await self._resolver(futuro, extraer_con_gemini(mensaje, al_parcial))
+            return
+
+        self.lotes_enviados += 1
+        self.mensajes_en_lotes += len(lote)
+        try:
+            resultados = await extraer_lote_con_gemini({id_mensaje: mensaje for id_mensaje, mensaje, _, _ in lote})
+        except CircuitoAbierto as e:
+            for _, _, futuro, _ in lote:
+                if not futuro.done():
+                    futuro.set_exception(e)
+            return
+        except Exception as e:
+            logger.warning(f"Respuesta de lote de Gemini inválida ({e}); se extrae mensaje por mensaje.")
+            resultados = {}
+
+        faltantes = []
+        for id_mensaje, mensaje, futuro, _ in lote:
+            if id_mensaje in resultados:
+                if not futuro.done():
+                    futuro.set_result(resultados[id_mensaje])
+            else:
+                faltantes.append((mensaje, futuro))
+        self.reintentos_individuales += len(faltantes)
+        await asyncio.gather(*(self._resolver(futuro, extraer_con_gemini(mensaje)) for mensaje, futuro in faltantes))
+
+    @staticmethod
+    async def _resolver(futuro, corrutina):
+        try:
+            resultado = await corrutina
+        except Exception as e:
+            if not futuro.done():
+                futuro.set_exception(e)
+        else:
+            if not futuro.done():
+                futuro.set_result(resultado)
+
+    def estadisticas(self):
+        return {
+            "lotes": self.lotes_enviados,
+            "mensajes_en_lotes": self.mensajes_en_lotes,
+            "reintentos_individuales": self.reintentos_individuales,
+        }
+
+lote_extracciones = LoteExtracciones(
+    ventana_segundos=int(os.getenv("GEMINI_VENTANA_LOTE_MS", "200")) / 1000,
+    tamano_maximo=int(os.getenv("GEMINI_LOTE_MAXIMO", "8")),
+)
+
+async def registrar_por_texto(update: Update, context: CallbackContext) -> None:
+    """
+    Procesa mensajes de texto: primero con el parser local y, si el mensaje es ambiguo, con Gemini.
+    """
+    user_message = update.message.text.upper() # Convertir a mayúsculas para consistencia con tus listas
+    inicio = time.perf_counter()
+    provisional = {}  # Mensaje provisional enviado mientras Gemini termina de responder
+
+    async def responder(texto):
+        # Si ya se mostró un resumen provisional, se corrige ese mismo mensaje
+        if "mensaje" in provisional:
+            await provisional["mensaje"].edit_text(texto)
+        else:
+            await update.message.reply_text(texto)
+
+    async def al_parcial(campos):
+        if "mensaje" in provisional or not all(c in campos for c in ("tipo", "monto", "concepto")):
+            return
+        provisional["mensaje"] = await update.message.reply_text(
+            f"⏳ Entendí: {campos['tipo']} de S/. {campos['monto']} en {campos['concepto']}. Registrando..."
+        )
+        provisional["segundos"] = time.perf_counter() - inicio
+
+    try:
+        # Los mensajes con formato conocido se resuelven sin llamar al modelo
+        extracted_data = parsear_mensaje_local(update.message.text)
+        if extracted_data is not None:
+            logger.info("Registro rápido resuelto con el parser local, sin llamar a Gemini.")
+        else:
+            # Un mensaje equivalente ya analizado por Gemini se reutiliza sin llamar al modelo
+            extracted_data = cache_extracciones.obtener(update.message.text)
+            if extracted_data is None:
+                extracted_data = await lote_extracciones.extraer(user_message, al_parcial)
+                cache_extracciones.guardar(update.message.text, extracted_data)
+        
+        fecha_gemini = extracted_data.get('fecha', 'actual')
+        if fecha_gemini == 'actual':
+            fecha_registro = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+        else:    
+            try:
+                # Validar formato de fecha
+                datetime.strptime(fecha_gemini, "%d/%m/%Y")
+                fecha_registro = fecha_gemini + " " + datetime.now().strftime("%H:%M:%S")
+            except:
+                fecha_registro = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+        
+        # Verificar si Gemini reportó un error de monto
+        if "error" in extracted_data:
+            await responder(f"❌ {extracted_data['error']}. Por favor, asegúrate de incluir un monto válido.")
+            return
+
+        tipo = extracted_data.get('tipo', 'GASTO') # Default a GASTO si Gemini no lo infiere bien
+        monto = float(extracted_data.get('monto', 0.0))
+        concepto_encontrado = extracted_data.get('concepto', 'OTROS')
+        categoria = extracted_data.get('categoria', 'VARIABLE') # Default a VARIABLE
+
+        user = update.effective_user
+
+        # Validaciones básicas que aún pueden ser útiles después de Gemini
+        if monto <= 0:
+            await responder("❌ El monto debe ser mayor que cero.")
+            return
+        
+        if tipo not in TIPOS: # Asegurarse que Gemini devolvió un tipo válido
+            await responder(f"❌ No pude determinar si es INGRESO o GASTO. Recibí: {tipo}. Por favor, sé más específico o usa /start.")
+            return
         
-        await query.edit_message_text(
-            "✅ ¡Perfil creado exitosamente!\n\n"
-            "Ya puedes empezar a registrar tus movimientos financieros. "
-            "Usa /start para acceder al menú principal."
+        if categoria not in CATEGORIAS: # Asegurarse que Gemini devolvió una categoría válida
+             categoria = "VARIABLE" # Fallback si Gemini no devuelve FIJO o VARIABLE
+
+        if "segundos" in provisional:
+            logger.info(f"Registro rápido: respuesta provisional en {provisional['segundos']:.2f}s, "
+                        f"final en {time.perf_counter() - inicio:.2f}s")
+
+        # Registrar en Google Sheets
+        mes = datetime.now().strftime("%B %Y")
+
+        avisos = await guardar_registro([
+            fecha_registro,
+            user.first_name,
+            tipo,
+            categoria,
+            concepto_encontrado,
+            monto,
+            mes
+        ], user.id, clave_idempotencia("texto", update.message))
+
+        await responder(
+            f"✅ Registro rápido completado:\n\n"
+            f"👤 Usuario: {user.first_name}\n"
+            f"📊 Tipo: {tipo}\n"
+            f"🏷️ Categoría: {categoria}\n"
+            f"🔖 Concepto: {concepto_encontrado}\n"
+            f"💰 Monto: S/. {monto}\n"
+            + texto_avisos(avisos)
         )
-        
-        # Limpiar datos temporales
-        if user_id in usuario_data:
-            del usuario_data[user_id]
-            
-        return ConversationHandler.END
     
-    else:  # corregir_perfil
-        await query.edit_message_text(
-            "Por favor, describe nuevamente tu situación familiar y financiera "
-            "con más detalles para que pueda entenderte mejor:"
+    except CircuitoAbierto:
+        # Sin Gemini solo se pueden registrar mensajes que entiende el parser local
+        await responder(
+            "⚠️ El análisis automático no está disponible en este momento. "
+            "Usa el formato TIPO MONTO CONCEPTO (por ejemplo: GASTO 50 ALIMENTOS) o /start para registrar paso a paso."
         )
-        return ONBOARDING_START
+    except Exception as e:
+        await responder(f"❌ Error: {e}")
 
-async def elegir_tipo(update: Update, context: CallbackContext) -> int:
-    query = update.callback_query
-    await query.answer()
-    
-    tipo = query.data
-    usuario_data[query.from_user.id]['tipo'] = tipo
-    
-    keyboard = [[InlineKeyboardButton(categoria, callback_data=categoria)] for categoria in CATEGORIAS]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await query.edit_message_text(
-        text=f"Has seleccionado: {tipo}\n\n¿Es un {tipo.lower()} fijo o variable?",
-        reply_markup=reply_markup
-    )
-    
-    return ELEGIR_CATEGORIA
+# Preprocesamiento de recibos
+# Antes de enviar la foto a Gemini se elige el tamaño más pequeño que Telegram ofrece con
+# resolución suficiente, se pasa a escala de grises, se reduce y se recomprime en JPEG. Menos
+# píxeles significa menos bytes que subir y menos tokens de imagen. Una huella perceptual
+# (dHash de 64 bits) permite reconocer un recibo que ya se registró.
+RECIBO_LADO_OBJETIVO = int(os.getenv("RECIBO_LADO_OBJETIVO", "1280"))
+RECIBO_CALIDAD_JPEG = int(os.getenv("RECIBO_CALIDAD_JPEG", "70"))
+# Recibos distintos con el mismo formato quedan a 3-7 bits; por eso además de la huella tienen que
+# coincidir el monto y la fecha, y aun así se pregunta al usuario antes de descartar nada
+RECIBO_DISTANCIA_DUPLICADO = int(os.getenv("RECIBO_DISTANCIA_DUPLICADO", "1"))
 
-async def elegir_categoria(update: Update, context: CallbackContext) -> int:
-    query = update.callback_query
-    await query.answer()
-    
-    categoria = query.data
-    usuario_data[query.from_user.id]['categoria'] = categoria
-    
-    # Seleccionar la lista adecuada según el tipo
-    conceptos = CONCEPTOS_INGRESOS if usuario_data[query.from_user.id]['tipo'] == "INGRESO" else CONCEPTOS_GASTOS
-    
-    # Crear botones en filas de 2
-    keyboard = []
-    row = []
-    for i, concepto in enumerate(conceptos):
-        row.append(InlineKeyboardButton(concepto, callback_data=concepto))
-        if i % 2 == 1 or i == len(conceptos) - 1:
-            keyboard.append(row)
-            row = []
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await query.edit_message_text(
-        text=f"Has seleccionado: {categoria}\n\nSelecciona el concepto:",
-        reply_markup=reply_markup
+def elegir_tamano_foto(fotos, lado_objetivo=RECIBO_LADO_OBJETIVO):
+    """El PhotoSize más pequeño cuyo lado mayor llega al objetivo; si ninguno llega, el más grande."""
+    suficientes = [f for f in fotos if max(f.width, f.height) >= lado_objetivo]
+    if suficientes:
+        return min(suficientes, key=lambda f: f.width * f.height)
+    return max(fotos, key=lambda f: f.width * f.height)
+
+def huella_perceptual(img):
+    """dHash de 64 bits en hexadecimal: compara cada píxel con su vecino en una miniatura 9x8."""
+    from PIL import Image
+    miniatura = img.convert("L").resize((9, 8), Image.LANCZOS)
+    pixeles = list(miniatura.getdata())
+    bits = 0
+    for fila in range(8):
+        for columna in range(8):
+            izquierda = pixeles[fila * 9 + columna]
+            derecha = pixeles[fila * 9 + columna + 1]
+            bits = (bits << 1) | (izquierda > derecha)
+    return f"{bits:016x}"
+
+def cargar_pil():
+    """Deja Pillow importado en el proceso que la ejecuta (al precalentar el pool de recibos)."""
+    # import_module y no "import PIL.Image": solo interesa el efecto de cargarlo
+    importlib.import_module("PIL.Image")
+
+def distancia_hamming(huella_a, huella_b):
+    return bin(int(huella_a, 16) ^ int(huella_b, 16)).count("1")
+
+def preprocesar_recibo(datos, lado_maximo=RECIBO_LADO_OBJETIVO, calidad=RECIBO_CALIDAD_JPEG):
+    """Devuelve (jpeg_reducido, huella) a partir de los bytes originales de la foto."""
+    # Pillow se importa aquí: solo lo cargan los procesos que llegan a tocar un recibo
+    from PIL import Image, ImageOps
+    img = Image.open(io.BytesIO(datos))
+    img = ImageOps.exif_transpose(img).convert("L")
+    huella = huella_perceptual(img)
+    img.thumbnail((lado_maximo, lado_maximo), Image.LANCZOS)
+    salida = io.BytesIO()
+    img.save(salida, format="JPEG", quality=calidad, optimize=True)
+    return salida.getvalue(), huella
+
+async def _analizar_recibo(user, foto_mensaje, mensaje):
+    """
+    Descarga, preprocesa, analiza y registra el recibo de `foto_mensaje` (el mensaje del usuario);
+    el resultado se escribe editando `mensaje`, el acuse del bot.
+    """
+    fotos = foto_mensaje.photo
+    try:
+        inicio = time.perf_counter()
+
+        # Descargar el tamaño de foto más pequeño que todavía sea legible
+        foto = elegir_tamano_foto(fotos)
+        photo_file = await foto.get_file()
+        photo_bytes = bytes(await photo_file.download_as_bytearray())
+        descarga = time.perf_counter()
+
+        # Reducir y recomprimir en el pool de procesos, sin ocupar el event loop
+        imagen_jpeg, huella = await cola_recibos.preprocesar(photo_bytes)
+        preproceso = time.perf_counter()
+        logger.info(
+            f"Recibo {foto.width}x{foto.height}: {len(photo_bytes)} -> {len(imagen_jpeg)} bytes "
+            f"(descarga {descarga - inicio:.2f}s, preproceso {preproceso - descarga:.2f}s)"
+        )
+
+        # En cuanto aparece el monto se adelanta al usuario mientras Gemini termina
+        async def al_parcial(campos):
+            if "monto_total" in campos and not avisado:
+                avisado.append(True)
+                await mensaje.edit_text(f"⏳ Monto detectado: S/. {campos['monto_total']}. Terminando de analizar...")
+
+        avisado = []
+        # Prompt para Gemini Vision, con la imagen ya reducida
+        extracted_data, primer_campo, total_gemini = await consultar_gemini_json_stream(
+            await modelo_gemini(vision=True), PROMPTS["recibo"].substitute(hoy=datetime.now().strftime("%d/%m/%Y")),
+            ESQUEMA_RECIBO, al_parcial, partes_extra=[{"mime_type": "image/jpeg", "data": imagen_jpeg}]
+        )
+        primer = f"{primer_campo:.2f}s" if primer_campo is not None else "-"
+        logger.info(f"Recibo analizado por Gemini: primeros datos en {primer}, Gemini {total_gemini:.2f}s "
+                    f"(total {time.perf_counter() - inicio:.2f}s)")
+
+        # Usar los datos extraídos por Gemini
+        monto_recibo = float(extracted_data.get('monto_total', 0.0))
+        
+        # Obtener fecha de Gemini o usar fecha actual como fallback
+        fecha_gemini = extracted_data.get('fecha', 'actual')
+        try:
+            # Usar fecha de Gemini + hora actual
+            datetime.strptime(fecha_gemini, "%d/%m/%Y")
+            fecha_registro = fecha_gemini + " " + datetime.now().strftime("%H:%M:%S")
+        except ValueError:
+            # 'actual', 'sin_fecha' o un formato inesperado
+            fecha_registro = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+        
+        categoria_recibo = extracted_data.get('categoria', 'Otros') # Fallback si Gemini no categoriza
+
+        # Aquí podrías preguntar al usuario para confirmar o ajustar los datos
+        # Por simplicidad, lo guardamos directamente
+
+        # Asumimos que los recibos son gastos, pero Gemini podría inferirlo si el prompt es más complejo
+        tipo_recibo = "GASTO" 
+        # Podrías tener una lógica más sofisticada para la categoría Fija/Variable
+        categoria_final = "VARIABLE" # Por defecto, o intentar mapear la categoría de Gemini a tus CATEGORIAS
+
+        recibo = {
+            "user_id": user.id,
+            "fila": [
+                fecha_registro,
+                user.first_name,
+                tipo_recibo,
+                categoria_final, # La categoría inferida por Gemini o un default
+                f"Gasto por recibo: {categoria_recibo}", # Una descripción más detallada
+                monto_recibo,
+                datetime.now().strftime("%B %Y")  # Usar siempre la fecha actual para el mes
+            ],
+            # Del mensaje del usuario: si Telegram reentrega la foto, el acuse nuevo tiene otro id
+            "clave": clave_idempotencia("recibo", foto_mensaje),
+            "huella": huella,
+            "categoria": categoria_recibo,
+        }
+
+        # Un recibo casi idéntico, con el mismo monto y la misma fecha, probablemente ya se registró:
+        # se pregunta en vez de descartarlo
+        duplicado = libro_local.buscar_recibo_parecido(libro_de_usuario(user.id), huella, RECIBO_DISTANCIA_DUPLICADO)
+        if es_mismo_recibo(duplicado, monto_recibo, fecha_registro):
+            recibos_por_confirmar[clave_idempotencia("recibo_pendiente", mensaje)] = recibo
+            await mensaje.edit_text(
+                f"⚠️ Este recibo parece ya registrado ({duplicado['fecha']}, S/. {duplicado['monto']}, "
+                f"por {duplicado['usuario']}). ¿Lo registro de todos modos?",
+                reply_markup=teclado_recibo_repetido()
+            )
+            return
+
+        await mensaje.edit_text(await registrar_recibo(recibo))
+
+    except CircuitoAbierto:
+        await mensaje.edit_text("⚠️ El análisis de recibos no está disponible en este momento. Intenta de nuevo en unos minutos.")
+    except json.JSONDecodeError:
+        await mensaje.edit_text("❌ No pude extraer la información del recibo. ¿Es una imagen clara de un recibo?")
+    except Exception as e:
+        logger.error(f"Error al procesar recibo con Gemini: {e}")
+        await mensaje.edit_text(f"❌ Ocurrió un error al procesar la imagen: {e}")
+
+def es_mismo_recibo(anterior, monto, fecha):
+    """True si el recibo parecido ya registrado tiene el mismo monto y la misma fecha (sin la hora)."""
+    if anterior is None:
+        return False
+    return abs(float(anterior["monto"]) - monto) < 0.005 and str(anterior["fecha"])[:10] == fecha[:10]
+
+def teclado_recibo_repetido():
+    return InlineKeyboardMarkup([[InlineKeyboardButton("✅ Registrar de todos modos", callback_data="recibo_si"),
+                                  InlineKeyboardButton("❌ No registrar", callback_data="recibo_no")]])
+
+async def registrar_recibo(recibo):
+    """Guarda el recibo analizado y devuelve el texto de confirmación."""
+    fila = recibo["fila"]
+    avisos = await guardar_registro(fila, recibo["user_id"], recibo["clave"])
+    if avisos is not None:
+        libro_local.guardar_recibo(libro_de_usuario(recibo["user_id"]), recibo["huella"], fila[1], fila[0], fila[5])
+    return (
+        f"✅ Recibo analizado y registrado:\n\n"
+        f"📅 Fecha: {fila[0]}\n"
+        f"💰 Monto: S/. {fila[5]}\n"
+        f"🏷️ Categoría sugerida: {recibo['categoria']}\n"
+        f"Puedes usar /start para un registro más detallado."
+        + texto_avisos(avisos)
     )
-    
-    return ELEGIR_CONCEPTO
 
-async def elegir_concepto(update: Update, context: CallbackContext) -> int:
+async def confirmar_recibo_repetido(update: Update, context: CallbackContext) -> None:
+    """Botones del aviso de recibo repetido: lo registra igualmente o lo descarta."""
     query = update.callback_query
     await query.answer()
-    
-    concepto = query.data
-    usuario_data[query.from_user.id]['concepto'] = concepto
-    
-    await query.edit_message_text(
-        text=f"Has seleccionado: {concepto}\n\nPor favor, ingresa el monto (solo números):"
-    )
-    
-    return INGRESAR_MONTO
+    clave = clave_idempotencia("recibo_pendiente", query.message) if query.message else None
+    recibo = recibos_por_confirmar.get(clave) if clave else None
+    if recibo is None or recibo["user_id"] != query.from_user.id:
+        await query.edit_message_text("⌛ Este recibo ya no está pendiente. Vuelve a enviarlo si quieres registrarlo.")
+        return
 
-async def ingresar_monto(update: Update, context: CallbackContext) -> int:
+    if query.data != "recibo_si":
+        del recibos_por_confirmar[clave]
+        await query.edit_message_text("❌ No registré el recibo.")
+        return
     try:
-        monto = float(update.message.text.replace(',', '.'))
-        user_id = update.effective_user.id
-        
-        if monto <= 0:
-            await update.message.reply_text("El monto debe ser mayor que cero. Por favor, ingresa un monto válido:")
-            return INGRESAR_MONTO
-        
-        usuario_data[user_id]['monto'] = monto
-        
-        # Mostrar resumen para confirmación
-        keyboard = [
-            [InlineKeyboardButton("✅ Confirmar", callback_data='confirmar')],
-            [InlineKeyboardButton("❌ Cancelar", callback_data='cancelar')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
+        texto = await registrar_recibo(recibo)
+    except Exception as e:
+        # Sigue pendiente: el usuario puede volver a intentarlo con los mismos botones
+        logger.error(f"Error al registrar un recibo repetido: {e}")
+        await query.edit_message_text(f"❌ Error al guardar el recibo: {e}", reply_markup=teclado_recibo_repetido())
+        return
+    recibos_por_confirmar.pop(clave, None)
+    await query.edit_message_text(texto)
+
+# Cola de recibos
+# Los recibos se atienden en una cola propia con un número limitado de trabajadores, y el
+# trabajo de píxeles corre en un pool de procesos. El usuario recibe un acuse inmediato que se
+# edita con el resultado; si la cola está llena se le pide que reintente en vez de acumular
+# fotos en memoria.
+class ColaRecibos:
+    """Cola acotada de recibos con trabajadores asyncio y un pool de procesos para las imágenes."""
+
+    def __init__(self, max_en_cola, concurrencia, procesos):
+        self.max_en_cola = max_en_cola
+        self.concurrencia = concurrencia
+        self.procesos = procesos
+        self.rechazados = 0
+        self._cola = None
+        self._pool = None
+        self._trabajadores = []
+
+    @property
+    def en_cola(self):
+        return self._cola.qsize() if self._cola is not None else 0
+
+    def iniciar(self):
+        self._cola = asyncio.Queue(maxsize=self.max_en_cola)
+        if self.procesos > 0:
+            self._pool = ProcessPoolExecutor(max_workers=self.procesos)
+        loop = asyncio.get_running_loop()
+        self._trabajadores = [loop.create_task(self._trabajador()) for _ in range(self.concurrencia)]
+
+    async def detener(self):
+        for tarea in self._trabajadores:
+            tarea.cancel()
+        await asyncio.gather(*self._trabajadores, return_exceptions=True)
+        self._trabajadores = []
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def encolar(self, user, foto_mensaje, mensaje):
+        """Devuelve False si la cola está llena (el llamador debe pedir que se reintente)."""
+        try:
+            self._cola.put_nowait((user, foto_mensaje, mensaje))
+            return True
+        except asyncio.QueueFull:
+            self.rechazados += 1
+            return False
+
+    async def preprocesar(self, datos):
+        if self._pool is None:
+            return await asyncio.to_thread(preprocesar_recibo, datos)
+        return await asyncio.get_running_loop().run_in_executor(self._pool, preprocesar_recibo, datos)
+
+    async def precalentar(self):
+        """Arranca el proceso del pool e importa Pillow antes de que llegue el primer recibo."""
+        if self._pool is None:
+            await asyncio.to_thread(cargar_pil)
+        else:
+            await asyncio.get_running_loop().run_in_executor(self._pool, cargar_pil)
+
+    async def _trabajador(self):
+        while True:
+            user, foto_mensaje, mensaje = await self._cola.get()
+            try:
+                await _analizar_recibo(user, foto_mensaje, mensaje)
+            except Exception as e:
+                logger.error(f"Error inesperado en la cola de recibos: {e}")
+            finally:
+                self._cola.task_done()
+
+cola_recibos = ColaRecibos(
+    max_en_cola=int(os.getenv("RECIBOS_COLA_MAXIMA", "20")),
+    concurrencia=int(os.getenv("RECIBOS_CONCURRENCIA", "2")),
+    procesos=int(os.getenv("RECIBOS_PROCESOS", "1")),
+)
+
+async def procesar_recibo_con_gemini(update: Update, context: CallbackContext) -> None:
+    """Acusa recibo de la foto al instante y la deja en la cola de recibos."""
+    if not RECIBOS_ACTIVADOS:
         await update.message.reply_text(
-            f"📝 *Resumen del registro*\n\n"
-            f"👤 Usuario: {usuario_data[user_id]['usuario']}\n"
-            f"📊 Tipo: {usuario_data[user_id]['tipo']}\n"
-            f"🏷️ Categoría: {usuario_data[user_id]['categoria']}\n"
-            f"🔖 Concepto: {usuario_data[user_id]['concepto']}\n"
-            f"💰 Monto: S/. {monto}\n\n"
-            f"¿Confirmas este registro?",
-            reply_markup=reply_markup,
+            "📷 El análisis de recibos no está activado. Puedes escribirme el movimiento, por ejemplo: GASTO 50 ALIMENTOS"
         )
-        
-        return CONFIRMAR
-    
+        return
+    mensaje = await update.message.reply_text("📷 Recibí tu imagen. La analizaré como un recibo en un momento...")
+    if not cola_recibos.encolar(update.effective_user, update.message, mensaje):
+        await mensaje.edit_text(
+            "⏳ Estoy procesando muchos recibos en este momento. Por favor, vuelve a enviarlo en unos minutos."
+        )
+
+# Importación de extractos bancarios
+# Un extracto (CSV o XLSX) llega como documento. Se descarga a un archivo temporal y se lee fila
+# a fila en un hilo (csv.reader, o openpyxl en modo read_only), quedándose solo con fecha, tipo,
+# monto y descripción de cada movimiento. Los conceptos se resuelven primero con los alias del
+# parser local y una lista de comercios y términos bancarios; las descripciones que quedan se
+# clasifican con Gemini en pocas llamadas (cada descripción distinta una sola vez). El usuario ve
+# un único resumen y, al confirmar, las filas van al journal agrupadas por hoja del mes y salen a
+# Sheets en append_rows de hasta FILAS_POR_APPEND filas.
+IMPORTACION_EXTENSIONES = (".csv", ".txt", ".xlsx")
+IMPORTACION_MAX_BYTES = int(os.getenv("IMPORTACION_MAX_BYTES", str(5 * 1024 * 1024)))
+IMPORTACION_MAX_MOVIMIENTOS = int(os.getenv("IMPORTACION_MAX_MOVIMIENTOS", "5000"))
+IMPORTACION_LOTE_GEMINI = int(os.getenv("IMPORTACION_LOTE_GEMINI", "100"))
+# Los bancos ponen datos de la cuenta antes de la tabla; el encabezado se busca en estas primeras filas
+IMPORTACION_FILAS_ENCABEZADO = 30
+
+# Palabras de los encabezados de columna que reconoce el importador, ya normalizadas
+COLUMNAS_EXTRACTO = {
+    "fecha": {"FECHA", "DATE"},
+    "descripcion": {"DESCRIPCION", "CONCEPTO", "DETALLE", "GLOSA", "REFERENCIA", "MOVIMIENTO", "DESCRIPTION"},
+    "monto": {"MONTO", "IMPORTE", "AMOUNT", "VALOR"},
+    "cargo": {"CARGO", "CARGOS", "DEBITO", "DEBE", "RETIRO", "EGRESO"},
+    "abono": {"ABONO", "ABONOS", "CREDITO", "HABER", "DEPOSITO", "INGRESO"},
+}
+
+# Comercios y términos de extracto que no están entre los alias del registro por texto
+TERMINOS_EXTRACTO = {
+    "SUELDO": ["HABERES", "REMUNERACION", "PLANILLA"],
+    "TARJETA DE CREDITO": ["PAGO TC", "PAGO TARJ"],
+    "PLAN DE CELULAR": ["MOVISTAR", "CLARO", "ENTEL", "BITEL"],
+    "LUZ": ["ENEL"],
+    "GAS": ["CALIDDA"],
+    "PASAJES": ["CABIFY", "DIDI", "INDRIVE"],
+    "GASOLINA/COMBUSTIBLE": ["PRIMAX", "REPSOL", "PECSA", "PETROPERU"],
+    "ALIMENTOS/COMIDA(DESAYUNO,ALMUERZO,CENA)": ["WONG", "PLAZA VEA", "PLAZAVEA", "TOTTUS", "VIVANDA", "MAKRO",
+                                                 "MASS", "RAPPI", "PEDIDOSYA"],
+    "MEDICINA/PASTILLAS": ["INKAFARMA", "MIFARMA", "BOTICA", "BOTICAS"],
+    "SALIDAS": ["CINEPLANET", "CINEMARK"],
+    "REPARACIONES/MEJORAS": ["SODIMAC", "PROMART"],
+}
+
+FORMATOS_FECHA_EXTRACTO = ("%d/%m/%Y", "%d/%m/%y", "%d-%m-%Y", "%d-%m-%y", "%Y-%m-%d", "%d.%m.%Y", "%Y/%m/%d")
+PATRON_NO_IMPORTE = re.compile(r"[^\d,.()-]")
+
+class ExtractoInvalido(Exception):
+    """El archivo no se puede importar; el mensaje de la excepción se muestra al usuario."""
+
+def parsear_importe(valor):
+    """Número de una celda de importe ("1,234.50", "1.234,50", "-45", "(45.00)", "S/ 12"); None si no hay."""
+    if valor is None or valor == "":
+        return None
+    if isinstance(valor, (int, float)):
+        return float(valor)
+    texto = PATRON_NO_IMPORTE.sub("", PATRON_MONEDA.sub("", str(valor).upper()))
+    negativo = texto.startswith(("(", "-")) or texto.endswith("-")
+    texto = texto.strip("()-")
+    if "," in texto and "." in texto:
+        # El separador que aparece último es el decimal
+        if texto.rfind(",") > texto.rfind("."):
+            texto = texto.replace(".", "").replace(",", ".")
+        else:
+            texto = texto.replace(",", "")
+    elif "," in texto:
+        # "12,50" es decimal; "1,234" es de miles
+        decimal = texto.count(",") == 1 and len(texto.split(",")[1]) != 3
+        texto = texto.replace(",", ".") if decimal else texto.replace(",", "")
+    try:
+        monto = float(texto)
     except ValueError:
-        await update.message.reply_text("Por favor, ingresa solo números (usa punto o coma para decimales):")
-        return INGRESAR_MONTO
+        return None
+    return -monto if negativo else monto
 
-async def confirmar(update: Update, context: CallbackContext) -> int:
-    query = update.callback_query
-    await query.answer()
-    
-    if query.data == 'confirmar':
-        user_id = query.from_user.id
-        
+def parsear_fecha_extracto(valor):
+    """datetime de una celda de fecha (ya es fecha en XLSX; texto en CSV); None si no se entiende."""
+    if isinstance(valor, datetime):
+        return valor
+    if isinstance(valor, date):
+        return datetime(valor.year, valor.month, valor.day)
+    texto = str(valor or "").strip().split(" ")[0].split("T")[0]
+    for formato in FORMATOS_FECHA_EXTRACTO:
         try:
-            sheet = conectar_google_sheets()
-            if sheet:
-                # Datos a registrar
-                fecha = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
-                mes = datetime.now().strftime("%B %Y")  # Mes y año
-                
-                # Añadir a Google Sheets
-                sheet.append_row([
-                    fecha,
-                    usuario_data[user_id]['usuario'],
-                    usuario_data[user_id]['tipo'],
-                    usuario_data[user_id]['categoria'],
-                    usuario_data[user_id]['concepto'],
-                    usuario_data[user_id]['monto'],
-                    mes
-                ])
-                
-                await query.edit_message_text("✅ Registro completado con éxito.")
-            else:
-                await query.edit_message_text("❌ No se pudo conectar con la hoja de cálculo.")
-        
+            return datetime.strptime(texto, formato)
+        except ValueError:
+            continue
+    return None
+
+def leer_filas_extracto(ruta):
+    """Filas del archivo una a una (listas de celdas), sin cargarlo entero en memoria."""
+    if ruta.lower().endswith(".xlsx"):
+        # openpyxl solo hace falta para importar; se carga aquí como Pillow en preprocesar_recibo
+        from openpyxl import load_workbook
+        libro = load_workbook(ruta, read_only=True, data_only=True)
+        try:
+            for fila in libro.active.iter_rows(values_only=True):
+                yield list(fila)
+        finally:
+            libro.close()
+        return
+
+    # Codificación y separador a partir del comienzo del archivo (los bancos usan ";" y latin-1)
+    with open(ruta, "rb") as f:
+        muestra = f.read(64 * 1024)
+    try:
+        texto = codecs.getincrementaldecoder("utf-8-sig")().decode(muestra)
+        codificacion = "utf-8-sig"
+    except UnicodeDecodeError:
+        texto = muestra.decode("latin-1")
+        codificacion = "latin-1"
+    try:
+        dialecto = csv.Sniffer().sniff(texto, delimiters=",;\t|")
+    except csv.Error:
+        dialecto = csv.excel
+    with open(ruta, encoding=codificacion, newline="") as f:
+        yield from csv.reader(f, dialecto)
+
+def _columnas_extracto(encabezados):
+    """{campo: índice de columna} si la fila es el encabezado de la tabla de movimientos; si no, None."""
+    columnas = {}
+    for indice, celda in enumerate(encabezados):
+        palabras = set(re.findall(r"[A-Z]+", normalizar_texto(str(celda or ""))))
+        campos = [campo for campo, terminos in COLUMNAS_EXTRACTO.items() if palabras & terminos]
+        # "Cargo/Abono" en una sola columna es un importe con signo
+        if {"cargo", "abono"} <= set(campos):
+            campos = ["monto"]
+        if campos:
+            columnas.setdefault(campos[0], indice)
+    if "fecha" in columnas and "descripcion" in columnas and columnas.keys() & {"monto", "cargo", "abono"}:
+        return columnas
+    return None
+
+def _movimiento_de_fila(fila, columnas):
+    """(fecha, tipo, monto, descripción) de una fila de la tabla, o None si no es un movimiento."""
+    def celda(campo):
+        indice = columnas.get(campo)
+        return fila[indice] if indice is not None and indice < len(fila) else None
+
+    fecha = parsear_fecha_extracto(celda("fecha"))
+    descripcion = " ".join(str(celda("descripcion") or "").split())
+    if fecha is None or not descripcion:
+        return None
+    if "monto" in columnas:
+        monto = parsear_importe(celda("monto"))
+    else:
+        cargo, abono = parsear_importe(celda("cargo")), parsear_importe(celda("abono"))
+        monto = abs(abono) if abono else (-abs(cargo) if cargo else None)
+    if not monto:
+        return None
+    return fecha, "INGRESO" if monto > 0 else "GASTO", round(abs(monto), 2), descripcion
+
+def leer_extracto(ruta):
+    """
+    Recorre el extracto una vez y devuelve (movimientos, filas omitidas). Cada movimiento es
+    (fecha, tipo, monto, descripción); las filas de saldos o totales bajo la tabla se omiten.
+    """
+    columnas = None
+    movimientos = []
+    omitidas = 0
+    with contextlib.closing(leer_filas_extracto(ruta)) as filas:
+        for numero, fila in enumerate(filas):
+            if columnas is None:
+                if numero >= IMPORTACION_FILAS_ENCABEZADO:
+                    break
+                columnas = _columnas_extracto(fila)
+                continue
+            if all(celda in (None, "") for celda in fila):
+                continue
+            movimiento = _movimiento_de_fila(fila, columnas)
+            if movimiento is None:
+                omitidas += 1
+                continue
+            movimientos.append(movimiento)
+            if len(movimientos) > IMPORTACION_MAX_MOVIMIENTOS:
+                raise ExtractoInvalido(
+                    f"El extracto tiene más de {IMPORTACION_MAX_MOVIMIENTOS} movimientos. Envíalo en partes, por ejemplo un archivo por mes."
+                )
+    if columnas is None:
+        raise ExtractoInvalido("No encontré la tabla de movimientos (columnas de fecha, descripción e importe).")
+    return movimientos, omitidas
+
+_matcher_extracto = None  # (patrón compilado, {término: (tipo, concepto)})
+
+def _obtener_matcher_extracto():
+    global _matcher_extracto
+    if _matcher_extracto is None:
+        terminos = {}
+        for concepto, lista in TERMINOS_EXTRACTO.items():
+            tipo = "INGRESO" if concepto in CONCEPTOS_INGRESOS else "GASTO"
+            for termino in lista:
+                terminos[normalizar_texto(termino)] = (tipo, concepto)
+        ordenados = sorted(terminos, key=len, reverse=True)
+        patron = re.compile(r"(?<![A-Z0-9])(" + "|".join(re.escape(t) for t in ordenados) + r")(?![A-Z0-9])")
+        _matcher_extracto = (patron, terminos)
+    return _matcher_extracto
+
+def descripcion_base(descripcion):
+    """Descripción normalizada sin números (tarjeta, operación, fecha), para agrupar y clasificar."""
+    return " ".join(re.sub(r"\d+", " ", normalizar_texto(descripcion)).split())
+
+def clasificar_por_reglas(base, tipo):
+    """Concepto según los alias de conceptos y TERMINOS_EXTRACTO; None si no hay uno solo claro."""
+    _, patron_conceptos, alias_a_concepto = _obtener_matcher_conceptos()
+    patron_extracto, terminos = _obtener_matcher_extracto()
+    conceptos = {alias_a_concepto[m.group(1)].get(tipo) for m in patron_conceptos.finditer(base)}
+    conceptos |= {terminos[m.group(1)][1] for m in patron_extracto.finditer(base) if terminos[m.group(1)][0] == tipo}
+    conceptos.discard(None)
+    return conceptos.pop() if len(conceptos) == 1 else None
+
+async def clasificar_con_gemini(pendientes):
+    """
+    `pendientes` es [(tipo, descripción base)]; devuelve {(tipo, base): concepto} con una llamada
+    a Gemini por cada IMPORTACION_LOTE_GEMINI descripciones. Un lote que falla queda sin clasificar.
+    """
+    _, catalogo, codigos, _, _ = _obtener_catalogo()
+    esquema = {"type": "array", "items": _esquema_objeto(
+        {"id": {"type": "string"}, "concepto": _esquema_enum(codigos)}, ["id", "concepto"])}
+
+    async def clasificar_lote(lote):
+        ids = {f"m{n}": clave for n, clave in enumerate(lote)}
+        lista = "\n".join(f'{id_movimiento}: {tipo} "{base}"' for id_movimiento, (tipo, base) in ids.items())
+        prompt = PROMPTS["clasificacion_extracto"].substitute(catalogo=catalogo, movimientos=lista)
+        try:
+            datos = await consultar_gemini_json(await modelo_gemini(), prompt, esquema)
         except Exception as e:
-            await query.edit_message_text(f"❌ Error al guardar el registro: {e}")
-    
-    else:  # cancelar
-        await query.edit_message_text("❌ Registro cancelado.")
-    
-    # Limpiar datos
-    if user_id in usuario_data:
-        del usuario_data[user_id]
-    
-    return ConversationHandler.END
+            logger.warning(f"No se pudo clasificar un lote de {len(lote)} movimientos con Gemini: {e}")
+            return {}
+        resultado = {}
+        for d in datos if isinstance(datos, list) else []:
+            if not isinstance(d, dict) or str(d.get("id")) not in ids:
+                continue
+            tipo, base = ids[str(d["id"])]
+            concepto = codigos.get(str(d.get("concepto", "")).strip().upper())
+            # Un concepto del otro tipo no sirve (el tipo lo da el signo del importe)
+            if concepto in (CONCEPTOS_INGRESOS if tipo == "INGRESO" else CONCEPTOS_GASTOS):
+                resultado[(tipo, base)] = concepto
+        return resultado
 
-async def registrar_por_texto(update: Update, context: CallbackContext) -> None:
+    lotes = [pendientes[i:i + IMPORTACION_LOTE_GEMINI] for i in range(0, len(pendientes), IMPORTACION_LOTE_GEMINI)]
+    clasificados = {}
+    for parcial in await asyncio.gather(*(clasificar_lote(lote) for lote in lotes)):
+        clasificados.update(parcial)
+    return clasificados
+
+async def clasificar_movimientos(movimientos):
     """
-    Procesa mensajes de texto usando Gemini para extraer información.
+    Concepto de cada movimiento, en el mismo orden, y cuántos resolvió cada vía ("reglas",
+    "gemini", "otros"). Las descripciones repetidas (la misma tienda cada semana) se clasifican una vez.
     """
-    user_message = update.message.text.upper() # Convertir a mayúsculas para consistencia con tus listas
+    claves = [(tipo, descripcion_base(descripcion)) for _, tipo, _, descripcion in movimientos]
+    por_reglas = {}
+    for tipo, base in claves:
+        if (tipo, base) not in por_reglas:
+            por_reglas[(tipo, base)] = clasificar_por_reglas(base, tipo)
+    pendientes = [clave for clave, concepto in por_reglas.items() if concepto is None]
+    por_gemini = await clasificar_con_gemini(pendientes) if pendientes else {}
+
+    conceptos = []
+    origenes = {"reglas": 0, "gemini": 0, "otros": 0}
+    for clave in claves:
+        if por_reglas[clave] is not None:
+            conceptos.append(por_reglas[clave])
+            origenes["reglas"] += 1
+        elif clave in por_gemini:
+            conceptos.append(por_gemini[clave])
+            origenes["gemini"] += 1
+        else:
+            conceptos.append("OTROS" if clave[0] == "INGRESO" else "OTROS GASTOS")
+            origenes["otros"] += 1
+    logger.info(f"Extracto clasificado: {origenes} ({len(pendientes)} descripciones enviadas a Gemini).")
+    return conceptos, origenes
+
+def resumen_importacion(movimientos, conceptos, omitidas, origenes):
+    """Texto de la vista previa que se muestra antes de importar."""
+    totales = {"INGRESO": [0, 0.0], "GASTO": [0, 0.0]}
+    por_concepto = {}
+    for (_, tipo, monto, _), concepto in zip(movimientos, conceptos):
+        totales[tipo][0] += 1
+        totales[tipo][1] += monto
+        por_concepto[(tipo, concepto)] = por_concepto.get((tipo, concepto), 0.0) + monto
+    fechas = [fecha for fecha, _, _, _ in movimientos]
+
+    lineas = [
+        f"📄 Extracto leído: {len(movimientos)} movimientos" + (f" ({omitidas} líneas omitidas)" if omitidas else ""),
+        f"📅 Del {min(fechas):%d/%m/%Y} al {max(fechas):%d/%m/%Y}",
+        f"📈 Ingresos: {totales['INGRESO'][0]} por S/. {totales['INGRESO'][1]:.2f}",
+        f"📉 Gastos: {totales['GASTO'][0]} por S/. {totales['GASTO'][1]:.2f}",
+        f"🏷️ Clasificados: {origenes['reglas']} por reglas, {origenes['gemini']} con Gemini, "
+        f"{origenes['otros']} como OTROS",
+        "",
+        "Principales conceptos:",
+    ]
+    for (tipo, concepto), total in sorted(por_concepto.items(), key=lambda item: -item[1])[:5]:
+        lineas.append(f"• {concepto} ({tipo}): S/. {total:.2f}")
+    lineas += ["", "Primeros movimientos:"]
+    for (fecha, tipo, monto, descripcion), concepto in list(zip(movimientos, conceptos))[:5]:
+        lineas.append(f"• {fecha:%d/%m} {tipo} S/. {monto:.2f} → {concepto} ({descripcion[:40]})")
+    lineas += ["", "¿Registro todos estos movimientos en tu libro?"]
+    return "\n".join(lineas)
+
+async def importar_extracto(update: Update, context: CallbackContext) -> None:
+    """Recibe un extracto como documento, lo lee y clasifica, y muestra la vista previa para confirmar."""
+    documento = update.message.document
+    user = update.effective_user
+    extension = os.path.splitext((documento.file_name or "").lower())[1]
+    if extension not in IMPORTACION_EXTENSIONES:
+        await update.message.reply_text(
+            "📄 Puedo importar extractos bancarios en CSV o XLSX. Descárgalo de tu banco en uno de esos formatos y envíamelo."
+        )
+        return
+    if documento.file_size and documento.file_size > IMPORTACION_MAX_BYTES:
+        await update.message.reply_text(
+            f"📄 El archivo es muy grande (máximo {IMPORTACION_MAX_BYTES // (1024 * 1024)} MB). Envíalo en partes."
+        )
+        return
+
+    mensaje = await update.message.reply_text("📄 Recibí tu extracto. Leyendo los movimientos...")
+    ruta = None
+    try:
+        archivo = await documento.get_file()
+        with tempfile.NamedTemporaryFile(suffix=extension, delete=False) as temporal:
+            ruta = temporal.name
+        await archivo.download_to_drive(ruta)
+        movimientos, omitidas = await asyncio.to_thread(leer_extracto, ruta)
+    except ExtractoInvalido as e:
+        await mensaje.edit_text(f"❌ {e}")
+        return
+    except Exception as e:
+        logger.error(f"No se pudo leer el extracto de {user.first_name}: {e}")
+        await mensaje.edit_text(f"❌ No pude leer el archivo: {e}")
+        return
+    finally:
+        if ruta is not None:
+            with contextlib.suppress(OSError):
+                os.remove(ruta)
+
+    if not movimientos:
+        await mensaje.edit_text("❌ No encontré movimientos en el extracto.")
+        return
+    await mensaje.edit_text(f"📄 Leí {len(movimientos)} movimientos. Clasificándolos...")
+    conceptos, origenes = await clasificar_movimientos(movimientos)
+
+    filas = [
+        [fecha.strftime("%d/%m/%Y %H:%M:%S"), user.first_name, tipo,
+         "FIJO" if concepto in CONCEPTOS_FIJOS else "VARIABLE", concepto, monto, fecha.strftime("%B %Y")]
+        for (fecha, tipo, monto, _), concepto in zip(movimientos, conceptos)
+    ]
+    # Una sola importación pendiente por usuario: la vista previa nueva reemplaza a la anterior
+    importaciones[user.id] = {"mensaje": mensaje.message_id, "filas": filas, "fecha": datetime.now().isoformat()}
+    await mensaje.edit_text(resumen_importacion(movimientos, conceptos, omitidas, origenes),
+                            reply_markup=teclado_importacion())
+
+def teclado_importacion():
+    keyboard = [[InlineKeyboardButton("✅ Importar", callback_data="importar_si"),
+                 InlineKeyboardButton("❌ Cancelar", callback_data="importar_no")]]
+    return InlineKeyboardMarkup(keyboard)
+
+async def confirmar_importacion(update: Update, context: CallbackContext) -> None:
+    """Botones de la vista previa: guarda todas las filas de la importación o la descarta."""
+    query = update.callback_query
+    await query.answer()
+    user_id = query.from_user.id
+
+    clave = clave_idempotencia("importar", query.message) if query.message else f"importar:{query.id}"
+    if not almacen.marcar_una_vez("confirmaciones", clave, IDEMPOTENCIA_TTL):
+        metricas.incrementar("contabot_duplicados_descartados_total", origen="confirmacion")
+        return
+
+    pendiente = importaciones.get(user_id)
+    if pendiente is None or (query.message and pendiente["mensaje"] != query.message.message_id):
+        await query.edit_message_text("⌛ Esta importación ya no está disponible. Vuelve a enviar el extracto.")
+        return
+
+    if query.data != "importar_si":
+        del importaciones[user_id]
+        await query.edit_message_text("❌ Importación cancelada.")
+        return
+    try:
+        guardadas, avisos = await guardar_registros(pendiente["filas"], user_id, clave)
+    except Exception as e:
+        # Sigue pendiente y sin marca: el usuario puede volver a intentarlo con los mismos botones
+        logger.error(f"Error al guardar la importación de {user_id}: {e}")
+        almacen.desmarcar("confirmaciones", clave)
+        await query.edit_message_text(f"❌ Error al guardar la importación: {e}", reply_markup=teclado_importacion())
+        return
+    importaciones.pop(user_id, None)
+    await query.edit_message_text(
+        f"✅ Importé {guardadas} movimientos. Se están enviando a tu hoja de cálculo." + texto_avisos(avisos)
+    )
 
-    # --- AQUI ES DONDE INTEGRARÁS GEMINI ---
+async def ultimos_command(update: Update, context: CallbackContext) -> None:
+    """Muestra los últimos N registros del usuario: /ultimos [N]"""
+    user = update.effective_user
     try:
-        # Definir el prompt para Gemini
-        # Queremos que Gemini extraiga el tipo, monto y concepto
-        # y categorice como FIJO o VARIABLE si es posible, o use un default.
-        # Le pedimos que nos devuelva un JSON para facilitar el parseo.
-        prompt = f"""
-        Analiza el siguiente mensaje para extraer la siguiente información en formato JSON:
-        - "tipo": "INGRESO" o "GASTO"
-        - "monto": solo el número (flotante), si no se encuentra, usar 0.0
-        - "concepto": la descripción del gasto/ingreso, debe ser uno de los siguientes si coincide: {", ".join(CONCEPTOS_INGRESOS + CONCEPTOS_GASTOS)}. Si no hay coincidencia exacta, usa la descripción más cercana o la que puedas inferir.
-        - "categoria": "FIJO" o "VARIABLE". Intenta inferir si es fijo o variable basado en el concepto o la naturaleza de la transacción. Si no es claro, asume "VARIABLE".
-        - "fecha": si se menciona una fecha específica (ayer, lunes, 25/05, etc.), calcúlala y devuélvela en formato DD/MM/YYYY. Si no se menciona fecha, usa "actual"
-
-        Si el monto no se puede determinar, devuelve un JSON con un campo "error": "Monto no válido".
-
-        Ejemplos de cómo debería ser el JSON:
-        Mensaje: "Gaste 30 soles en pasajes"
-        JSON: {{"tipo": "GASTO", "monto": 30.0, "concepto": "PASAJES", "categoria": "VARIABLE"}}
-
-        Mensaje: "Mi sueldo de 1500"
-        JSON: {{"tipo": "INGRESO", "monto": 1500.0, "concepto": "SUELDO", "categoria": "FIJO"}}
-
-        Mensaje: "Compre ropa por 80"
-        JSON: {{"tipo": "GASTO", "monto": 80.0, "concepto": "ROPA", "categoria": "VARIABLE"}}
-        
-        "Gasté 30 soles en pasajes ayer" -> {{"fecha": "01/06/2025", ...}}
-        "El lunes pagué 100 de luz" -> {{"fecha": "fecha_del_lunes", ...}}
-        "Compré ropa por 80" -> {{"fecha": "actual", ...}}
+        cantidad = int(context.args[0]) if context.args else 5
+    except ValueError:
+        await update.message.reply_text("Uso: /ultimos [cantidad], por ejemplo /ultimos 5")
+        return
+    cantidad = max(1, min(cantidad, MAX_ULTIMOS_POR_USUARIO))
 
-        Mensaje a analizar: "{user_message}"
-        """
-        
-        # Generar contenido con Gemini
-        # temp = 0.2 para respuestas más determinísticas, menos creativas
-        response = gemini_text_model.generate_content(prompt, generation_config={"temperature": 0.2})
-        
-        # Extraer el texto de la respuesta y cargarlo como JSON
-        # A veces Gemini puede añadir texto extra, intentamos limpiar si es necesario
-        response_text = response.text.strip().replace("```json", "").replace("```", "")
-        
-        extracted_data = json.loads(response_text)
-        
-        fecha_gemini = extracted_data.get('fecha', 'actual')
-        if fecha_gemini == 'actual':
-            fecha_registro = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
-        else:    
-            try:
-                # Validar formato de fecha
-                datetime.strptime(fecha_gemini, "%d/%m/%Y")
-                fecha_registro = fecha_gemini + " " + datetime.now().strftime("%H:%M:%S")
-            except:
-                fecha_registro = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
-        
-        # Verificar si Gemini reportó un error de monto
-        if "error" in extracted_data:
-            await update.message.reply_text(f"❌ {extracted_data['error']}. Por favor, asegúrate de incluir un monto válido.")
-            return
+    try:
+        registros = libro_local.ultimos_de(libro_de_usuario(user.id), user.id, cantidad)
+    except Exception as e:
+        await update.message.reply_text(f"Error al obtener tus registros: {e}")
+        return
 
-        tipo = extracted_data.get('tipo', 'GASTO') # Default a GASTO si Gemini no lo infiere bien
-        monto = float(extracted_data.get('monto', 0.0))
-        concepto_encontrado = extracted_data.get('concepto', 'OTROS')
-        categoria = extracted_data.get('categoria', 'VARIABLE') # Default a VARIABLE
+    if not registros:
+        await update.message.reply_text("No tienes registros recientes.")
+        return
+    await update.message.reply_text(
+        f"📝 *Tus últimos {len(registros)} registros*\n\n" + "\n".join(formatear_registro(r) for r in registros),
+        parse_mode='Markdown'
+    )
 
-        user = update.effective_user
+MESES = {
+    "ENERO": 1, "FEBRERO": 2, "MARZO": 3, "ABRIL": 4, "MAYO": 5, "JUNIO": 6, "JULIO": 7,
+    "AGOSTO": 8, "SETIEMBRE": 9, "SEPTIEMBRE": 9, "OCTUBRE": 10, "NOVIEMBRE": 11, "DICIEMBRE": 12,
+}
 
-        # Validaciones básicas que aún pueden ser útiles después de Gemini
-        if monto <= 0:
-            await update.message.reply_text("❌ El monto debe ser mayor que cero.")
-            return
-        
-        if tipo not in TIPOS: # Asegurarse que Gemini devolvió un tipo válido
-            await update.message.reply_text(f"❌ No pude determinar si es INGRESO o GASTO. Recibí: {tipo}. Por favor, sé más específico o usa /start.")
-            return
-        
-        if categoria not in CATEGORIAS: # Asegurarse que Gemini devolvió una categoría válida
-             categoria = "VARIABLE" # Fallback si Gemini no devuelve FIJO o VARIABLE
+def mes_desde_texto(texto, hoy=None):
+    """
+    Convierte "junio", "junio 2025", "06/2025" o "2025-06" al formato de la columna Mes
+    (el mismo strftime("%B %Y") con el que se escriben las filas). Devuelve None si no se entiende.
+    """
+    hoy = hoy or datetime.now()
+    texto = normalizar_texto(texto)
+    if not texto:
+        return hoy.strftime("%B %Y")
 
-        # --- FIN DE LA INTEGRACIÓN DE GEMINI ---
-        
-        # Registrar en Google Sheets
-        sheet = conectar_google_sheets()
-        if sheet:
-            mes = datetime.now().strftime("%B %Y")
-            
-            sheet.append_row([
-                fecha_registro,
-                user.first_name,
-                tipo,
-                categoria,
-                concepto_encontrado,
-                monto,
-                mes
-            ])
-            
+    coincidencia = re.fullmatch(r"(\d{1,2})[/-](\d{4})|(\d{4})[/-](\d{1,2})", texto)
+    if coincidencia:
+        mes = int(coincidencia.group(1) or coincidencia.group(4))
+        anio = int(coincidencia.group(2) or coincidencia.group(3))
+    else:
+        partes = texto.split()
+        nombres_ingles = {datetime(2000, m, 1).strftime("%B").upper(): m for m in range(1, 13)}
+        mes = MESES.get(partes[0]) or nombres_ingles.get(partes[0])
+        if mes is None:
+            return None
+        anio = int(partes[1]) if len(partes) > 1 and partes[1].isdigit() else hoy.year
+    if not 1 <= mes <= 12:
+        return None
+    return datetime(anio, mes, 1).strftime("%B %Y")
+
+async def resumen_command(update: Update, context: CallbackContext) -> None:
+    """Resumen mensual desde los agregados locales: /resumen [mes] o /resumen reconstruir"""
+    if context.args and context.args[0].lower() == "reconstruir":
+        if update.effective_user.id not in ADMINISTRADORES:
+            await update.message.reply_text("Solo un administrador del bot puede reconstruir los totales.")
+            return
+        # La marca es compartida entre trabajadores y caduca sola al terminar la espera
+        if not almacen.marcar_una_vez("reconstrucciones", "libro_local", ESPERA_RECONSTRUCCION):
             await update.message.reply_text(
-                f"✅ Registro rápido completado:\n\n"
-                f"👤 Usuario: {user.first_name}\n"
-                f"📊 Tipo: {tipo}\n"
-                f"🏷️ Categoría: {categoria}\n"
-                f"🔖 Concepto: {concepto_encontrado}\n"
-                f"💰 Monto: S/. {monto}\n"
+                f"⌛ Ya se reconstruyeron los totales hace poco. Espera {ESPERA_RECONSTRUCCION / 60:.0f} minutos "
+                "entre reconstrucciones."
             )
-        else:
-            await update.message.reply_text("❌ No se pudo conectar con la hoja de cálculo.")
-    
-    except Exception as e:
-        await update.message.reply_text(f"❌ Error: {e}")
+            return
+        await update.message.reply_text("Reconstruyendo los totales desde las hojas de cálculo...")
+        try:
+            total = await reconstruir_libro_local()
+            await update.message.reply_text(f"✅ Totales reconstruidos a partir de {total} filas.")
+        except Exception as e:
+            # Si falló, se puede volver a intentar sin esperar
+            almacen.desmarcar("reconstrucciones", "libro_local")
+            await update.message.reply_text(f"❌ Error al reconstruir los totales: {e}")
+        return
 
-async def procesar_recibo_con_gemini(update: Update, context: CallbackContext) -> None:
-    user = update.effective_user
-    await update.message.reply_text("Detecté una imagen. Intentando analizarla como un recibo...")
+    mes = mes_desde_texto(" ".join(context.args or []))
+    if mes is None:
+        await update.message.reply_text("No entendí el mes. Ejemplos: /resumen, /resumen junio 2025, /resumen 06/2025")
+        return
 
-    try:
-        # Descargar la imagen
-        photo_file = await update.message.photo[-1].get_file() # Obtener la foto de mayor resolución
-        photo_bytes = await photo_file.download_as_bytearray()
-
-        # Convertir a formato de imagen para Pillow y luego para Gemini
-        # Esto es necesario porque Gemini espera un objeto Image de PIL
-        img = Image.open(io.BytesIO(photo_bytes))
-
-        # Prompt para Gemini Vision
-        # Aquí la clave es ser muy específico sobre qué quieres extraer del recibo
-        prompt_parts = [
-            "Extrae el monto total, la fecha (en formato DD/MM/YYYY), y sugiere una categoría de gasto de este recibo. Si no encuentras una fecha válida, usa 'sin_fecha'. Devuelve la información en formato JSON.",
-            img
-        ]
+    filas = libro_local.resumen_mes(libro_de_usuario(update.effective_user.id), mes)
+    if not filas:
+        await update.message.reply_text(f"No hay registros para {mes}.")
+        return
 
-        response = gemini_vision_model.generate_content(prompt_parts)
+    ingresos = sum(f["total"] for f in filas if f["tipo"] == "INGRESO")
+    gastos = sum(f["total"] for f in filas if f["tipo"] == "GASTO")
+    gastos_fijos = sum(f["total"] for f in filas if f["tipo"] == "GASTO" and f["categoria"] == "FIJO")
+    gastos_variables = gastos - gastos_fijos
 
-        # Limpiar y parsear la respuesta JSON de Gemini
-        response_text = response.text.strip().replace("```json", "").replace("```", "")
-        extracted_data = json.loads(response_text)
+    por_concepto = {}
+    for f in filas:
+        if f["tipo"] == "GASTO":
+            por_concepto[f["concepto"]] = por_concepto.get(f["concepto"], 0) + f["total"]
+    top = sorted(por_concepto.items(), key=lambda item: item[1], reverse=True)[:5]
 
-        # Usar los datos extraídos por Gemini
-        monto_recibo = float(extracted_data.get('monto_total', 0.0))
-        
-        # Obtener fecha de Gemini o usar fecha actual como fallback
-        fecha_gemini = extracted_data.get('fecha', 'actual')
-        if fecha_gemini == 'actual':
-            fecha_registro = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+    texto = (
+        f"📊 Resumen de {mes}\n\n"
+        f"💵 Ingresos: S/. {ingresos:.2f}\n"
+        f"💸 Gastos: S/. {gastos:.2f}\n"
+        f"⚖️ Balance: S/. {ingresos - gastos:.2f}\n\n"
+        f"📌 Gastos fijos: S/. {gastos_fijos:.2f}\n"
+        f"🔄 Gastos variables: S/. {gastos_variables:.2f}\n"
+    )
+    if top:
+        texto += "\n🏆 Principales gastos:\n" + "\n".join(f"• {concepto}: S/. {total:.2f}" for concepto, total in top)
+    await update.message.reply_text(texto)
+
+# Exportación del libro
+# /exportar lee de la copia local por páginas y escribe cada página en un archivo temporal
+# (CSV, o XLSX con openpyxl en modo write_only), que se envía como documento y se borra. Ni el
+# libro ni el archivo se tienen enteros en memoria, y el tiempo depende de las filas elegidas.
+COLUMNAS_EXPORTACION = [c for c in COLUMNAS_REGISTRO if c != "Clave"]
+FORMATOS_EXPORTACION = ("CSV", "XLSX")
+PALABRAS_TIPO_EXPORTACION = {"INGRESO": "INGRESO", "INGRESOS": "INGRESO", "GASTO": "GASTO", "GASTOS": "GASTO"}
+
+def escribir_exportacion(ruta, formato, filas):
+    """Escribe las filas en `ruta` a medida que llegan y devuelve cuántas escribió."""
+    cantidad = 0
+    if formato == "XLSX":
+        from openpyxl import Workbook
+        libro = Workbook(write_only=True)
+        hoja = libro.create_sheet("Registros")
+        hoja.append(COLUMNAS_EXPORTACION)
+        for fila in filas:
+            hoja.append(list(fila))
+            cantidad += 1
+        libro.save(ruta)
+        return cantidad
+    # utf-8-sig para que Excel muestre bien las tildes al abrir el CSV
+    with open(ruta, "w", encoding="utf-8-sig", newline="") as f:
+        escritor = csv.writer(f)
+        escritor.writerow(COLUMNAS_EXPORTACION)
+        for fila in filas:
+            escritor.writerow(fila)
+            cantidad += 1
+    return cantidad
+
+def _argumentos_exportacion(args):
+    """(mes o None para todo el libro, tipo o None, formato) de los argumentos de /exportar; mes "" si no se entiende."""
+    tipo, formato, resto = None, "CSV", []
+    for argumento in args:
+        palabra = normalizar_texto(argumento)
+        if palabra in PALABRAS_TIPO_EXPORTACION:
+            tipo = PALABRAS_TIPO_EXPORTACION[palabra]
+        elif palabra in FORMATOS_EXPORTACION:
+            formato = palabra
         else:
-            # Usar fecha de Gemini + hora actual
-            fecha_registro = fecha_gemini + " " + datetime.now().strftime("%H:%M:%S")
-        
-        categoria_recibo = extracted_data.get('categoria', 'Otros') # Fallback si Gemini no categoriza
+            resto.append(argumento)
+    if resto and normalizar_texto(resto[0]) in ("TODO", "TODOS"):
+        return None, tipo, formato
+    return mes_desde_texto(" ".join(resto)) or "", tipo, formato
 
-        # Aquí podrías preguntar al usuario para confirmar o ajustar los datos
-        # Por simplicidad, lo guardamos directamente
+async def exportar_command(update: Update, context: CallbackContext) -> None:
+    """Envía los registros del libro como archivo: /exportar [mes|todo] [ingresos|gastos] [csv|xlsx]"""
+    mes, tipo, formato = _argumentos_exportacion(context.args or [])
+    if mes == "":
+        await update.message.reply_text(
+            "No entendí el mes. Ejemplos: /exportar, /exportar junio 2025 gastos, /exportar todo xlsx"
+        )
+        return
 
-        sheet = conectar_google_sheets()
-        if sheet:
-            # Asumimos que los recibos son gastos, pero Gemini podría inferirlo si el prompt es más complejo
-            tipo_recibo = "GASTO" 
-            # Podrías tener una lógica más sofisticada para la categoría Fija/Variable
-            categoria_final = "VARIABLE" # Por defecto, o intentar mapear la categoría de Gemini a tus CATEGORIAS
+    libro = libro_de_usuario(update.effective_user.id)
+    descripcion = (f"{tipo.lower()}s" if tipo else "registros") + (f" de {mes}" if mes else " de todo el libro")
+    extension = "." + formato.lower()
+    ruta = None
+    try:
+        with tempfile.NamedTemporaryFile(suffix=extension, delete=False) as temporal:
+            ruta = temporal.name
+        cantidad = await asyncio.to_thread(escribir_exportacion, ruta, formato, libro_local.recorrer(libro, mes, tipo))
+        if not cantidad:
+            await update.message.reply_text(f"No hay {descripcion}.")
+            return
+        nombre = "contabot_" + "_".join(filter(None, [(mes or "todo").replace(" ", "_"), tipo and f"{tipo.lower()}s"]))
+        with open(ruta, "rb") as archivo:
+            await update.message.reply_document(
+                document=archivo, filename=nombre.lower() + extension, caption=f"📤 {cantidad} {descripcion}"
+            )
+    except Exception as e:
+        logger.error(f"Error al exportar {descripcion}: {e}")
+        await update.message.reply_text(f"❌ Error al exportar: {e}")
+    finally:
+        if ruta is not None:
+            with contextlib.suppress(OSError):
+                os.remove(ruta)
 
-            sheet.append_row([
-                fecha_registro,
-                user.first_name,
-                tipo_recibo,
-                categoria_final, # La categoría inferida por Gemini o un default
-                f"Gasto por recibo: {categoria_recibo}", # Una descripción más detallada
-                monto_recibo,
-                datetime.now().strftime("%B %Y")  # Usar siempre la fecha actual para el mes
-            ])
+async def presupuesto_command(update: Update, context: CallbackContext) -> None:
+    """Presupuestos del mes desde los contadores: /presupuesto, o /presupuesto CONCEPTO MONTO para fijar uno"""
+    user_id = update.effective_user.id
+    if user_id not in users_db:
+        await update.message.reply_text("Primero crea tu perfil con /start.")
+        return
 
+    args = context.args or []
+    if args:
+        monto = parsear_importe(args[-1]) if len(args) > 1 else None
+        concepto = clasificar_por_reglas(descripcion_base(" ".join(args[:-1])), "GASTO") if monto is not None else None
+        if concepto is None or monto < 0:
             await update.message.reply_text(
-                f"✅ Recibo analizado y registrado:\n\n"
-                f"📅 Fecha: {fecha_registro}\n"
-                f"💰 Monto: S/. {monto_recibo}\n"
-                f"🏷️ Categoría sugerida: {categoria_recibo}\n"
-                f"Puedes usar /start para un registro más detallado."
+                "Uso: /presupuesto CONCEPTO MONTO, por ejemplo /presupuesto alimentos 800 (0 para quitarlo)"
             )
+            return
+        presupuestos = dict(presupuestos_de(user_id))
+        if monto:
+            presupuestos[concepto] = monto
         else:
-            await update.message.reply_text("❌ No se pudo conectar con la hoja de cálculo para registrar el recibo.")
+            presupuestos.pop(concepto, None)
+        users_db.actualizar(user_id, presupuestos=presupuestos)
+        await update.message.reply_text(
+            f"✅ Presupuesto de {concepto}: S/. {monto:.2f} al mes." if monto else f"✅ Quité el presupuesto de {concepto}."
+        )
+        return
 
-    except json.JSONDecodeError:
-        logger.error(f"Error al decodificar JSON de Gemini Vision: {response.text}")
-        await update.message.reply_text("❌ No pude extraer la información del recibo. ¿Es una imagen clara de un recibo?")
-    except Exception as e:
-        logger.error(f"Error al procesar recibo con Gemini: {e}")
-        await update.message.reply_text(f"❌ Ocurrió un error al procesar la imagen: {e}")
+    presupuestos = presupuestos_de(user_id)
+    if not presupuestos:
+        await update.message.reply_text(
+            "No tienes presupuestos. Fija uno con /presupuesto CONCEPTO MONTO, por ejemplo /presupuesto alimentos 800"
+        )
+        return
+    mes = datetime.now().strftime("%B %Y")
+    lineas = [f"🎯 Presupuestos de {mes}\n"]
+    for concepto, limite in sorted(presupuestos.items()):
+        gastado = almacen.contador("gastos_mes", clave_gasto_mes(user_id, mes, concepto))
+        porcentaje = gastado / limite * 100 if limite else 0
+        icono = "🚨" if porcentaje >= 100 else "⚠️" if porcentaje >= 80 else "✅"
+        lineas.append(f"{icono} {concepto}: S/. {gastado:.2f} de S/. {limite:.2f} ({porcentaje:.0f}%)")
+    await update.message.reply_text("\n".join(lineas))
+
+USO_FAMILIA = (
+    "Uso:\n"
+    "/familia - Ver tu familia y su libro\n"
+    "/familia crear URL_DEL_SPREADSHEET - Crear una familia que registra en ese libro\n"
+    "/familia unir CÓDIGO - Unirte a la familia de ese código\n"
+    "/familia salir - Volver al libro por defecto"
+)
+
+async def familia_command(update: Update, context: CallbackContext) -> None:
+    """Familia del usuario y su libro: /familia, /familia crear URL, /familia unir CÓDIGO, /familia salir"""
+    user = update.effective_user
+    if user.id not in users_db:
+        await update.message.reply_text("Primero crea tu perfil con /start.")
+        return
+
+    args = context.args or []
+    accion = args[0].lower() if args else ""
+    if not accion:
+        familia_id = users_db[user.id].get("familia_id")
+        familia = families_db.get(familia_id) if familia_id is not None else None
+        if familia is None:
+            await update.message.reply_text("No perteneces a ninguna familia; registras en el libro por defecto.\n\n"
+                                            + USO_FAMILIA)
+            return
+        await update.message.reply_text(
+            f"👪 {familia['nombre']}\n"
+            f"📗 Libro: {familia['spreadsheet']}\n"
+            f"🔑 Código para invitar: {familia_id}"
+        )
+        return
+
+    if accion == "crear" and len(args) > 1:
+        libro = libro_desde_texto(" ".join(args[1:]))
+        # El libro tiene que estar compartido con la cuenta de servicio del bot
+        try:
+            await ejecutor_sheets.ejecutar(listar_hojas_registro, libro)
+        except Exception as e:
+            logger.warning(f"{user.first_name} no pudo crear una familia con el libro '{libro}': {e}")
+            await update.message.reply_text(
+                "❌ No pude abrir ese libro. Compártelo (como editor) con la cuenta de servicio del bot y "
+                "vuelve a intentarlo."
+            )
+            return
+        codigo = crear_familia(user.id, f"Familia de {user.first_name}", libro)
+        await update.message.reply_text(
+            f"✅ Familia creada. Tus registros irán a ese libro.\n"
+            f"Comparte este código con tu familia para que se una: /familia unir {codigo}"
+        )
+    elif accion == "unir" and len(args) == 2:
+        familia = unir_a_familia(user.id, args[1])
+        if familia is None:
+            await update.message.reply_text("❌ No encontré una familia con ese código.")
+            return
+        await update.message.reply_text(f"✅ Te uniste a {familia['nombre']}. Tus registros irán a su libro.")
+    elif accion == "salir":
+        users_db.actualizar(user.id, familia_id=None)
+        await update.message.reply_text("✅ Saliste de tu familia; tus registros irán al libro por defecto.")
+    else:
+        await update.message.reply_text(USO_FAMILIA)
 
+async def estado_command(update: Update, context: CallbackContext) -> None:
+    """Muestra el estado de los backends (cuotas, interruptores y colas)"""
+    await update.message.reply_text(
+        "🩺 Estado de los servicios:\n\n" + json.dumps(estado_backends(), indent=2, ensure_ascii=False)
+    )
 
 async def cancelar(update: Update, context: CallbackContext) -> int:
     """Cancela la conversación"""
@@ -688,81 +4140,454 @@ async def ayuda(update: Update, context: CallbackContext) -> None:
         "🤖 *Bot de Economía Familiar* 🏡\n\n"
         "*Comandos disponibles:*\n"
         "/start - Iniciar el bot y registrar un movimiento\n"
+        "/ultimos [N] - Ver tus últimos N registros\n"
+        "/resumen [mes] - Ingresos, gastos y balance del mes\n"
+        "/exportar [mes] [tipo] [xlsx] - Descargar los registros en CSV o Excel\n"
+        "/presupuesto [concepto monto] - Ver o fijar tus presupuestos del mes\n"
+        "/familia - Crear una familia con su propio libro o unirte a una\n"
         "/ayuda - Mostrar este mensaje de ayuda\n\n"
         "*Registro rápido por texto:*\n"
         "Puedes escribir directamente en este formato:\n"
         "TIPO MONTO CONCEPTO\n\n"
         "*Ejemplos:*\n"
         "• INGRESO 1500 SUELDO\n"
-        "• GASTO 50 ALIMENTOS\n",
+        "• GASTO 50 ALIMENTOS\n"
+        "• gasté 30 en pasajes ayer\n\n"
+        "*Importar un extracto:*\n"
+        "Envía el extracto de tu banco en CSV o XLSX como archivo; te muestro un resumen antes de registrarlo.\n",
         parse_mode='Markdown'
     )
 
 async def error(update: Update, context: CallbackContext) -> None:
     """Maneja errores"""
     logger.warning(f'Update {update} causó el error {context.error}')
-    if update.message:
-        await update.message.reply_text("Ocurrió un error. Por favor, intenta de nuevo o contacta al administrador.")
+    if not isinstance(update, Update):
+        return
+    try:
+        if update.message:
+            await update.message.reply_text("Ocurrió un error. Por favor, intenta de nuevo o contacta al administrador.")
+    finally:
+        # Corta los grupos siguientes: el update no llega a marcar_update_atendido
+        raise ApplicationHandlerStop
 
-def main() -> None:
-    """Función principal"""
-    # --- CAMBIOS AQUÍ para configurar Webhooks ---
-    global gemini_text_model, gemini_vision_model
+async def post_init(application: Application) -> None:
+    """Se ejecuta dentro del event loop antes de empezar a recibir updates."""
+    await asyncio.to_thread(cola_registros.cargar_pendientes)
+    # Las filas del journal que no llegaron a la copia local antes de una caída
+    for id_journal, fila, destino in cola_registros.entradas_pendientes():
+        libro_local.insertar(id_journal, fila, destino)
+    cola_registros.iniciar()
+    cola_recibos.iniciar()
+    application.bot_data["tarea_precalentamiento"] = asyncio.get_running_loop().create_task(
+        precalentar_conexiones(application))
+    registrar_etapa_arranque("post_init")
 
-    # 1. Obtener TOKEN del bot de variables de entorno (OBLIGATORIO para seguridad)
-    TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-    if not TOKEN:
-        logger.error("Error: La variable de entorno TELEGRAM_BOT_TOKEN no está configurada.")
-        logger.error("Por favor, configura tu token de bot de Telegram en Render como una variable de entorno.")
-        # Es crucial que el bot no se inicie sin el token
-        raise ValueError("TELEGRAM_BOT_TOKEN no configurado.")
-    
-    GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-    if not GEMINI_API_KEY:
-        logger.error("Error: La variable de entorno GEMINI_API_KEY no está configurada.")
-        raise ValueError("GEMINI_API_KEY no configurada.")
-    genai.configure(api_key=GEMINI_API_KEY)
-     # --- AÑADE ESTA LÍNEA PARA VERIFICAR ---
-    logger.info(f"GEMINI_API_KEY cargada (solo los primeros 5 caracteres): {GEMINI_API_KEY[:5]}*****")
-    # --- FIN DE LA LÍNEA DE VERIFICACIÓN ---
-    # Puedes definir el modelo aquí o en la función donde lo uses
-    #model_text = genai.GenerativeModel('gemini-pro') 
-    #model_vision = genai.GenerativeModel('gemini-pro-vision')
-    #gemini_text_model = genai.GenerativeModel('gemini-pro')
+async def _precalentar(nombre, corutina, tiempos):
+    inicio = time.perf_counter()
+    try:
+        await corutina
+    except Exception as e:
+        logger.warning(f"No se pudo precalentar {nombre}; se conectará en el primer uso: {e}")
+    tiempos[nombre] = time.perf_counter() - inicio
 
-    gemini_text_model = genai.GenerativeModel('gemini-1.5-flash')
-    
-    if os.getenv("ENABLE_RECEIPT_PROCESSING", "False").lower() == "true":
-        gemini_vision_model = genai.GenerativeModel('gemini-1.5-flash')
-    else:
-        gemini_vision_model = None
+async def _precalentar_sheets():
+    # La hoja del mes del libro por defecto, donde irá el primer registro
+    hoja = await ejecutor_sheets.ejecutar(conectar_google_sheets, hoja_del_mes(datetime.now().strftime("%B %Y")),
+                                          None, True)
+    if hoja is None:
+        raise ConnectionError("no se pudo abrir la hoja del mes")
 
+async def precalentar_conexiones(application):
+    """
+    Cuando el webhook ya escucha, abre en paralelo Google Sheets, el SDK de Gemini y el pool de
+    recibos, y arranca la sincronización periódica. Así el puerto se abre cuanto antes y el primer
+    update no espera a ninguna de las conexiones.
+    """
+    # post_init corre antes de que se levante el servidor, que escucha antes de application.start()
+    while not application.running:
+        await asyncio.sleep(0.05)
+    registrar_etapa_arranque("webhook escuchando" if TRABAJADORES == 1 else "trabajador listo")
+    logger.info(f"Arranque: {resumen_arranque()}")
+    application.bot_data["tarea_sync"] = asyncio.get_running_loop().create_task(_bucle_sincronizacion())
 
-    # Para el modelo de visión, solo inicializa si ENABLE_RECEIPT_PROCESSING está activado
-    if os.getenv("ENABLE_RECEIPT_PROCESSING", "False").lower() == "true":
-        gemini_vision_model = genai.GenerativeModel('gemini-1.5-flash')
-    else:
-        gemini_vision_model = None # Asegurarse de que sea None si no se usa
+    tiempos = {}
+    tareas = [_precalentar("sheets", _precalentar_sheets(), tiempos),
+              _precalentar("gemini", modelo_gemini(), tiempos)]
+    if RECIBOS_ACTIVADOS:
+        tareas += [_precalentar("gemini visión", modelo_gemini(vision=True), tiempos),
+                   _precalentar("recibos", cola_recibos.precalentar(), tiempos)]
+    await asyncio.gather(*tareas)
+    registrar_etapa_arranque("precalentamiento")
+    logger.info("Precalentamiento: " + ", ".join(f"{nombre} {segundos:.2f}s" for nombre, segundos in tiempos.items())
+                + f" (conexiones listas a los {ETAPAS_ARRANQUE['precalentamiento']:.2f}s del arranque)")
 
-    # 2. Obtener el puerto que Render asigna a tu aplicación (OBLIGATORIO para Web Services)
-    PORT = int(os.environ.get("PORT", "8080")) # Default a 8080 si no se especifica (aunque Render lo debería dar)
+async def post_shutdown(application: Application) -> None:
+    """Envía lo que quede en la cola antes de apagar el proceso."""
+    for nombre in ("tarea_sync", "tarea_precalentamiento"):
+        tarea = application.bot_data.pop(nombre, None)
+        if tarea is not None:
+            tarea.cancel()
+    await cola_recibos.detener()
+    await cola_registros.detener()
+    libro_local.cerrar()
+    logger.info(f"Cache de extracciones: {cache_extracciones.estadisticas()}")
+    ejecutor_sheets.cerrar()
+    ejecutor_gemini.cerrar()
 
-    # 3. Obtener la URL externa de tu servicio en Render (Render la inyecta automáticamente)
-    WEBHOOK_URL = os.getenv("RENDER_EXTERNAL_URL")
-    if not WEBHOOK_URL:
-        logger.error("Error: La variable de entorno RENDER_EXTERNAL_URL no está configurada.")
-        logger.error("Asegúrate de que tu servicio en Render sea un 'Web Service'.")
-        raise ValueError("RENDER_EXTERNAL_URL no configurada.")
+async def descartar_update_repetido(update: Update, context: CallbackContext) -> None:
+    """
+    Grupo -1, antes que cualquier otro handler: si Telegram reentrega un update que ya se atendió
+    (no recibió el 200 a tiempo), el update_id está marcado y se corta aquí.
+    """
+    if almacen.marcado("updates", update.update_id):
+        logger.info(f"Update {update.update_id} repetido por Telegram; se ignora.")
+        metricas.incrementar("contabot_duplicados_descartados_total", origen="update")
+        raise ApplicationHandlerStop
 
-    # 4. Definir una ruta secreta para el webhook. Se recomienda usar el TOKEN del bot.
-    WEBHOOK_PATH = TOKEN # O puedes usar algo como "mi_ruta_secreta_para_webhook"
+GRUPO_UPDATE_ATENDIDO = 100  # Después de todos los grupos de handlers
+
+async def marcar_update_atendido(update: Update, context: CallbackContext) -> None:
+    """
+    Último grupo: el update se marca solo cuando todos los handlers terminaron bien. Si uno falla
+    (el manejador de errores corta los grupos siguientes) o el proceso muere a mitad, la
+    reentrega de Telegram se vuelve a procesar. Dos entregas simultáneas del mismo update las
+    frenan las claves de cada fila y de cada confirmación (ver guardar_registro).
+
+    Antes se guarda el estado de las conversaciones: usuario_data se escribe en el almacén al
+    momento, y si el paso de la conversación esperara al intervalo de la persistencia, un
+    reinicio dejaría a las dos desalineadas. Solo se escriben las conversaciones que cambiaron.
+    """
+    await context.application.update_persistence()
+    almacen.marcar_una_vez("updates", update.update_id, IDEMPOTENCIA_TTL)
+
+# Modo multiproceso
+# Con WEBHOOK_WORKERS > 1, el proceso principal recibe el webhook y reparte cada update a un
+# trabajador según el libro (la familia) del usuario: todas las escrituras y lecturas de un libro
+# pasan por el mismo proceso, así /resumen, /ultimos y "ver último" leen una copia local que ya
+# tiene las filas de toda la familia, y cada trabajador sincroniza solo sus libros. Dentro del
+# trabajador, los updates de un usuario se atienden en orden (ver AplicacionOrdenada): que la
+# cola sea FIFO no basta con concurrent_updates. Los perfiles, las conversaciones y el estado de
+# los ConversationHandler viven en el almacén compartido; el journal y la copia local del libro
+# son de cada trabajador. Si un usuario cambia de familia, su libro nuevo puede ser de otro
+# trabajador, que lo descubre en la siguiente sincronización (hasta INTERVALO_SYNC).
+CAMPOS_CON_REMITENTE = ("message", "edited_message", "callback_query", "inline_query", "chosen_inline_result",
+                        "shipping_query", "pre_checkout_query", "poll_answer", "my_chat_member", "chat_member",
+                        "chat_join_request")
+
+def trabajador_de_libro(libro, trabajadores=None):
+    """Índice del trabajador dueño de un libro; estable entre procesos y reinicios (no usa hash())."""
+    return zlib.crc32(libro.encode("utf-8")) % (trabajadores or TRABAJADORES)
+
+def es_libro_propio(libro):
+    """True si este proceso atiende el libro (siempre, fuera del modo multiproceso)."""
+    return TRABAJADOR is None or trabajador_de_libro(libro) == int(TRABAJADOR)
+
+def trabajador_de_update(datos, trabajadores):
+    """Índice del trabajador de un update (JSON de Telegram): el dueño del libro del usuario."""
+    for campo in CAMPOS_CON_REMITENTE:
+        contenido = datos.get(campo)
+        if contenido:
+            remitente = contenido.get("from") or contenido.get("user")
+            if remitente:
+                return trabajador_de_libro(libro_de_usuario(remitente["id"]), trabajadores)
+    # Updates sin usuario (publicaciones de canales, encuestas): no hay orden que cuidar
+    return datos.get("update_id", 0) % trabajadores
+
+def adoptar_journals(trabajadores):
+    """
+    Pasa las filas de journals que ya no tienen dueño a uno vigente: el journal único al
+    trabajador 0 al activar el modo multiproceso, los de trabajadores sobrantes al bajar
+    WEBHOOK_WORKERS y todos al journal único al volver a un solo proceso.
+    """
+    directorio = os.path.dirname(RUTA_JOURNAL) or "."
+    base, extension = os.path.splitext(os.path.basename(RUTA_JOURNAL))
+    patron = re.compile(re.escape(base) + r"(?:\.trabajador(\d+))?" + re.escape(extension) + "$")
+    if not os.path.isdir(directorio):
+        return
+    for nombre in os.listdir(directorio):
+        coincidencia = patron.match(nombre)
+        if coincidencia is None:
+            continue
+        indice = coincidencia.group(1)
+        if trabajadores == 1:
+            if indice is None:
+                continue
+            destino = RUTA_JOURNAL
+        else:
+            if indice is not None and int(indice) < trabajadores:
+                continue
+            destino = ruta_de_trabajador(RUTA_JOURNAL, int(indice or 0) % trabajadores)
+        origen = os.path.join(directorio, nombre)
+        with open(origen, encoding="utf-8") as f:
+            contenido = f.read()
+        # La línea en blanco separa de una posible última línea a medio escribir del destino
+        with open(destino, "a", encoding="utf-8") as f:
+            f.write("\n" + contenido)
+            f.flush()
+            os.fsync(f.fileno())
+        os.remove(origen)
+        logger.warning(f"Journal {origen} incorporado a {destino}.")
+
+def ejecutar_webhook(application, puerto, webhook_url, webhook_path):
+    """Modo de un proceso: sirve el webhook, /metrics y /healthz y procesa los updates."""
+    asyncio.run(_servir_webhook(application, puerto, webhook_url, webhook_path))
+
+async def _servir_webhook(application, puerto, webhook_url, webhook_path):
+    loop = asyncio.get_running_loop()
+    detener = asyncio.Event()
+    for senal in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(senal, detener.set)
+
+    await application.initialize()
+    await post_init(application)
+    servidor = tornado.web.Application([
+        (rf"/{re.escape(webhook_path)}/?", WebhookHandler, {"aplicacion": application}),
+        (r"/metrics/?", MetricasHandler),
+        (r"/healthz/?", SaludHandler),
+    ]).listen(puerto, address="0.0.0.0")
+    await application.start()
+    await application.bot.set_webhook(url=f"{webhook_url}/{webhook_path}")
+    logger.info(f"Bot iniciado con webhook en: {webhook_url}/{webhook_path}")
+    logger.info(f"Escuchando en puerto: {puerto}")
+
+    await detener.wait()
+    servidor.stop()
+    await application.stop()
+    await post_shutdown(application)
+    await application.shutdown()
+
+def ejecutar_trabajador(indice, cola, token, puerto_monitoreo):
+    """Proceso trabajador: una Application sin Updater que procesa los updates de su cola."""
+    logger.info(f"Trabajador {indice} iniciado (pid {os.getpid()}).")
+    application = construir_aplicacion(token)
+    asyncio.run(_servir_trabajador(application, cola, puerto_monitoreo))
+
+async def _servir_trabajador(application, cola, puerto_monitoreo):
+    loop = asyncio.get_running_loop()
+    detener = asyncio.Event()
+    for senal in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(senal, detener.set)
+
+    await application.initialize()
+    await post_init(application)
+    await application.start()
+    # /metrics y /healthz de cada trabajador, solo en la interfaz local
+    monitoreo = tornado.web.Application(
+        [(r"/metrics/?", MetricasHandler), (r"/healthz/?", SaludHandler)]
+    ).listen(puerto_monitoreo, address="127.0.0.1")
+
+    def entregar(datos):
+        application.update_queue.put_nowait(Update.de_json(json.loads(datos), application.bot))
+
+    def leer_cola():
+        # multiprocessing.Queue.get bloquea: se lee en un hilo y se pasa al event loop en orden
+        while True:
+            datos = cola.get()
+            if datos is None:
+                loop.call_soon_threadsafe(detener.set)
+                return
+            loop.call_soon_threadsafe(entregar, datos)
+
+    threading.Thread(target=leer_cola, name="lector-updates", daemon=True).start()
+    await detener.wait()
+
+    monitoreo.stop()
+    await application.stop()
+    await post_shutdown(application)
+    await application.shutdown()
+
+metricas_enrutador = Metricas()
+metricas_enrutador.describir("contabot_enrutador_updates_total", "counter", "Updates enviados a cada trabajador")
+metricas_enrutador.describir("contabot_enrutador_reinicios_total", "counter", "Trabajadores relanzados tras caerse")
+
+class EnrutadorTrabajadores:
+    """Procesos trabajadores con una cola cada uno; relanza los que se caen."""
+
+    def __init__(self, trabajadores, token, puerto_monitoreo):
+        self.token = token
+        self.puerto_monitoreo = puerto_monitoreo
+        self._contexto = multiprocessing.get_context("spawn")
+        self.colas = [self._contexto.Queue() for _ in range(trabajadores)]
+        self.procesos = [None] * trabajadores
+        metricas_enrutador.medidor("contabot_enrutador_cola", "Updates esperando en la cola de cada trabajador",
+                                   lambda: [({"trabajador": str(i)}, self._en_cola(i)) for i in range(trabajadores)])
+        metricas_enrutador.medidor("contabot_enrutador_trabajador_vivo", "1 si el proceso trabajador está vivo",
+                                   lambda: [({"trabajador": str(i)}, int(p.is_alive()))
+                                            for i, p in enumerate(self.procesos)])
+
+    def _en_cola(self, indice):
+        try:
+            return self.colas[indice].qsize()
+        except NotImplementedError:  # macOS
+            return -1
+
+    def lanzar(self, indice):
+        # El índice viaja en el entorno: el trabajador lo necesita al importar el módulo,
+        # antes de crear el journal y la copia local
+        os.environ["CONTABOT_TRABAJADOR"] = str(indice)
+        try:
+            proceso = self._contexto.Process(
+                target=ejecutar_trabajador, name=f"contabot-trabajador-{indice}",
+                args=(indice, self.colas[indice], self.token, self.puerto_monitoreo + indice),
+            )
+            proceso.start()
+        finally:
+            del os.environ["CONTABOT_TRABAJADOR"]
+        self.procesos[indice] = proceso
 
+    def iniciar(self):
+        for indice in range(len(self.procesos)):
+            self.lanzar(indice)
+
+    def enrutar(self, cuerpo):
+        """Deja el update (bytes JSON) en la cola de su trabajador y devuelve el índice."""
+        indice = trabajador_de_update(json.loads(cuerpo), len(self.colas))
+        self.colas[indice].put(cuerpo)
+        metricas_enrutador.incrementar("contabot_enrutador_updates_total", trabajador=str(indice))
+        return indice
+
+    def vigilar(self):
+        for indice, proceso in enumerate(self.procesos):
+            if not proceso.is_alive():
+                logger.error(f"El trabajador {indice} terminó (código {proceso.exitcode}); se relanza.")
+                metricas_enrutador.incrementar("contabot_enrutador_reinicios_total", trabajador=str(indice))
+                # Los updates que quedaron en su cola los atiende el nuevo proceso
+                self.lanzar(indice)
+
+    def detener(self, espera=30):
+        for cola in self.colas:
+            cola.put(None)
+        limite = time.monotonic() + espera
+        for proceso in self.procesos:
+            proceso.join(max(0, limite - time.monotonic()))
+            if proceso.is_alive():
+                logger.warning(f"{proceso.name} no terminó a tiempo; se fuerza la salida.")
+                proceso.terminate()
+
+    def estado(self):
+        return [{"trabajador": i, "pid": p.pid, "vivo": p.is_alive(), "en_cola": self._en_cola(i)}
+                for i, p in enumerate(self.procesos)]
+
+class WebhookEnrutadorHandler(tornado.web.RequestHandler):
+    def initialize(self, enrutador):
+        self.enrutador = enrutador
+
+    def post(self):
+        try:
+            self.enrutador.enrutar(self.request.body)
+        except (ValueError, AttributeError, TypeError) as e:
+            logger.warning(f"Update inválido recibido en el webhook: {e}")
+            self.set_status(400)
+
+class SaludEnrutadorHandler(tornado.web.RequestHandler):
+    def initialize(self, enrutador):
+        self.enrutador = enrutador
+
+    def get(self):
+        trabajadores = self.enrutador.estado()
+        caidos = [t["trabajador"] for t in trabajadores if not t["vivo"]]
+        self.set_status(503 if caidos else 200)
+        self.write({"estado": "error" if caidos else "ok", "trabajadores": trabajadores})
+
+def ejecutar_multiproceso(token, puerto, webhook_url, webhook_path):
+    """
+    Proceso principal del modo multiproceso: lanza los trabajadores y sirve el webhook, que
+    solo enruta. Los trabajadores exponen /metrics y /healthz en 127.0.0.1, en los puertos
+    siguientes a PORT (PORT+1 el trabajador 0, PORT+2 el 1...).
+    """
+    adoptar_journals(TRABAJADORES)
+    enrutador = EnrutadorTrabajadores(TRABAJADORES, token, puerto + 1)
+    enrutador.iniciar()
+    logger.info(f"Modo multiproceso: {TRABAJADORES} trabajadores.")
+    try:
+        asyncio.run(_servir_enrutador(enrutador, token, puerto, webhook_url, webhook_path))
+    finally:
+        enrutador.detener()
+
+async def _servir_enrutador(enrutador, token, puerto, webhook_url, webhook_path):
+    loop = asyncio.get_running_loop()
+    detener = asyncio.Event()
+    for senal in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(senal, detener.set)
+
+    servidor = tornado.web.Application([
+        (rf"/{re.escape(webhook_path)}/?", WebhookEnrutadorHandler, {"enrutador": enrutador}),
+        (r"/metrics/?", MetricasHandler, {"registro": metricas_enrutador}),
+        (r"/healthz/?", SaludEnrutadorHandler, {"enrutador": enrutador}),
+    ]).listen(puerto, address="0.0.0.0")
+    registrar_etapa_arranque("webhook escuchando")
+    logger.info(f"Arranque: {resumen_arranque()}")
+
+    bot = Bot(token, base_url=os.getenv("TELEGRAM_API_URL") or "https://api.telegram.org/bot")
+    async with bot:
+        await bot.set_webhook(url=f"{webhook_url}/{webhook_path}")
+    logger.info(f"Bot iniciado con webhook en: {webhook_url}/{webhook_path}")
+
+    vigilancia = tornado.ioloop.PeriodicCallback(enrutador.vigilar, 5000)
+    vigilancia.start()
+    await detener.wait()
+    vigilancia.stop()
+    servidor.stop()
+
+class AplicacionOrdenada(Application):
+    """
+    Application que atiende en paralelo a usuarios distintos pero los updates de un mismo usuario
+    de uno en uno y en orden de llegada. Con concurrent_updates, un botón pulsado dos veces y el
+    mensaje siguiente podían correr a la vez sobre usuario_data y el estado de la conversación.
+    python-telegram-bot 20.0 no tiene procesadores de updates por clave, así que se serializa en
+    process_update con un candado por usuario.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Un candado vive mientras algún update del usuario lo tiene o lo espera
+        self._candados_usuario = weakref.WeakValueDictionary()
+
+    def candado_de_usuario(self, user_id):
+        candado = self._candados_usuario.get(user_id)
+        if candado is None:
+            candado = asyncio.Lock()
+            self._candados_usuario[user_id] = candado
+        return candado
+
+    async def process_update(self, update):
+        usuario = update.effective_user if isinstance(update, Update) else None
+        if usuario is None:
+            return await super().process_update(update)
+        async with self.candado_de_usuario(usuario.id):
+            return await super().process_update(update)
+
+def construir_aplicacion(token):
+    """Application con persistencia, handlers e instrumentación; la usan main() y cada trabajador."""
     # Construye la aplicación del bot
     # Si te encuentras con problemas de 'Request' o 'URLInputFile', puedes añadir:
     # from telegram.request import Request
     # request = Request(con_proxy=False, pool_timeout=60.0)
     # application = Application.builder().token(TOKEN).request(request).build()
-    application = Application.builder().token(TOKEN).build()
+    # Procesar updates en paralelo: las llamadas lentas ya no bloquean a otros usuarios. Los de
+    # un mismo usuario siguen en orden (ver AplicacionOrdenada)
+    max_updates = int(os.getenv("MAX_UPDATES_CONCURRENTES", "32"))
+    builder = (
+        Application.builder()
+        .application_class(AplicacionOrdenada)
+        .token(token)
+        # Mismo tamaño de pool que el builder usa por defecto, con medición de cada llamada
+        .request(PeticionTelegramMedida(connection_pool_size=256))
+        .persistence(PersistenciaBot(almacen))
+        .concurrent_updates(max_updates)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    # Otra API de Telegram (un servidor Bot API propio o el falso de las pruebas de carga)
+    if os.getenv("TELEGRAM_API_URL"):
+        builder = builder.base_url(os.environ["TELEGRAM_API_URL"])
+    if os.getenv("TELEGRAM_FILE_URL"):
+        builder = builder.base_file_url(os.environ["TELEGRAM_FILE_URL"])
+    # Los updates llegan por un servidor tornado propio (ejecutar_webhook o el enrutador), no
+    # por el Updater: así /metrics y /healthz comparten puerto con el webhook sin tocar las
+    # clases internas de python-telegram-bot
+    builder = builder.updater(None)
+    application = builder.build()
     
     # Manejador de conversación para el registro de movimientos
     conv_handler = ConversationHandler(
@@ -778,15 +4603,27 @@ def main() -> None:
             ONBOARDING_START: [MessageHandler(filters.TEXT & ~filters.COMMAND, procesar_onboarding_inicial)],
             ONBOARDING_ROLE: [CallbackQueryHandler(confirmar_perfil_callback)],
         },
-        fallbacks=[CommandHandler('cancelar', cancelar)]
+        fallbacks=[CommandHandler('cancelar', cancelar)],
+        name="registro",
+        persistent=True,
     )
     
+    # Antes que la conversación: sus estados aceptan cualquier callback y se quedarían con estos botones
+    application.add_handler(CallbackQueryHandler(confirmar_importacion, pattern=r"^importar_"))
+    application.add_handler(CallbackQueryHandler(confirmar_recibo_repetido, pattern=r"^recibo_"))
     application.add_handler(conv_handler) # Añadir a application
     
     application.add_handler(MessageHandler(filters.PHOTO & ~filters.COMMAND, procesar_recibo_con_gemini))
+    application.add_handler(MessageHandler(filters.Document.ALL, importar_extracto))
     
     # Otros comandos explícitos
     application.add_handler(CommandHandler("ayuda", ayuda))# Añadir a application
+    application.add_handler(CommandHandler("ultimos", ultimos_command))
+    application.add_handler(CommandHandler("resumen", resumen_command))
+    application.add_handler(CommandHandler("exportar", exportar_command))
+    application.add_handler(CommandHandler("presupuesto", presupuesto_command))
+    application.add_handler(CommandHandler("familia", familia_command))
+    application.add_handler(CommandHandler("estado", estado_command))
     application.add_handler(CommandHandler("cancelar", cancelar)) # También como comando directo fuera de la conv.
 
     # Manejador para fotos (si lo implementas)
@@ -795,32 +4632,72 @@ def main() -> None:
     # Manejador para registro por texto
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, registrar_por_texto)) # Añadir a application
     
+    # Latencia y errores de todos los handlers registrados arriba
+    for handlers in application.handlers.values():
+        instrumentar_handlers(handlers)
+
+    # Fuera de la instrumentación: ApplicationHandlerStop no es un error del handler
+    application.add_handler(TypeHandler(Update, descartar_update_repetido), group=-1)
+    application.add_handler(TypeHandler(Update, marcar_update_atendido), group=GRUPO_UPDATE_ATENDIDO)
+
     # Manejador de errores
     application.add_error_handler(error) # Añadir a application
+    return application
+
+def main() -> None:
+    """Función principal"""
+    # --- CAMBIOS AQUÍ para configurar Webhooks ---
+    registrar_etapa_arranque("imports")
+
+    # 1. Obtener TOKEN del bot de variables de entorno (OBLIGATORIO para seguridad)
+    TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+    if not TOKEN:
+        logger.error("Error: La variable de entorno TELEGRAM_BOT_TOKEN no está configurada.")
+        logger.error("Por favor, configura tu token de bot de Telegram en Render como una variable de entorno.")
+        # Es crucial que el bot no se inicie sin el token
+        raise ValueError("TELEGRAM_BOT_TOKEN no configurado.")
+    
+    GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+    if not GEMINI_API_KEY:
+        logger.error("Error: La variable de entorno GEMINI_API_KEY no está configurada.")
+        raise ValueError("GEMINI_API_KEY no configurada.")
+     # --- AÑADE ESTA LÍNEA PARA VERIFICAR ---
+    logger.info(f"GEMINI_API_KEY cargada (solo los primeros 5 caracteres): {GEMINI_API_KEY[:5]}*****")
+    # --- FIN DE LA LÍNEA DE VERIFICACIÓN ---
+    # El SDK de Gemini, los modelos y la conexión con Sheets se preparan en segundo plano
+    # cuando el webhook ya escucha (ver precalentar_conexiones)
+
+    # 2. Obtener el puerto que Render asigna a tu aplicación (OBLIGATORIO para Web Services)
+    PORT = int(os.environ.get("PORT", "8080")) # Default a 8080 si no se especifica (aunque Render lo debería dar)
+
+    # 3. Obtener la URL externa de tu servicio en Render (Render la inyecta automáticamente)
+    WEBHOOK_URL = os.getenv("RENDER_EXTERNAL_URL")
+    if not WEBHOOK_URL:
+        logger.error("Error: La variable de entorno RENDER_EXTERNAL_URL no está configurada.")
+        logger.error("Asegúrate de que tu servicio en Render sea un 'Web Service'.")
+        raise ValueError("RENDER_EXTERNAL_URL no configurada.")
+
+    # 4. Definir una ruta secreta para el webhook. Se recomienda usar el TOKEN del bot.
+    WEBHOOK_PATH = TOKEN # O puedes usar algo como "mi_ruta_secreta_para_webhook"
+
+    if TRABAJADORES > 1:
+        ejecutar_multiproceso(TOKEN, PORT, WEBHOOK_URL, WEBHOOK_PATH)
+        return
+
+    adoptar_journals(1)
+    application = construir_aplicacion(TOKEN)
+    registrar_etapa_arranque("configuración")
     
     # Iniciar el bot con Webhooks
-    # Primero, asegúrate de que no haya un webhook antiguo configurado en Telegram
-    logger.info("Intentando eliminar cualquier webhook anterior.")
-	# Importante: set_webhook es una coroutine, pero se llama fuera de un async def,
-    # por lo que necesita ser "await" de alguna manera.
-    # En este contexto de main(), que no es async, python-telegram-bot
-    # lo maneja internamente al llamar run_webhook que inicia el bucle de eventos.
-    # Así que, por ahora, no es necesario 'await' aquí directamente.
-    application.bot.set_webhook(url=None) # Desactivar webhook si existe uno configurado previamente
+    # No hace falta borrar antes un webhook anterior: _servir_webhook llama a set_webhook con la
+    # URL nueva, que reemplaza a la que hubiera
 
     # Configurar el nuevo webhook con la URL de Render
     # 'listen' debe ser "0.0.0.0" para que Render pueda enrutar el tráfico
     # 'port' debe ser el puerto que Render asigna a tu aplicación (desde la variable de entorno)
     # 'url_path' es la parte final de la URL del webhook, se recomienda que sea secreta (ej. el token)
-    application.run_webhook(
-        listen="0.0.0.0",
-        port=PORT,
-        url_path=WEBHOOK_PATH,
-        webhook_url=f"{WEBHOOK_URL}/{WEBHOOK_PATH}"
-    )
-
-    logger.info(f"Bot iniciado con webhook en: {WEBHOOK_URL}/{WEBHOOK_PATH}")
-    logger.info(f"Escuchando en puerto: {PORT}")
+    # /metrics y /healthz se sirven desde el mismo puerto que el webhook
+    ejecutar_webhook(application, PORT, WEBHOOK_URL, WEBHOOK_PATH)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,14 @@
+"""
+Prueba de carga de extremo a extremo por el webhook.
+
+El generador levanta una API de Telegram falsa, arranca el bot (loadtest.servidor) con Sheets
+y Gemini falsos apuntando a ella, y envía updates JSON al webhook simulando familias que
+registran movimientos por el menú, por texto y con fotos de recibos. La latencia de cada paso
+se mide desde el POST del update hasta que el bot envía su respuesta final a la API falsa.
+
+    python -m loadtest.generador --usuarios 50 --tasas 1 2 5 10 20 --duracion 30
+"""
+
+# Los usuarios virtuales tienen ids consecutivos desde aquí; el servidor los da de alta
+ID_BASE_USUARIOS = 900_000_000
+TOKEN_PRUEBA = "123456:PRUEBA-DE-CARGA"
@@ -0,0 +1,331 @@
+"""
+Generador de carga: familias virtuales que registran movimientos por el webhook del bot.
+
+    python -m loadtest.generador [--usuarios 50] [--tasas 1 2 5 10 20] [--duracion 30]
+                                 [--mezcla menu=0.4,texto=0.5,foto=0.1]
+                                 [--slo-p95 2.0] [--max-errores 0.01] [--salida carga.json]
+                                 [--url http://127.0.0.1:8080/<token>]   # bot ya arrancado
+
+Cada escalón lanza flujos con llegadas de Poisson a la tasa indicada (flujos por segundo). Un
+flujo ocupa a un usuario virtual libre; si no queda ninguno, la llegada se descarta, así que
+--usuarios es también la concurrencia máxima. El punto de saturación es el primer escalón en el
+que el rendimiento no alcanza el 90 % de lo ofrecido, el p95 supera el SLO o los errores pasan
+del máximo.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import random
+import signal
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+import httpx
+import tornado.httpserver
+
+from loadtest import ID_BASE_USUARIOS, TOKEN_PRUEBA
+from loadtest.telegram_falso import TelegramFalso, USUARIO_BOT
+
+# Respuestas intermedias: el bot todavía no terminó el paso
+PREFIJOS_PROVISIONALES = ("⏳", "📷")
+PREFIJOS_ERROR = ("❌", "Ocurrió un error")
+
+TEXTOS_RAPIDOS = [
+    "GASTO 50 ALIMENTOS",
+    "gasté 30 en pasajes ayer",
+    "INGRESO 1500 SUELDO",
+    "PAGUÉ {monto} POR UNAS COSITAS VARIAS",  # No lo entiende el parser local: va a Gemini
+]
+
+# Desde la hora actual: el bot descarta update_id ya vistos, también de corridas anteriores
+_ids = itertools.count(int(time.time() * 1000))
+
+class ErrorDePaso(Exception):
+    pass
+
+def _usuario_json(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"Usuario{user_id - ID_BASE_USUARIOS}",
+            "language_code": "es"}
+
+def _mensaje_json(user_id, **campos):
+    return {"message_id": next(_ids), "date": int(time.time()), "chat": {"id": user_id, "type": "private"},
+            "from": _usuario_json(user_id), **campos}
+
+def update_texto(user_id, texto):
+    campos = {"text": texto}
+    if texto.startswith("/"):
+        campos["entities"] = [{"type": "bot_command", "offset": 0, "length": len(texto.split()[0])}]
+    return {"update_id": next(_ids), "message": _mensaje_json(user_id, **campos)}
+
+def update_callback(user_id, data, mensaje_bot):
+    return {"update_id": next(_ids), "callback_query": {
+        "id": str(next(_ids)),
+        "from": _usuario_json(user_id),
+        "chat_instance": str(user_id),
+        "data": data,
+        "message": {**mensaje_bot, "from": USUARIO_BOT},
+    }}
+
+def update_foto(user_id):
+    file_id = f"recibo{next(_ids)}"
+    tamanos = [(320, 240), (800, 600), (1280, 960)]
+    fotos = [{"file_id": f"{file_id}_{ancho}", "file_unique_id": f"{file_id}_{ancho}", "width": ancho,
+              "height": alto, "file_size": ancho * alto // 10} for ancho, alto in tamanos]
+    return {"update_id": next(_ids), "message": _mensaje_json(user_id, photo=fotos)}
+
+class Medicion:
+    """Latencias por paso y por flujo, y conteo de errores, de un escalón."""
+
+    def __init__(self):
+        self.pasos = defaultdict(list)
+        self.flujos = defaultdict(list)
+        self.errores = defaultdict(int)
+        self.completados = 0
+        self.fallidos = 0
+        self.descartados = 0
+        self.lanzados = 0
+
+class Carga:
+    def __init__(self, args, telegram):
+        self.args = args
+        self.telegram = telegram
+        self.cliente = httpx.AsyncClient(timeout=args.timeout,
+                                         limits=httpx.Limits(max_connections=args.usuarios + 10))
+
+    async def paso(self, medicion, nombre, user_id, update):
+        """Envía un update y espera la respuesta final del bot al chat; devuelve ese mensaje."""
+        self.telegram.vaciar(user_id)
+        inicio = time.perf_counter()
+        respuesta = await self.cliente.post(self.args.url, json=update)
+        if respuesta.status_code != 200:
+            raise ErrorDePaso(f"webhook HTTP {respuesta.status_code}")
+        limite = inicio + self.args.timeout
+        while True:
+            restante = limite - time.perf_counter()
+            if restante <= 0:
+                raise ErrorDePaso("sin respuesta del bot")
+            try:
+                mensaje = await self.telegram.siguiente(user_id, restante)
+            except asyncio.TimeoutError:
+                raise ErrorDePaso("sin respuesta del bot")
+            if not mensaje["text"].startswith(PREFIJOS_PROVISIONALES):
+                break
+        medicion.pasos[nombre].append(time.perf_counter() - inicio)
+        if mensaje["text"].startswith(PREFIJOS_ERROR):
+            raise ErrorDePaso("el bot respondió con un error")
+        return mensaje
+
+    async def flujo_menu(self, medicion, user_id):
+        """start -> tipo -> categoría -> concepto -> monto -> confirmar, como en el ConversationHandler."""
+        menu = await self.paso(medicion, "start", user_id, update_texto(user_id, "/start"))
+        mensaje = await self.paso(medicion, "accion", user_id, update_callback(user_id, "registrar", menu))
+        mensaje = await self.paso(medicion, "tipo", user_id, update_callback(user_id, "GASTO", mensaje))
+        mensaje = await self.paso(medicion, "categoria", user_id, update_callback(user_id, "VARIABLE", mensaje))
+        await self.paso(medicion, "concepto", user_id, update_callback(user_id, "ALIMENTOS", mensaje))
+        resumen = await self.paso(medicion, "monto", user_id, update_texto(user_id, str(random.randint(5, 300))))
+        await self.paso(medicion, "confirmar", user_id, update_callback(user_id, "confirmar", resumen))
+
+    async def flujo_texto(self, medicion, user_id):
+        texto = random.choice(TEXTOS_RAPIDOS).format(monto=random.randint(5, 300))
+        await self.paso(medicion, "texto", user_id, update_texto(user_id, texto))
+
+    async def flujo_foto(self, medicion, user_id):
+        await self.paso(medicion, "foto", user_id, update_foto(user_id))
+
+    async def ejecutar_flujo(self, medicion, tipo, user_id, libres):
+        inicio = time.perf_counter()
+        try:
+            await getattr(self, f"flujo_{tipo}")(medicion, user_id)
+            medicion.flujos[tipo].append(time.perf_counter() - inicio)
+            medicion.completados += 1
+        except ErrorDePaso as e:
+            medicion.fallidos += 1
+            medicion.errores[f"{tipo}: {e}"] += 1
+        except httpx.HTTPError as e:
+            medicion.fallidos += 1
+            medicion.errores[f"{tipo}: {type(e).__name__}"] += 1
+        finally:
+            libres.put_nowait(user_id)
+
+    async def escalon(self, tasa):
+        medicion = Medicion()
+        libres = asyncio.Queue()
+        for i in range(self.args.usuarios):
+            libres.put_nowait(ID_BASE_USUARIOS + i)
+        tipos, pesos = zip(*self.args.mezcla.items())
+
+        tareas = []
+        inicio = time.perf_counter()
+        fin = inicio + self.args.duracion
+        proxima = inicio
+        while True:
+            proxima += random.expovariate(tasa)
+            if proxima >= fin:
+                break
+            await asyncio.sleep(max(0.0, proxima - time.perf_counter()))
+            medicion.lanzados += 1
+            try:
+                user_id = libres.get_nowait()
+            except asyncio.QueueEmpty:
+                medicion.descartados += 1
+                continue
+            tipo = random.choices(tipos, pesos)[0]
+            tareas.append(asyncio.create_task(self.ejecutar_flujo(medicion, tipo, user_id, libres)))
+        await asyncio.gather(*tareas)
+        return resumir_escalon(tasa, medicion, time.perf_counter() - inicio)
+
+    async def cerrar(self):
+        await self.cliente.aclose()
+
+def _percentiles(valores):
+    valores = sorted(valores)
+    if not valores:
+        return {"n": 0}
+    def p(q):
+        return valores[max(0, math.ceil(q / 100 * len(valores)) - 1)] * 1000
+    return {"n": len(valores), "p50_ms": p(50), "p95_ms": p(95), "p99_ms": p(99), "max_ms": valores[-1] * 1000}
+
+def resumir_escalon(tasa, medicion, segundos):
+    todos_los_pasos = [t for tiempos in medicion.pasos.values() for t in tiempos]
+    terminados = medicion.completados + medicion.fallidos
+    return {
+        "tasa_ofrecida": tasa,
+        "segundos": segundos,
+        "flujos_lanzados": medicion.lanzados,
+        "flujos_completados": medicion.completados,
+        "flujos_fallidos": medicion.fallidos,
+        "flujos_descartados": medicion.descartados,
+        "rendimiento_flujos_s": medicion.completados / segundos if segundos else 0.0,
+        "tasa_errores": (medicion.fallidos + medicion.descartados) / medicion.lanzados if medicion.lanzados else 0.0,
+        "errores": dict(medicion.errores),
+        "latencia_pasos": _percentiles(todos_los_pasos),
+        "latencia_por_paso": {nombre: _percentiles(t) for nombre, t in sorted(medicion.pasos.items())},
+        "latencia_por_flujo": {nombre: _percentiles(t) for nombre, t in sorted(medicion.flujos.items())},
+        "flujos_terminados": terminados,
+    }
+
+def saturado(resultado, args):
+    """True si el escalón ya no da abasto: rendimiento, latencia o errores fuera de lo aceptable."""
+    ofrecido = resultado["tasa_ofrecida"]
+    p95 = resultado["latencia_pasos"].get("p95_ms")
+    return (
+        resultado["rendimiento_flujos_s"] < 0.9 * ofrecido
+        or (p95 is not None and p95 > args.slo_p95 * 1000)
+        or resultado["tasa_errores"] > args.max_errores
+    )
+
+def _mezcla(texto):
+    mezcla = {}
+    for parte in texto.split(","):
+        tipo, peso = parte.split("=")
+        if tipo not in ("menu", "texto", "foto"):
+            raise argparse.ArgumentTypeError(f"flujo desconocido: {tipo}")
+        mezcla[tipo] = float(peso)
+    return mezcla
+
+def lanzar_bot(args):
+    comando = [sys.executable, "-m", "loadtest.servidor", "--puerto", str(args.puerto_bot),
+               "--telegram", f"http://127.0.0.1:{args.puerto_telegram}", "--usuarios", str(args.usuarios),
+               "--latencia-gemini", str(args.latencia_gemini), "--latencia-sheets", str(args.latencia_sheets)]
+    return subprocess.Popen(comando)
+
+async def esperar_bot(args, proceso, limite=60.0):
+    """Espera a que el servidor del webhook responda en /healthz."""
+    url = f"http://127.0.0.1:{args.puerto_bot}/healthz"
+    fin = time.perf_counter() + limite
+    async with httpx.AsyncClient(timeout=2.0) as cliente:
+        while time.perf_counter() < fin:
+            if proceso is not None and proceso.poll() is not None:
+                raise RuntimeError("El bot terminó antes de empezar a escuchar")
+            try:
+                await cliente.get(url)
+                return
+            except httpx.HTTPError:
+                await asyncio.sleep(0.5)
+    raise RuntimeError("El bot no empezó a escuchar a tiempo")
+
+async def ejecutar(args):
+    telegram = TelegramFalso(latencia=args.latencia_telegram)
+    servidor = tornado.httpserver.HTTPServer(telegram.aplicacion())
+    servidor.listen(args.puerto_telegram, "127.0.0.1")
+
+    proceso = None
+    if args.url is None:
+        args.url = f"http://127.0.0.1:{args.puerto_bot}/{TOKEN_PRUEBA}"
+        proceso = lanzar_bot(args)
+    carga = Carga(args, telegram)
+    resultados = []
+    try:
+        await esperar_bot(args, proceso)
+        for tasa in args.tasas:
+            print(f"Escalón de {tasa} flujos/s durante {args.duracion:.0f}s...", file=sys.stderr)
+            resultado = await carga.escalon(tasa)
+            resultados.append(resultado)
+            imprimir_escalon(resultado)
+            if args.parar_al_saturar and saturado(resultado, args):
+                break
+    finally:
+        await carga.cerrar()
+        servidor.stop()
+        if proceso is not None:
+            proceso.send_signal(signal.SIGINT)
+            try:
+                proceso.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                proceso.kill()
+
+    saturacion = next((r["tasa_ofrecida"] for r in resultados if saturado(r, args)), None)
+    sostenibles = [r for r in resultados if not saturado(r, args)]
+    return {
+        "configuracion": {k: v for k, v in vars(args).items() if k != "salida"},
+        "escalones": resultados,
+        "punto_saturacion_flujos_s": saturacion,
+        "maximo_sostenible_flujos_s": max((r["rendimiento_flujos_s"] for r in sostenibles), default=None),
+        "llamadas_telegram": dict(telegram.llamadas),
+    }
+
+def imprimir_escalon(r):
+    pasos = r["latencia_pasos"]
+    latencias = (f"p50 {pasos['p50_ms']:.0f} ms, p95 {pasos['p95_ms']:.0f} ms, p99 {pasos['p99_ms']:.0f} ms"
+                 if pasos["n"] else "sin pasos completados")
+    print(f"  {r['tasa_ofrecida']:>6.1f} flujos/s ofrecidos -> {r['rendimiento_flujos_s']:.2f} completados/s, "
+          f"{latencias}, errores {r['tasa_errores']:.1%}", file=sys.stderr)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Prueba de carga de ContaBot por el webhook")
+    parser.add_argument("--url", help="URL del webhook de un bot ya arrancado (si no, se lanza loadtest.servidor)")
+    parser.add_argument("--puerto-bot", type=int, default=8080)
+    parser.add_argument("--puerto-telegram", type=int, default=8081)
+    parser.add_argument("--usuarios", type=int, default=50, help="Usuarios virtuales (concurrencia máxima)")
+    parser.add_argument("--tasas", type=float, nargs="+", default=[1, 2, 5, 10, 20],
+                        help="Flujos por segundo de cada escalón")
+    parser.add_argument("--duracion", type=float, default=30.0, help="Segundos de llegadas por escalón")
+    parser.add_argument("--mezcla", type=_mezcla, default=_mezcla("menu=0.4,texto=0.5,foto=0.1"))
+    parser.add_argument("--timeout", type=float, default=30.0, help="Espera máxima por paso")
+    parser.add_argument("--slo-p95", type=float, default=2.0, help="p95 máximo aceptable por paso, en segundos")
+    parser.add_argument("--max-errores", type=float, default=0.01)
+    parser.add_argument("--parar-al-saturar", action="store_true")
+    parser.add_argument("--latencia-gemini", type=float, default=0.8)
+    parser.add_argument("--latencia-sheets", type=float, default=0.3)
+    parser.add_argument("--latencia-telegram", type=float, default=0.05)
+    parser.add_argument("--salida", help="Archivo JSON con los resultados")
+    args = parser.parse_args(argv)
+
+    informe = asyncio.run(ejecutar(args))
+    if informe["punto_saturacion_flujos_s"] is None:
+        print("No se alcanzó la saturación con las tasas probadas.", file=sys.stderr)
+    else:
+        print(f"Saturación a partir de {informe['punto_saturacion_flujos_s']} flujos/s "
+              f"(máximo sostenido: {informe['maximo_sostenible_flujos_s']} flujos/s).", file=sys.stderr)
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as f:
+            json.dump(informe, f, indent=2, ensure_ascii=False)
+    else:
+        print(json.dumps(informe, indent=2, ensure_ascii=False))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Arranca bot.py con Google Sheets y Gemini falsos y la API de Telegram apuntando al generador.
+
+    python -m loadtest.servidor --puerto 8080 --telegram http://127.0.0.1:8081 --usuarios 50
+
+Todo lo demás (webhook, handlers, colas, copia local, métricas) es el código de producción.
+"""
+import argparse
+import os
+import tempfile
+from datetime import datetime
+
+from benchmarks import fakes
+from loadtest import ID_BASE_USUARIOS, TOKEN_PRUEBA
+
+def _configurar_entorno(args, directorio):
+    os.environ.update({
+        "TELEGRAM_BOT_TOKEN": args.token,
+        "GEMINI_API_KEY": "clave-falsa",
+        "PORT": str(args.puerto),
+        "RENDER_EXTERNAL_URL": f"http://127.0.0.1:{args.puerto}",
+        "TELEGRAM_API_URL": f"{args.telegram}/bot",
+        "TELEGRAM_FILE_URL": f"{args.telegram}/file/bot",
+        "ENABLE_RECEIPT_PROCESSING": "true",
+    })
+    # Estas se pueden fijar desde fuera, por ejemplo para probar con las cuotas reales
+    os.environ.setdefault("CONTABOT_DB_PATH", os.path.join(directorio, "contabot.db"))
+    os.environ.setdefault("JOURNAL_PATH", os.path.join(directorio, "registros_pendientes.jsonl"))
+    os.environ.setdefault("ALMACEN_BACKEND", "memoria")
+    os.environ.setdefault("GEMINI_PETICIONES_POR_MINUTO", "1000000")
+    os.environ.setdefault("SHEETS_PETICIONES_POR_MINUTO", "1000000")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="ContaBot con backends falsos para pruebas de carga")
+    parser.add_argument("--puerto", type=int, default=8080)
+    parser.add_argument("--telegram", default="http://127.0.0.1:8081", help="URL de la API de Telegram falsa")
+    parser.add_argument("--token", default=TOKEN_PRUEBA)
+    parser.add_argument("--usuarios", type=int, default=50, help="Usuarios virtuales que se dan de alta")
+    parser.add_argument("--filas", type=int, default=1000, help="Filas iniciales de la hoja falsa")
+    parser.add_argument("--latencia-gemini", type=float, default=0.8)
+    parser.add_argument("--latencia-sheets", type=float, default=0.3)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix="contabot-carga-") as directorio:
+        _configurar_entorno(args, directorio)
+        import bot
+
+        # Con los modelos ya asignados el bot no llega a importar el SDK de Gemini
+        modelo = fakes.ModeloGeminiFalso(latencia=args.latencia_gemini)
+        bot.gemini_text_model = bot.gemini_vision_model = modelo
+        historico = fakes.HojaFalsa(bot.COLUMNAS_REGISTRO, fakes.generar_filas(args.filas),
+                                    latencia=args.latencia_sheets, title=bot.NOMBRE_HOJA_REGISTRO)
+        bot._libros_cache[bot.LIBRO_POR_DEFECTO] = fakes.LibroFalso(bot.LIBRO_POR_DEFECTO, [historico],
+                                                                    latencia=args.latencia_sheets)
+        # Usuarios ya registrados, para que /start vaya al menú y no al onboarding
+        for i in range(args.usuarios):
+            user_id = ID_BASE_USUARIOS + i
+            bot.users_db[user_id] = {
+                "telegram_id": user_id,
+                "nombre": f"Usuario{i}",
+                "rol_familiar": "adulto_solo",
+                "ingresos_estimados": 3000,
+                "prioridades": ["ahorro"],
+                "fecha_registro": datetime.now().isoformat(),
+                "familia_id": None,
+            }
+        bot.main()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+API de Bot de Telegram falsa (tornado) para las pruebas de carga.
+
+Responde a los métodos que usa el bot y deja cada mensaje enviado o editado en la cola del
+chat correspondiente, para que el generador sepa cuándo respondió el bot a cada paso.
+"""
+import asyncio
+import io
+import itertools
+import json
+import time
+from collections import defaultdict
+
+import tornado.web
+from PIL import Image
+
+USUARIO_BOT = {"id": 1, "is_bot": True, "first_name": "ContaBot", "username": "contabot_carga_bot",
+               "can_join_groups": False, "can_read_all_group_messages": False, "supports_inline_queries": False}
+TAMANO_FOTO = (1280, 960)
+
+def _imagen_recibo():
+    """JPEG de ruido: cada descarga es un recibo distinto para la detección de duplicados."""
+    buffer = io.BytesIO()
+    Image.effect_noise(TAMANO_FOTO, 64).convert("RGB").save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue()
+
+class TelegramFalso:
+    """Estado compartido de la API falsa: ids de mensajes y colas de respuestas por chat."""
+
+    def __init__(self, latencia=0.0):
+        self.latencia = latencia
+        self.llamadas = defaultdict(int)
+        self._ids_mensaje = itertools.count(1)
+        self._colas = defaultdict(asyncio.Queue)
+
+    def aplicacion(self):
+        return tornado.web.Application([
+            (r"/bot[^/]+/(\w+)", MetodoHandler, {"telegram": self}),
+            (r"/file/bot[^/]+/(.+)", ArchivoHandler, {"telegram": self}),
+        ])
+
+    def mensaje(self, chat_id, texto, message_id=None):
+        return {
+            "message_id": message_id or next(self._ids_mensaje),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": USUARIO_BOT,
+            "text": texto,
+        }
+
+    def registrar_salida(self, chat_id, mensaje):
+        self._colas[chat_id].put_nowait(mensaje)
+
+    def vaciar(self, chat_id):
+        """Descarta lo que el bot haya enviado a un chat antes del próximo paso."""
+        cola = self._colas[chat_id]
+        while not cola.empty():
+            cola.get_nowait()
+
+    async def siguiente(self, chat_id, timeout):
+        return await asyncio.wait_for(self._colas[chat_id].get(), timeout)
+
+class MetodoHandler(tornado.web.RequestHandler):
+    def initialize(self, telegram):
+        self.telegram = telegram
+
+    def _parametros(self):
+        if self.request.headers.get("Content-Type", "").startswith("application/json"):
+            return json.loads(self.request.body or b"{}")
+        return {clave: self.get_body_argument(clave) for clave in self.request.body_arguments}
+
+    async def post(self, metodo):
+        telegram = self.telegram
+        telegram.llamadas[metodo] += 1
+        if telegram.latencia:
+            await asyncio.sleep(telegram.latencia)
+        parametros = self._parametros()
+
+        if metodo == "getMe":
+            resultado = USUARIO_BOT
+        elif metodo == "sendMessage":
+            chat_id = int(parametros["chat_id"])
+            resultado = telegram.mensaje(chat_id, parametros.get("text", ""))
+            telegram.registrar_salida(chat_id, resultado)
+        elif metodo == "editMessageText":
+            chat_id = int(parametros["chat_id"])
+            resultado = telegram.mensaje(chat_id, parametros.get("text", ""), int(parametros["message_id"]))
+            telegram.registrar_salida(chat_id, resultado)
+        elif metodo == "getFile":
+            file_id = parametros["file_id"]
+            resultado = {"file_id": file_id, "file_unique_id": file_id, "file_size": 200_000,
+                         "file_path": f"photos/{file_id}.jpg"}
+        else:
+            # setWebhook, deleteWebhook, answerCallbackQuery, sendChatAction...
+            resultado = True
+        self.write({"ok": True, "result": resultado})
+
+    get = post
+
+class ArchivoHandler(tornado.web.RequestHandler):
+    def initialize(self, telegram):
+        self.telegram = telegram
+
+    async def get(self, ruta):
+        self.telegram.llamadas["descarga"] += 1
+        self.set_header("Content-Type", "image/jpeg")
+        self.write(await asyncio.to_thread(_imagen_recibo))
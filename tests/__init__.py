@@ -0,0 +1,6 @@
+"""
+Pruebas del bot, sin red: Gemini, Google Sheets y Telegram se sustituyen por los dobles de
+benchmarks/fakes.py.
+
+    python -m pytest tests
+"""
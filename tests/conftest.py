@@ -0,0 +1,43 @@
+import os
+import tempfile
+
+import pytest
+
+# El bot lee su configuración al importarse: rutas temporales y almacén en memoria
+_directorio = tempfile.mkdtemp(prefix="contabot-tests-")
+os.environ.setdefault("CONTABOT_DB_PATH", os.path.join(_directorio, "contabot.db"))
+os.environ.setdefault("JOURNAL_PATH", os.path.join(_directorio, "registros_pendientes.jsonl"))
+os.environ.setdefault("ALMACEN_BACKEND", "memoria")
+os.environ.setdefault("SHEETS_PETICIONES_POR_MINUTO", "1000000")
+os.environ.setdefault("GEMINI_PETICIONES_POR_MINUTO", "1000000")
+
+import bot  # noqa: E402
+from benchmarks import fakes  # noqa: E402
+
+
+@pytest.fixture
+def entorno(tmp_path, monkeypatch):
+    """
+    Almacén, perfiles, conversaciones, journal y copia local nuevos, y libros falsos sin latencia:
+    el por defecto y dos de familia. Devuelve {nombre del libro: LibroFalso}.
+    """
+    almacen = bot.AlmacenMemoria()
+    monkeypatch.setattr(bot, "almacen", almacen)
+    monkeypatch.setattr(bot, "users_db", bot.DiccionarioPersistente(almacen, "usuarios"))
+    monkeypatch.setattr(bot, "families_db", bot.DiccionarioPersistente(almacen, "familias"))
+    monkeypatch.setattr(bot, "usuario_data", bot.DiccionarioPersistente(almacen, "conversaciones"))
+    monkeypatch.setattr(bot, "libro_local", bot.LibroLocal(str(tmp_path / "libro.db")))
+    monkeypatch.setattr(bot, "cola_registros",
+                        bot.ColaRegistros(str(tmp_path / "journal.jsonl"), tamano_lote=50, intervalo=60))
+    # El semáforo del ejecutor queda atado al event loop de la prueba anterior
+    monkeypatch.setattr(bot.ejecutor_sheets, "_semaforo", None)
+    libros = {nombre: fakes.LibroFalso(nombre, latencia=0)
+              for nombre in (bot.LIBRO_POR_DEFECTO, "Libro Pérez", "Libro Rojas")}
+    for nombre, libro in libros.items():
+        monkeypatch.setitem(bot._libros_cache, nombre, libro)
+    bot._hojas_cache.clear()
+    for user_id, nombre in ((1, "Ana"), (2, "Luis"), (3, "Sofía")):
+        bot.users_db[user_id] = {"telegram_id": user_id, "nombre": nombre, "familia_id": None}
+    yield libros
+    bot._hojas_cache.clear()
+    bot.libro_local.cerrar()
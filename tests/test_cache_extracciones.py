@@ -0,0 +1,53 @@
+from datetime import datetime
+
+import pytest
+
+import bot
+
+HOY = datetime(2025, 5, 14)
+EXTRAIDO = {"tipo": "GASTO", "categoria": "VARIABLE", "concepto": "PASAJES", "monto": 12, "fecha": "actual"}
+
+
+@pytest.fixture
+def cache():
+    return bot.CacheExtracciones(max_entradas=100, ttl_segundos=3600)
+
+
+def test_mensaje_equivalente_reutiliza_la_extraccion_con_su_monto_y_fecha(cache):
+    cache.guardar("pague 12 soles de taxi al aeropuerto", EXTRAIDO, hoy=HOY)
+
+    datos = cache.obtener("ayer pague 30 soles de taxi al aeropuerto", hoy=HOY)
+
+    assert datos == {"tipo": "GASTO", "categoria": "VARIABLE", "concepto": "PASAJES",
+                     "monto": 30.0, "fecha": "13/05/2025"}
+    assert (cache.aciertos, cache.fallos) == (1, 0)
+
+
+def test_mensaje_distinto_no_acierta(cache):
+    cache.guardar("pague 12 soles de taxi al aeropuerto", EXTRAIDO, hoy=HOY)
+    assert cache.obtener("pague 12 soles de almuerzo", hoy=HOY) is None
+    assert cache.fallos == 1
+
+
+@pytest.mark.parametrize("mensaje, extraido", [
+    # Gemini tomó otro número como monto
+    ("pague 12 soles de taxi", dict(EXTRAIDO, monto=15)),
+    # Más de un monto en el mensaje
+    ("pague 12 y 3 soles de taxi", EXTRAIDO),
+    # Gemini resolvió una fecha que el parser local no entiende
+    ("pague 12 soles de taxi la semana pasada", dict(EXTRAIDO, fecha="07/05/2025")),
+    ("pague 12 soles de taxi", {"error": "no entendí"}),
+])
+def test_extracciones_no_reutilizables_no_se_guardan(cache, mensaje, extraido):
+    cache.guardar(mensaje, extraido, hoy=HOY)
+    assert cache.estadisticas()["entradas"] == 0
+
+
+def test_cambiar_los_conceptos_invalida_la_cache(cache, monkeypatch):
+    cache.guardar("pague 12 soles de taxi", EXTRAIDO, hoy=HOY)
+    assert cache.obtener("pague 20 soles de taxi", hoy=HOY) is not None
+
+    monkeypatch.setattr(bot, "CONCEPTOS_GASTOS", bot.CONCEPTOS_GASTOS + ["TAXI"])
+
+    assert cache.obtener("pague 20 soles de taxi", hoy=HOY) is None
+    assert cache.estadisticas()["entradas"] == 0
@@ -0,0 +1,43 @@
+import asyncio
+
+import bot
+
+
+def _fila(usuario, monto):
+    return ["14/05/2025 10:00:00", usuario, "GASTO", "VARIABLE", "PASAJES", monto, "May 2025"]
+
+
+def test_libro_desde_texto():
+    url = "https://docs.google.com/spreadsheets/d/1AbC-dEf_0123456789abcdefghijklmnopqrstu/edit#gid=0"
+    assert bot.libro_desde_texto(url) == "1AbC-dEf_0123456789abcdefghijklmnopqrstu"
+    assert bot.libro_desde_texto("  ECONOMIA DE LA CASA ") == "ECONOMIA DE LA CASA"
+
+
+def test_crear_y_unirse_a_una_familia(entorno):
+    codigo = bot.crear_familia(1, "Familia de Ana", "Libro Pérez")
+    assert bot.libro_de_usuario(1) == "Libro Pérez"
+    assert bot.libro_de_usuario(2) == bot.LIBRO_POR_DEFECTO
+
+    assert bot.unir_a_familia(2, codigo.lower())["spreadsheet"] == "Libro Pérez"
+    assert bot.libro_de_usuario(2) == "Libro Pérez"
+    assert bot.unir_a_familia(3, "NOEXISTE") is None
+    assert bot.libro_de_usuario(3) == bot.LIBRO_POR_DEFECTO
+    assert "Libro Pérez" in bot.libros_conocidos()
+
+
+def test_dos_familias_escriben_en_libros_distintos(entorno):
+    perez = bot.crear_familia(1, "Familia de Ana", "Libro Pérez")
+    bot.unir_a_familia(2, perez)
+    bot.crear_familia(3, "Familia de Sofía", "Libro Rojas")
+
+    async def escenario():
+        await bot.guardar_registro(_fila("Ana", 10), 1, "texto:1:1")
+        await bot.guardar_registro(_fila("Luis", 20), 2, "texto:2:1")
+        await bot.guardar_registro(_fila("Sofía", 30), 3, "texto:3:1")
+        assert await bot.cola_registros.vaciar()
+
+    asyncio.run(escenario())
+    hoja = bot.hoja_del_mes("May 2025")
+    assert [fila[5] for fila in entorno["Libro Pérez"].hojas[hoja].filas[1:]] == [10, 20]
+    assert [fila[5] for fila in entorno["Libro Rojas"].hojas[hoja].filas[1:]] == [30]
+    assert [r["Monto"] for r in bot.libro_local.ultimos_de("Libro Rojas", 3, 10)] == [30]
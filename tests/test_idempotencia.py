@@ -0,0 +1,103 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+
+import bot
+from benchmarks import fakes
+
+DATOS_REGISTRO = {"usuario": "Ana", "tipo": "GASTO", "categoria": "VARIABLE", "concepto": "PASAJES", "monto": 5.0}
+
+
+def _filas_del_mes(entorno):
+    hoja = entorno[bot.LIBRO_POR_DEFECTO].hojas.get(bot.hoja_del_mes(datetime.now().strftime("%B %Y")))
+    return hoja.filas[1:] if hoja else []
+
+
+def _toques(telegram, usuario, data, veces):
+    """`veces` callbacks con el mismo data sobre el mismo mensaje, como un doble toque."""
+    primero = fakes.crear_update_callback(telegram, usuario, data)
+    updates = [primero]
+    for _ in range(veces - 1):
+        query = fakes.CallbackQueryFalso(telegram, usuario, data)
+        query.message = primero.callback_query.message
+        updates.append(fakes._update(usuario, callback_query=query))
+    return updates
+
+
+def test_doble_toque_en_confirmar_registra_una_sola_fila(entorno):
+    telegram = fakes.TelegramFalso()
+    usuario = fakes.crear_usuario(1, "Ana")
+    bot.usuario_data[1] = dict(DATOS_REGISTRO)
+
+    async def escenario():
+        for update in _toques(telegram, usuario, "confirmar", 2):
+            assert await bot.confirmar(update, fakes.crear_contexto()) == bot.ConversationHandler.END
+        assert await bot.cola_registros.vaciar()
+
+    asyncio.run(escenario())
+    assert len(_filas_del_mes(entorno)) == 1
+    assert 1 not in bot.usuario_data
+
+
+def test_confirmar_se_puede_reintentar_si_falla_el_guardado(entorno, monkeypatch):
+    telegram = fakes.TelegramFalso()
+    usuario = fakes.crear_usuario(1, "Ana")
+    bot.usuario_data[1] = dict(DATOS_REGISTRO)
+    encolar = bot.cola_registros.encolar
+
+    async def disco_lleno(*args, **kwargs):
+        raise OSError("No queda espacio en el disco")
+
+    async def escenario():
+        primero, segundo = _toques(telegram, usuario, "confirmar", 2)
+        monkeypatch.setattr(bot.cola_registros, "encolar", disco_lleno)
+        assert await bot.confirmar(primero, fakes.crear_contexto()) == bot.CONFIRMAR
+        assert primero.callback_query.message.ediciones[-1].startswith("❌")
+        # Los datos siguen ahí y el botón vuelve a funcionar
+        assert bot.usuario_data[1] == DATOS_REGISTRO
+        monkeypatch.setattr(bot.cola_registros, "encolar", encolar)
+        assert await bot.confirmar(segundo, fakes.crear_contexto()) == bot.ConversationHandler.END
+        assert segundo.callback_query.message.ediciones[-1].startswith("✅")
+        assert await bot.cola_registros.vaciar()
+
+    asyncio.run(escenario())
+    assert len(_filas_del_mes(entorno)) == 1
+    assert 1 not in bot.usuario_data
+
+
+def test_cancelar_no_registra(entorno):
+    telegram = fakes.TelegramFalso()
+    bot.usuario_data[1] = dict(DATOS_REGISTRO)
+    update = fakes.crear_update_callback(telegram, fakes.crear_usuario(1, "Ana"), "cancelar")
+
+    asyncio.run(bot.confirmar(update, fakes.crear_contexto()))
+    assert bot.cola_registros.pendientes == 0
+    assert 1 not in bot.usuario_data
+
+
+class _AplicacionFalsa:
+    def __init__(self):
+        self.persistencias = 0
+
+    async def update_persistence(self):
+        self.persistencias += 1
+
+
+def test_update_reentregado_se_descarta_solo_si_se_atendio(entorno):
+    telegram = fakes.TelegramFalso()
+    update = fakes.crear_update_texto(telegram, fakes.crear_usuario(1, "Ana"), "gasto 5 pasajes")
+    contexto = fakes.crear_contexto()
+    contexto.application = _AplicacionFalsa()
+
+    async def escenario():
+        # Primera entrega: pasa el filtro; si un handler fallara, no se marca y la reentrega pasa
+        await bot.descartar_update_repetido(update, contexto)
+        await bot.descartar_update_repetido(update, contexto)
+
+        await bot.marcar_update_atendido(update, contexto)
+        with pytest.raises(bot.ApplicationHandlerStop):
+            await bot.descartar_update_repetido(update, contexto)
+
+    asyncio.run(escenario())
+    assert contexto.application.persistencias == 1
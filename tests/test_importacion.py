@@ -0,0 +1,99 @@
+from datetime import datetime
+
+import pytest
+
+import bot
+
+
+@pytest.mark.parametrize("valor, esperado", [
+    ("1,234.50", 1234.5),
+    ("1.234,50", 1234.5),
+    ("12,50", 12.5),
+    ("1,234", 1234.0),
+    ("-45", -45.0),
+    ("(45.00)", -45.0),
+    ("45.00-", -45.0),
+    ("S/ 12", 12.0),
+    (7, 7.0),
+    ("", None),
+    ("n/a", None),
+])
+def test_parsear_importe(valor, esperado):
+    assert bot.parsear_importe(valor) == esperado
+
+
+@pytest.mark.parametrize("valor", ["14/05/2025", "14-05-25", "2025-05-14", "2025-05-14T08:30:00", "14/05/2025 08:30"])
+def test_parsear_fecha_extracto(valor):
+    assert bot.parsear_fecha_extracto(valor).date() == datetime(2025, 5, 14).date()
+
+
+def test_csv_de_banco_con_cabecera_cargos_y_abonos(tmp_path):
+    ruta = tmp_path / "extracto.csv"
+    ruta.write_bytes("\n".join([
+        "Banco de Prueba;;;",
+        "Cuenta;191-0000000;;",
+        "",
+        "Fecha;Descripción;Cargo;Abono",
+        "02/05/2025;PLAZA VEA SURCO 1234;45,90;",
+        "03/05/2025;HABERES MAYO;;3.500,00",
+        "04/05/2025;  RETIRO   CAJERO ;200,00;",
+        "Saldo final;;;3.254,10",
+    ]).encode("latin-1"))
+
+    movimientos, omitidas = bot.leer_extracto(str(ruta))
+
+    assert movimientos == [
+        (datetime(2025, 5, 2), "GASTO", 45.9, "PLAZA VEA SURCO 1234"),
+        (datetime(2025, 5, 3), "INGRESO", 3500.0, "HABERES MAYO"),
+        (datetime(2025, 5, 4), "GASTO", 200.0, "RETIRO CAJERO"),
+    ]
+    assert omitidas == 1
+
+
+def test_csv_con_importe_con_signo(tmp_path):
+    ruta = tmp_path / "extracto.csv"
+    ruta.write_text("date,description,amount\n2025-05-02,CABIFY 998,-12.40\n2025-05-05,DEPOSITO,100\n",
+                    encoding="utf-8-sig")
+
+    movimientos, omitidas = bot.leer_extracto(str(ruta))
+
+    assert [(tipo, monto) for _, tipo, monto, _ in movimientos] == [("GASTO", 12.4), ("INGRESO", 100.0)]
+    assert omitidas == 0
+
+
+def test_csv_sin_tabla_de_movimientos(tmp_path):
+    ruta = tmp_path / "otro.csv"
+    ruta.write_text("nombre,telefono\nAna,999\n", encoding="utf-8")
+    with pytest.raises(bot.ExtractoInvalido):
+        bot.leer_extracto(str(ruta))
+
+
+def test_extracto_demasiado_largo(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, "IMPORTACION_MAX_MOVIMIENTOS", 2)
+    ruta = tmp_path / "extracto.csv"
+    ruta.write_text("fecha,detalle,monto\n" + "01/05/2025,TOTTUS,-10\n" * 3, encoding="utf-8")
+    with pytest.raises(bot.ExtractoInvalido):
+        bot.leer_extracto(str(ruta))
+
+
+def test_xlsx(tmp_path):
+    openpyxl = pytest.importorskip("openpyxl")
+    ruta = tmp_path / "extracto.xlsx"
+    libro = openpyxl.Workbook()
+    libro.active.append(["Fecha", "Glosa", "Importe"])
+    libro.active.append([datetime(2025, 5, 2), "PRIMAX 01", -80])
+    libro.save(ruta)
+
+    movimientos, _ = bot.leer_extracto(str(ruta))
+
+    assert movimientos == [(datetime(2025, 5, 2), "GASTO", 80.0, "PRIMAX 01")]
+
+
+@pytest.mark.parametrize("descripcion, tipo, concepto", [
+    ("PLAZA VEA SURCO 1234", "GASTO", "ALIMENTOS/COMIDA(DESAYUNO,ALMUERZO,CENA)"),
+    ("HABERES MAYO", "INGRESO", "SUELDO"),
+    ("CABIFY 998", "GASTO", "PASAJES"),
+    ("TRANSFERENCIA 0012", "GASTO", None),
+])
+def test_clasificar_por_reglas(descripcion, tipo, concepto):
+    assert bot.clasificar_por_reglas(bot.descripcion_base(descripcion), tipo) == concepto
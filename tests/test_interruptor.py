@@ -0,0 +1,173 @@
+import asyncio
+
+import pytest
+
+import bot
+
+
+class Reloj:
+    """time.monotonic controlado por la prueba."""
+
+    def __init__(self):
+        self.ahora = 1000.0
+
+    def __call__(self):
+        return self.ahora
+
+    def avanzar(self, segundos):
+        self.ahora += segundos
+
+
+@pytest.fixture
+def reloj(monkeypatch):
+    reloj = Reloj()
+    monkeypatch.setattr(bot.time, "monotonic", reloj)
+    return reloj
+
+
+@pytest.fixture
+def interruptor(reloj):
+    return bot.Interruptor("prueba", umbral_fallos=3, segundos_abierto=30)
+
+
+def test_se_abre_tras_n_fallos_seguidos(interruptor):
+    for _ in range(2):
+        assert interruptor.permitir()
+        interruptor.registrar_fallo()
+    assert interruptor.estado_actual == "cerrado"
+
+    assert interruptor.permitir()
+    interruptor.registrar_fallo()
+    assert interruptor.estado() == {"estado": "abierto", "fallos_seguidos": 3, "aperturas": 1}
+    assert not interruptor.permitir()
+
+
+def test_un_exito_reinicia_la_cuenta_de_fallos(interruptor):
+    interruptor.registrar_fallo()
+    interruptor.registrar_fallo()
+    interruptor.registrar_exito()
+    interruptor.registrar_fallo()
+    assert interruptor.estado_actual == "cerrado"
+    assert interruptor.fallos_seguidos == 1
+
+
+def _abrir(interruptor):
+    for _ in range(interruptor.umbral_fallos):
+        interruptor.registrar_fallo()
+    assert interruptor.estado_actual == "abierto"
+
+
+def test_semiabierto_deja_salir_una_sola_prueba(interruptor, reloj):
+    _abrir(interruptor)
+    reloj.avanzar(29)
+    assert not interruptor.permitir()
+
+    reloj.avanzar(1)
+    assert interruptor.permitir()
+    assert interruptor.estado_actual == "semiabierto"
+    # Mientras la prueba no se resuelve, no sale ninguna otra llamada
+    assert not interruptor.permitir()
+    assert not interruptor.permitir()
+
+
+def test_prueba_exitosa_cierra_el_interruptor(interruptor, reloj):
+    _abrir(interruptor)
+    reloj.avanzar(30)
+    assert interruptor.permitir()
+    interruptor.registrar_exito()
+    assert interruptor.estado() == {"estado": "cerrado", "fallos_seguidos": 0, "aperturas": 1}
+    assert interruptor.permitir()
+    assert interruptor.permitir()
+
+
+def test_prueba_fallida_vuelve_a_abrir(interruptor, reloj):
+    _abrir(interruptor)
+    reloj.avanzar(30)
+    assert interruptor.permitir()
+    interruptor.registrar_fallo()
+    assert interruptor.estado_actual == "abierto"
+    assert interruptor.aperturas == 2
+    assert not interruptor.permitir()
+    # El tiempo abierto se cuenta desde el último fallo, no desde la primera apertura
+    reloj.avanzar(29)
+    assert not interruptor.permitir()
+    reloj.avanzar(1)
+    assert interruptor.permitir()
+
+
+def test_prueba_perdida_se_repite_pasado_el_tiempo(interruptor, reloj):
+    _abrir(interruptor)
+    reloj.avanzar(30)
+    assert interruptor.permitir()
+    # La llamada de prueba nunca informa (p. ej. la tarea se canceló)
+    reloj.avanzar(29)
+    assert not interruptor.permitir()
+    reloj.avanzar(1)
+    assert interruptor.permitir()
+    assert interruptor.estado_actual == "semiabierto"
+
+
+def _ejecutor(**kwargs):
+    return bot.EjecutorBackend("prueba", max_concurrencia=2, por_minuto=1_000_000, espera_base=0, **kwargs)
+
+
+def test_ejecutor_reintenta_errores_transitorios():
+    ejecutor = _ejecutor(reintentos=3, umbral_fallos=5)
+    intentos = []
+
+    def llamada():
+        intentos.append(1)
+        if len(intentos) < 3:
+            raise ConnectionError("caído")
+        return "ok"
+
+    try:
+        assert asyncio.run(ejecutor.ejecutar(llamada)) == "ok"
+    finally:
+        ejecutor.cerrar()
+    assert len(intentos) == 3
+    assert ejecutor.reintentos_hechos == 2
+    assert ejecutor.interruptor.estado_actual == "cerrado"
+    assert ejecutor.interruptor.fallos_seguidos == 0
+
+
+def test_ejecutor_no_reintenta_errores_permanentes():
+    ejecutor = _ejecutor(reintentos=3, umbral_fallos=1)
+    intentos = []
+
+    def llamada():
+        intentos.append(1)
+        raise ValueError("petición inválida")
+
+    try:
+        with pytest.raises(ValueError):
+            asyncio.run(ejecutor.ejecutar(llamada))
+    finally:
+        ejecutor.cerrar()
+    assert len(intentos) == 1
+    # El backend respondió: el interruptor no se abre
+    assert ejecutor.disponible
+
+
+def test_ejecutor_abre_el_circuito_y_falla_sin_llamar():
+    ejecutor = _ejecutor(reintentos=5, umbral_fallos=2, segundos_abierto=60)
+    intentos = []
+
+    def llamada():
+        intentos.append(1)
+        raise TimeoutError("sin respuesta")
+
+    async def escenario():
+        with pytest.raises(bot.CircuitoAbierto):
+            await ejecutor.ejecutar(llamada)
+        with pytest.raises(bot.CircuitoAbierto):
+            await ejecutor.ejecutar(llamada)
+
+    try:
+        asyncio.run(escenario())
+    finally:
+        ejecutor.cerrar()
+    # Dos fallos abren el circuito; el resto de reintentos y la segunda llamada no llegan al backend
+    assert len(intentos) == 2
+    assert not ejecutor.disponible
+    assert ejecutor.interruptor.aperturas == 1
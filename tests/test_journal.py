@@ -0,0 +1,128 @@
+import asyncio
+import json
+
+import pytest
+
+import bot
+from benchmarks import fakes
+
+LIBRO = "Libro de pruebas"
+DESTINO = (LIBRO, "Mayo 2025")
+
+
+def _fila(n):
+    return ["14/05/2025 10:00:00", "Ana", "GASTO", "VARIABLE", "PASAJES", n, "May 2025", f"prueba:{n}"]
+
+
+@pytest.fixture
+def hoja(tmp_path, monkeypatch):
+    """Hoja del mes falsa, sin latencia, y copia local nueva para cada prueba."""
+    hoja = fakes.HojaFalsa(bot.COLUMNAS_REGISTRO, latencia=0, title=DESTINO[1])
+    monkeypatch.setitem(bot._libros_cache, LIBRO, fakes.LibroFalso(LIBRO, [hoja], latencia=0))
+    bot._hojas_cache.clear()
+    monkeypatch.setattr(bot, "libro_local", bot.LibroLocal(str(tmp_path / "libro.db")))
+    # El semáforo del ejecutor queda atado al event loop de la prueba anterior
+    monkeypatch.setattr(bot.ejecutor_sheets, "_semaforo", None)
+    yield hoja
+    bot._hojas_cache.clear()
+    bot.libro_local.cerrar()
+
+
+@pytest.fixture
+def ruta_journal(tmp_path):
+    return str(tmp_path / "registros_pendientes.jsonl")
+
+
+def _nueva_cola(ruta_journal):
+    return bot.ColaRegistros(ruta_journal, tamano_lote=50, intervalo=60)
+
+
+def _claves_en_hoja(hoja):
+    return [bot.clave_de_fila(fila) for fila in hoja.filas[1:]]
+
+
+def _reiniciar(ruta_journal):
+    """Proceso nuevo: otra cola que recupera el journal, como hace post_init."""
+    cola = _nueva_cola(ruta_journal)
+    cola.cargar_pendientes()
+    return cola
+
+
+def test_caida_antes_del_envio(hoja, ruta_journal):
+    async def escenario():
+        await _nueva_cola(ruta_journal).encolar([_fila(1), _fila(2)], DESTINO)
+        # Caída: las filas solo están en el journal
+        cola = _reiniciar(ruta_journal)
+        assert cola.pendientes == 2
+        assert await cola.vaciar()
+        return cola
+
+    cola = asyncio.run(escenario())
+    assert _claves_en_hoja(hoja) == ["prueba:1", "prueba:2"]
+    assert cola.pendientes == 0
+    assert _reiniciar(ruta_journal).pendientes == 0
+
+
+def test_caida_despues_del_envio_y_antes_del_ack(hoja, ruta_journal):
+    async def escenario():
+        cola = _nueva_cola(ruta_journal)
+        await cola.encolar([_fila(1), _fila(2)], DESTINO)
+        # El append llega a la hoja pero el proceso muere antes de escribir el ack
+        _, lote = cola._siguiente_lote(set())
+        cola._enviar_lote(lote)(hoja)
+        assert _claves_en_hoja(hoja) == ["prueba:1", "prueba:2"]
+
+        cola = _reiniciar(ruta_journal)
+        assert cola.pendientes == 2
+        assert await cola.vaciar()
+        return cola
+
+    cola = asyncio.run(escenario())
+    # Se buscan las claves en la hoja y no se vuelve a hacer append
+    assert _claves_en_hoja(hoja) == ["prueba:1", "prueba:2"]
+    assert cola.pendientes == 0
+    assert _reiniciar(ruta_journal).pendientes == 0
+
+
+def test_caida_despues_del_ack(hoja, ruta_journal):
+    async def escenario():
+        cola = _nueva_cola(ruta_journal)
+        await cola.encolar([_fila(1)], DESTINO)
+        assert await cola.vaciar()
+        await cola.encolar([_fila(2)], DESTINO)
+        # Caída con la fila 1 confirmada y la 2 sin enviar
+        cola = _reiniciar(ruta_journal)
+        assert [fila for _, fila, _ in cola.entradas_pendientes()] == [_fila(2)]
+        assert await cola.vaciar()
+
+    asyncio.run(escenario())
+    assert _claves_en_hoja(hoja) == ["prueba:1", "prueba:2"]
+    assert _reiniciar(ruta_journal).pendientes == 0
+
+
+def test_linea_a_medio_escribir_se_ignora(hoja, ruta_journal):
+    async def escenario():
+        await _nueva_cola(ruta_journal).encolar([_fila(1)], DESTINO)
+        with open(ruta_journal, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"id": "x", "fila": _fila(2), "destino": DESTINO})[:20])
+        cola = _reiniciar(ruta_journal)
+        assert cola.pendientes == 1
+        assert await cola.vaciar()
+
+    asyncio.run(escenario())
+    assert _claves_en_hoja(hoja) == ["prueba:1"]
+
+
+def test_ack_escrito_dos_veces_no_repite_filas(hoja, ruta_journal):
+    async def escenario():
+        cola = _nueva_cola(ruta_journal)
+        await cola.encolar([_fila(1), _fila(2)], DESTINO)
+        assert await cola.vaciar()
+        # Reiniciar dos veces seguidas no reenvía nada
+        for _ in range(2):
+            cola = _reiniciar(ruta_journal)
+            assert cola.pendientes == 0
+            assert await cola.vaciar()
+
+    asyncio.run(escenario())
+    assert _claves_en_hoja(hoja) == ["prueba:1", "prueba:2"]
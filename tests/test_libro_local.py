@@ -0,0 +1,46 @@
+import pytest
+
+import bot
+
+DESTINO = ("Libro Pérez", "Registro May 2025")
+
+
+def _fila(usuario, monto, clave):
+    return ["14/05/2025 10:00:00", usuario, "GASTO", "VARIABLE", "PASAJES", monto, "May 2025", clave]
+
+
+@pytest.fixture
+def libro(tmp_path):
+    libro = bot.LibroLocal(str(tmp_path / "libro.db"))
+    yield libro
+    libro.cerrar()
+
+
+def _montos(registros):
+    return [r["Monto"] for r in registros]
+
+
+def test_ultimos_de_filtra_por_id_y_no_por_nombre(libro):
+    # Dos "Juan" en la misma familia
+    libro.registrar_autores(["texto:1:1"], 1)
+    libro.insertar("a", _fila("Juan", 10, "texto:1:1"), DESTINO)
+    libro.registrar_autores(["texto:2:1"], 2)
+    libro.insertar("b", _fila("Juan", 20, "texto:2:1"), DESTINO)
+    # Fila escrita a mano en la hoja: sin autor
+    libro.incorporar_filas_hoja([_fila("Juan", 30, "")], 2, *DESTINO)
+
+    assert _montos(libro.ultimos_de(DESTINO[0], 1, 10)) == [10]
+    assert _montos(libro.ultimos_de(DESTINO[0], 2, 10)) == [20]
+    assert libro.ultimos_de("Otro libro", 1, 10) == []
+
+
+def test_el_autor_sobrevive_a_la_reconstruccion(libro):
+    libro.registrar_autores(["texto:1:1", "texto:1:2"], 1)
+    libro.insertar("a", _fila("Juan", 10, "texto:1:1"), DESTINO)
+    libro.insertar("b", _fila("Juan", 20, "texto:1:2"), DESTINO)
+    libro.marcar_enviadas(["a", "b"], 2)
+
+    libro.preparar_reconstruccion()
+    libro.incorporar_filas_hoja([_fila("Juan", 10, "texto:1:1"), _fila("Juan", 20, "texto:1:2")], 2, *DESTINO)
+
+    assert sorted(_montos(libro.ultimos_de(DESTINO[0], 1, 10))) == [10, 20]
@@ -0,0 +1,70 @@
+import asyncio
+
+import bot
+
+
+class Reloj:
+    """time.monotonic y asyncio.sleep falsos: dormir solo avanza el reloj."""
+
+    def __init__(self):
+        self.ahora = 1000.0
+        self.dormido = 0.0
+
+    def monotonic(self):
+        return self.ahora
+
+    async def sleep(self, segundos):
+        self.ahora += segundos
+        self.dormido += segundos
+
+
+def _limitador(monkeypatch, por_minuto, rafaga=None):
+    reloj = Reloj()
+    monkeypatch.setattr(bot.time, "monotonic", reloj.monotonic)
+    monkeypatch.setattr(bot.asyncio, "sleep", reloj.sleep)
+    return bot.LimitadorTokens(por_minuto, rafaga), reloj
+
+
+def test_rafaga_inicial_sin_esperas(monkeypatch):
+    limitador, reloj = _limitador(monkeypatch, por_minuto=60, rafaga=5)
+
+    async def escenario():
+        for _ in range(5):
+            await limitador.adquirir()
+
+    asyncio.run(escenario())
+    assert reloj.dormido == 0
+    assert limitador.esperas == 0
+
+
+def test_agotada_la_rafaga_se_respeta_la_cuota(monkeypatch):
+    limitador, reloj = _limitador(monkeypatch, por_minuto=60, rafaga=5)
+
+    async def escenario():
+        for _ in range(15):
+            await limitador.adquirir()
+
+    asyncio.run(escenario())
+    # 60 por minuto es uno por segundo: las 10 peticiones después de la ráfaga esperan 10 s
+    assert abs(reloj.dormido - 10) < 1e-6
+    assert limitador.esperas == 10
+
+
+def test_los_tokens_se_recargan_hasta_la_capacidad(monkeypatch):
+    limitador, reloj = _limitador(monkeypatch, por_minuto=60, rafaga=5)
+
+    async def escenario():
+        for _ in range(5):
+            await limitador.adquirir()
+
+    asyncio.run(escenario())
+    assert limitador.estado()["tokens"] == 0
+    reloj.ahora += 2
+    assert limitador.estado()["tokens"] == 2
+    reloj.ahora += 3600
+    assert limitador.estado()["tokens"] == 5
+
+
+def test_rafaga_por_defecto_es_la_cuota_de_diez_segundos():
+    assert bot.LimitadorTokens(600).capacidad == 100
+    assert bot.LimitadorTokens(3).capacidad == 1
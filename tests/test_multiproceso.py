@@ -0,0 +1,55 @@
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def familias(monkeypatch):
+    monkeypatch.setattr(bot, "users_db", {
+        1: {"nombre": "Ana", "familia_id": "perez"},
+        2: {"nombre": "Luis", "familia_id": "perez"},
+        3: {"nombre": "Sofía", "familia_id": "rojas"},
+        4: {"nombre": "Juan", "familia_id": None},
+    })
+    monkeypatch.setattr(bot, "families_db", {
+        "perez": {"nombre": "Pérez", "spreadsheet": "Libro Pérez"},
+        "rojas": {"nombre": "Rojas", "spreadsheet": "Libro Rojas"},
+    })
+
+
+def _mensaje(user_id, update_id=1):
+    return {"update_id": update_id, "message": {"message_id": 1, "from": {"id": user_id}, "text": "hola"}}
+
+
+def _callback(user_id, update_id=1):
+    return {"update_id": update_id, "callback_query": {"id": "x", "from": {"id": user_id}, "data": "confirmar"}}
+
+
+@pytest.mark.parametrize("trabajadores", [2, 3, 8])
+def test_la_familia_cae_en_el_trabajador_dueno_de_su_libro(familias, trabajadores):
+    dueno = bot.trabajador_de_libro("Libro Pérez", trabajadores)
+    for datos in (_mensaje(1), _mensaje(2, update_id=7), _callback(1), _callback(2)):
+        assert bot.trabajador_de_update(datos, trabajadores) == dueno
+    assert bot.trabajador_de_update(_mensaje(3), trabajadores) == bot.trabajador_de_libro("Libro Rojas", trabajadores)
+
+
+def test_sin_familia_se_usa_el_trabajador_del_libro_por_defecto(familias):
+    assert bot.trabajador_de_update(_mensaje(4), 4) == bot.trabajador_de_libro(bot.LIBRO_POR_DEFECTO, 4)
+    assert bot.trabajador_de_update(_mensaje(99), 4) == bot.trabajador_de_libro(bot.LIBRO_POR_DEFECTO, 4)
+
+
+def test_el_reparto_es_estable():
+    # No depende de PYTHONHASHSEED: el enrutador y los trabajadores son procesos distintos
+    assert bot.trabajador_de_libro("Libro Pérez", 1000) == bot.trabajador_de_libro("Libro Pérez", 1000)
+    assert {bot.trabajador_de_libro(f"Libro {i}", 4) for i in range(50)} == {0, 1, 2, 3}
+
+
+def test_cada_trabajador_sincroniza_solo_sus_libros(monkeypatch):
+    monkeypatch.setattr(bot, "TRABAJADORES", 4)
+    dueno = bot.trabajador_de_libro("Libro Pérez", 4)
+    monkeypatch.setattr(bot, "TRABAJADOR", str(dueno))
+    assert bot.es_libro_propio("Libro Pérez")
+    monkeypatch.setattr(bot, "TRABAJADOR", str((dueno + 1) % 4))
+    assert not bot.es_libro_propio("Libro Pérez")
+    monkeypatch.setattr(bot, "TRABAJADOR", None)
+    assert bot.es_libro_propio("Libro Pérez")
@@ -0,0 +1,85 @@
+from datetime import datetime
+
+import pytest
+
+import bot
+
+# Miércoles
+HOY = datetime(2025, 5, 14, 10, 30)
+
+
+@pytest.mark.parametrize("texto, esperado", [
+    ("GASTO 50 ALIMENTOS", ("GASTO", 50.0, "ALIMENTOS/COMIDA(DESAYUNO,ALMUERZO,CENA)", "VARIABLE")),
+    ("gasté 30 en pasajes", ("GASTO", 30.0, "PASAJES", "VARIABLE")),
+    ("pagué S/ 12,50 de taxi", ("GASTO", 12.5, "PASAJES", "VARIABLE")),
+    ("sueldo 1500", ("INGRESO", 1500.0, "SUELDO", "FIJO")),
+    ("quincena 800", ("INGRESO", 800.0, "SUELDO", "FIJO")),
+    ("luz 120", ("GASTO", 120.0, "LUZ", "FIJO")),
+    ("luz 120 variable", ("GASTO", 120.0, "LUZ", "VARIABLE")),
+    ("compré zapatillas 150 soles", ("GASTO", 150.0, "CALZADO/ZAPATILLA/ZAPATO", "VARIABLE")),
+    ("tarjeta de crédito 300", ("GASTO", 300.0, "TARJETA DE CREDITO", "FIJO")),
+    ("gasté 10 en otros", ("GASTO", 10.0, "OTROS GASTOS", "VARIABLE")),
+])
+def test_frases_aceptadas(texto, esperado):
+    datos = bot.parsear_mensaje_local(texto, hoy=HOY)
+    assert datos is not None
+    assert (datos["tipo"], datos["monto"], datos["concepto"], datos["categoria"]) == esperado
+    assert datos["fecha"] == "actual"
+
+
+def test_palabra_de_tipo_elige_la_lista_del_concepto():
+    # REGALOS está en ingresos y en gastos: sin palabra clave es ambiguo
+    assert bot.parsear_mensaje_local("regalos 50", hoy=HOY) is None
+    assert bot.parsear_mensaje_local("recibí regalos 50", hoy=HOY)["tipo"] == "INGRESO"
+    assert bot.parsear_mensaje_local("compré regalos 50", hoy=HOY)["tipo"] == "GASTO"
+
+
+@pytest.mark.parametrize("texto", [
+    "",
+    "hola",
+    "pasajes",                              # sin monto
+    "pasajes 5 y 10",                       # dos montos
+    "otros 10",                             # OTROS es ingreso y gasto
+    "luz 50 pasajes",                       # dos conceptos distintos
+    "gasté y cobré 50 de luz",              # dos tipos
+    "cobré 50 de luz",                      # LUZ no es un ingreso
+    "pagué 37 por unas cositas varias",     # concepto desconocido
+    "pasajes 20 con mi primo el gordito",   # demasiadas palabras desconocidas
+])
+def test_frases_rechazadas(texto):
+    assert bot.parsear_mensaje_local(texto, hoy=HOY) is None
+
+
+def test_la_fecha_no_se_toma_como_monto():
+    datos = bot.parsear_mensaje_local("pasajes 5 el 03/05", hoy=HOY)
+    assert datos["monto"] == 5.0
+    assert datos["fecha"] == "03/05/2025"
+
+
+@pytest.mark.parametrize("texto, esperado", [
+    ("PASAJES 5", "actual"),
+    ("PASAJES 5 HOY", "actual"),
+    ("PASAJES 5 AYER", "13/05/2025"),
+    ("PASAJES 5 ANTEAYER", "12/05/2025"),
+    ("PASAJES 5 ANTIER", "12/05/2025"),
+    ("PASAJES 5 EL LUNES", "12/05/2025"),
+    ("PASAJES 5 EL DOMINGO PASADO", "11/05/2025"),
+    # El mismo día de la semana que hoy es el de la semana pasada
+    ("PASAJES 5 EL MIERCOLES", "07/05/2025"),
+    ("PASAJES 5 EL JUEVES", "08/05/2025"),
+    ("PASAJES 5 3/5", "03/05/2025"),
+    ("PASAJES 5 03-05-24", "03/05/2024"),
+    ("PASAJES 5 31/12/2024", "31/12/2024"),
+])
+def test_resolver_fecha_relativa(texto, esperado):
+    assert bot.resolver_fecha_relativa(texto, hoy=HOY) == esperado
+
+
+@pytest.mark.parametrize("texto", [
+    "PASAJES 5 31/02",        # día inexistente
+    "PASAJES 5 10/13/2025",   # mes inexistente
+    "PASAJES 5 MARTESITO",    # no es un día de la semana
+    "PASAJES 12,50",          # un monto con decimales no es una fecha
+])
+def test_resolver_fecha_relativa_sin_fecha_valida(texto):
+    assert bot.resolver_fecha_relativa(texto, hoy=HOY) == "actual"
@@ -0,0 +1,50 @@
+import asyncio
+
+import bot
+
+MES = "May 2025"
+
+
+def _gasto(monto, concepto="PASAJES", tipo="GASTO", mes=MES):
+    return ["14/05/2025 10:00:00", "Ana", tipo, "VARIABLE", concepto, monto, mes]
+
+
+def test_aviso_al_cruzar_cada_umbral():
+    assert bot.aviso_presupuesto("PASAJES", MES, 100, 0, 79) is None
+    assert "80%" in bot.aviso_presupuesto("PASAJES", MES, 100, 79, 80)
+    assert bot.aviso_presupuesto("PASAJES", MES, 100, 80, 95) is None
+    assert bot.aviso_presupuesto("PASAJES", MES, 100, 95, 120).startswith("🚨")
+    assert bot.aviso_presupuesto("PASAJES", MES, 100, 120, 150) is None
+    # Un solo gasto que cruza los dos umbrales da un solo aviso, el de superado
+    assert bot.aviso_presupuesto("PASAJES", MES, 100, 10, 130).startswith("🚨")
+    assert bot.aviso_presupuesto("PASAJES", MES, None, 0, 1000) is None
+
+
+def test_gastos_suman_por_usuario_mes_y_concepto(entorno):
+    bot.users_db.actualizar(1, presupuestos={"PASAJES": 100})
+
+    assert bot.sumar_gastos_presupuesto(1, [_gasto(50), _gasto(20), _gasto(500, concepto="LUZ"),
+                                            _gasto(900, tipo="INGRESO", concepto="SUELDO")]) == []
+    assert bot.almacen.contador("gastos_mes", bot.clave_gasto_mes(1, MES, "PASAJES")) == 70
+    assert bot.almacen.contador("gastos_mes", bot.clave_gasto_mes(1, MES, "SUELDO")) == 0
+
+    avisos = bot.sumar_gastos_presupuesto(1, [_gasto(15)])
+    assert len(avisos) == 1 and "85%" in avisos[0]
+    # Otro mes y otro usuario llevan su propia cuenta
+    assert bot.sumar_gastos_presupuesto(1, [_gasto(15, mes="Jun 2025")]) == []
+    assert bot.sumar_gastos_presupuesto(2, [_gasto(95)]) == []
+
+
+def test_registro_repetido_no_cuenta_dos_veces(entorno):
+    bot.users_db.actualizar(1, presupuestos={"PASAJES": 100})
+
+    async def escenario():
+        primero = await bot.guardar_registro(_gasto(90), 1, "prueba:1")
+        repetido = await bot.guardar_registro(_gasto(90), 1, "prueba:1")
+        await bot.cola_registros.vaciar()
+        return primero, repetido
+
+    primero, repetido = asyncio.run(escenario())
+    assert len(primero) == 1 and "90%" in primero[0]
+    assert repetido is None
+    assert bot.almacen.contador("gastos_mes", bot.clave_gasto_mes(1, MES, "PASAJES")) == 90